@@ -0,0 +1,369 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+# Throughput benchmark under concurrent arrivals: requests arrive by a Poisson
+# process (or a replayed trace) and are served by the in-process continuous batching
+# engine or by a FastChat/vLLM OpenAI-compatible API server.
+import json
+import random
+import threading
+import time
+
+import numpy as np
+import torch
+from datetime import date
+
+import os
+current_dir = os.path.dirname(os.path.realpath(__file__))
+from ipex_llm.utils.common import invalidInputError
+from ipex_llm.serving.fastchat.continuous_batching import ContinuousBatchingEngine
+
+results = []
+
+CSV_COLUMNS = ['model', '1st token avg latency (ms)', '2+ avg latency (ms/token)', 'encoder time (ms)',
+               'input/output tokens', 'batch_size', 'actual input/output tokens', 'num_beams', 'low_bit',
+               'cpu_embedding', 'model loading time (s)', 'peak mem (GB)', 'streaming', 'use_fp16_torch_dtype',
+               'backend', 'request rate (req/s)', 'num requests', 'duration (s)', 'throughput (req/s)',
+               'output throughput (tokens/s)', 'goodput (req/s)',
+               'TTFT p50 (ms)', 'TTFT p90 (ms)', 'TTFT p99 (ms)',
+               'TPOT p50 (ms/token)', 'TPOT p90 (ms/token)', 'TPOT p99 (ms/token)',
+               'queueing delay p50 (ms)', 'queueing delay p99 (ms)', 'e2e latency p99 (ms)',
+               'KV cache peak mem (GB)']
+
+
+def get_model_path(repo_id, local_model_hub):
+    if local_model_hub:
+        repo_model_name = repo_id.split("/")[1]
+        local_model_path = local_model_hub + os.path.sep + repo_model_name
+        invalidInputError(os.path.isdir(local_model_path),
+                          local_model_path + " not exists!, Please check your models' folder.")
+        return local_model_path
+    else:
+        return repo_id
+
+
+def get_prompt_ids(tokenizer, in_len):
+    # As different tokenizer has different encodings,
+    # in_len.txt maybe shorter than we need,
+    # use much longer context to make sure input length
+    test_length = min(in_len*2, 8192)
+    while test_length not in [32, 256, 1024, 2048, 8192]:
+        test_length = test_length * 2
+    input_str = open(f"{current_dir}/prompt/continuation/{test_length}.txt", 'r').read()
+    input_ids = tokenizer.encode(input_str)
+    return input_ids[:in_len]
+
+
+def get_arrivals(request_rate, num_requests, in_out_pairs, arrival_trace, seed):
+    """Return a list of (arrival time, input tokens, output tokens) sorted by arrival time."""
+    if arrival_trace:
+        arrivals = []
+        with open(arrival_trace, 'r') as f:
+            for line in f:
+                fields = line.strip().split(',')
+                if len(fields) < 3 or not fields[0].replace('.', '', 1).isdigit():
+                    # skip the header and blank lines
+                    continue
+                arrivals.append((float(fields[0]), int(fields[1]), int(fields[2])))
+        return sorted(arrivals)
+    rng = random.Random(seed)
+    arrivals = []
+    arrival_time = 0.0
+    for i in range(num_requests):
+        in_len, out_len = [int(x) for x in in_out_pairs[i % len(in_out_pairs)].split('-')]
+        arrivals.append((arrival_time, in_len, out_len))
+        if request_rate != float('inf'):
+            arrival_time += rng.expovariate(request_rate)
+    return arrivals
+
+
+class RequestRecord:
+    """Timestamps of one request, also a streamer of `ContinuousBatchingEngine`."""
+
+    def __init__(self, arrival, in_len):
+        self.arrival = arrival
+        self.in_len = in_len
+        self.start = None
+        self.token_times = []
+        self.prompt_skipped = False
+        self.done = threading.Event()
+
+    def put(self, value):
+        if not self.prompt_skipped:
+            # the prompt is put first
+            self.prompt_skipped = True
+            return
+        self.token_times.extend([time.perf_counter()] * value.numel())
+
+    def end(self):
+        self.done.set()
+
+    def ttft(self):
+        return self.token_times[0] - self.arrival
+
+    def tpot(self):
+        if len(self.token_times) < 2:
+            return None
+        return (self.token_times[-1] - self.token_times[0]) / (len(self.token_times) - 1)
+
+
+def kv_cache_nbytes(past_key_values):
+    # allocated bytes of the kv buffers, preallocated room included
+    if past_key_values is None:
+        return 0
+    if isinstance(past_key_values, (tuple, list)):
+        tensors = [t for layer in past_key_values for t in layer]
+    else:
+        tensors = [t for name in ['key_cache', 'value_cache', 'key_scale', 'value_scale']
+                   for t in getattr(past_key_values, name, [])]
+    storages = {}
+    for t in tensors:
+        storage = t.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+    return sum(storages.values())
+
+
+class BenchmarkEngine(ContinuousBatchingEngine):
+    """Records the prefill start of each request and the kv cache high-water mark."""
+    kv_peak = 0
+
+    def prefill(self, seq):
+        seq.streamer.start = time.perf_counter()
+        super().prefill(seq)
+        self.kv_peak = max(self.kv_peak, kv_cache_nbytes(self.past_key_values))
+
+    def decode(self):
+        super().decode()
+        self.kv_peak = max(self.kv_peak, kv_cache_nbytes(self.past_key_values))
+
+
+def run_in_process(engine, tokenizer, arrivals, warm_up):
+    prompts = {}
+
+    def submit(record, out_len):
+        if record.in_len not in prompts:
+            prompts[record.in_len] = get_prompt_ids(tokenizer, record.in_len)
+        engine.submit(torch.tensor([prompts[record.in_len]]), record, out_len, [])
+
+    for _, in_len, out_len in arrivals[:warm_up]:
+        record = RequestRecord(time.perf_counter(), in_len)
+        submit(record, out_len)
+        record.done.wait()
+    engine.kv_peak = 0
+
+    records = []
+    bench_start = time.perf_counter()
+    for arrival, in_len, out_len in arrivals:
+        delay = bench_start + arrival - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        record = RequestRecord(time.perf_counter(), in_len)
+        submit(record, out_len)
+        records.append(record)
+    for record in records:
+        record.done.wait()
+    return records, bench_start, engine.kv_peak
+
+
+def run_api_server(backend, server_url, model_name, tokenizer, arrivals, warm_up):
+    import requests
+
+    prompts = {}
+    for _, in_len, _ in arrivals:
+        if in_len not in prompts:
+            prompts[in_len] = tokenizer.decode(get_prompt_ids(tokenizer, in_len),
+                                               skip_special_tokens=True)
+
+    def send(record, out_len):
+        payload = {
+            "model": model_name,
+            "prompt": prompts[record.in_len],
+            "max_tokens": out_len,
+            "temperature": 0,
+            "stream": True,
+        }
+        if backend == 'vllm':
+            # keep the requested output length
+            payload["ignore_eos"] = True
+        try:
+            record.start = time.perf_counter()
+            text = ""
+            with requests.post(f"{server_url}/v1/completions", json=payload, stream=True) as r:
+                for line in r.iter_lines():
+                    line = line.decode("utf-8").strip()
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk_text = json.loads(data)["choices"][0].get("text", "")
+                    if chunk_text:
+                        # a chunk holds one or more tokens, count them on the joined text
+                        text += chunk_text
+                        num_tokens = len(tokenizer.encode(text, add_special_tokens=False))
+                        now = time.perf_counter()
+                        record.token_times.extend(
+                            [now] * max(num_tokens - len(record.token_times), 0))
+        except Exception as e:
+            print(f"request failed: {e}")
+        finally:
+            record.end()
+
+    for _, in_len, out_len in arrivals[:warm_up]:
+        send(RequestRecord(time.perf_counter(), in_len), out_len)
+
+    records = []
+    threads = []
+    bench_start = time.perf_counter()
+    for arrival, in_len, out_len in arrivals:
+        delay = bench_start + arrival - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        record = RequestRecord(time.perf_counter(), in_len)
+        thread = threading.Thread(target=send, args=(record, out_len), daemon=True)
+        thread.start()
+        records.append(record)
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    # the queue of an API server is not observable from the client
+    for record in records:
+        record.start = None
+    return records, bench_start, None
+
+
+def load_model(repo_id, local_model_hub, low_bit, device):
+    from ipex_llm.transformers import AutoModelForCausalLM
+    from transformers import AutoTokenizer
+
+    model_path = get_model_path(repo_id, local_model_hub)
+    st = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(model_path, load_in_low_bit=low_bit, optimize_model=True,
+                                                 trust_remote_code=True, use_cache=True).eval()
+    if device == 'xpu':
+        import intel_extension_for_pytorch as ipex
+        model = model.half().to('xpu')
+    tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
+    end = time.perf_counter()
+    load_time = end - st
+    print(">> loading of model costs {}s".format(load_time))
+    return model, tokenizer, load_time
+
+
+def summarize(repo_id, conf, request_rate, records, bench_start, kv_peak, load_time, peak_mem):
+    records = [r for r in records if len(r.token_times) > 0]
+    invalidInputError(len(records) > 0, "All requests failed, please check the serving backend.")
+    duration = max(r.token_times[-1] for r in records) - bench_start
+    ttfts = np.array([r.ttft() for r in records]) * 1000.0
+    tpots = np.array([r.tpot() for r in records if r.tpot() is not None]) * 1000.0
+    if len(tpots) == 0:
+        tpots = np.zeros(1)
+    e2e = np.array([r.token_times[-1] - r.arrival for r in records]) * 1000.0
+    queue_delays = np.array([r.start - r.arrival for r in records if r.start is not None]) * 1000.0
+    num_good = sum(1 for r in records
+                   if r.ttft() * 1000.0 <= conf['ttft_slo_ms'] and
+                   (r.tpot() is None or r.tpot() * 1000.0 <= conf['tpot_slo_ms']))
+    num_output_tokens = sum(len(r.token_times) for r in records)
+
+    def pct(values, q):
+        return round(float(np.percentile(values, q)), 2) if len(values) > 0 else 'N/A'
+
+    in_lens = sorted(set(r.in_len for r in records))
+    in_out = '/'.join(conf['in_out_pairs']) if not conf['arrival_trace'] else 'trace'
+    results.append([repo_id,
+                    round(float(np.mean(ttfts)), 2),
+                    round(float(np.mean(tpots)), 2),
+                    'N/A',
+                    in_out,
+                    conf['max_num_seqs'] if conf['backend'] == 'in_process' else 'N/A',
+                    f'{int(np.mean([r.in_len for r in records]))}' +
+                    f'-{int(num_output_tokens / len(records))}',
+                    1,
+                    conf['low_bit'],
+                    'N/A',
+                    round(load_time, 2) if load_time is not None else 'N/A',
+                    peak_mem,
+                    True,
+                    'N/A',
+                    conf['backend'],
+                    request_rate,
+                    len(records),
+                    round(duration, 2),
+                    round(len(records) / duration, 3),
+                    round(num_output_tokens / duration, 2),
+                    round(num_good / duration, 3),
+                    pct(ttfts, 50), pct(ttfts, 90), pct(ttfts, 99),
+                    pct(tpots, 50), pct(tpots, 90), pct(tpots, 99),
+                    pct(queue_delays, 50), pct(queue_delays, 99),
+                    pct(e2e, 99),
+                    round(kv_peak / (1024**3), 3) if kv_peak is not None else 'N/A'])
+    print(f">> {repo_id} @ {request_rate} req/s, prompt lengths {in_lens}: "
+          f"{results[-1][18]} req/s, {results[-1][19]} tokens/s, goodput {results[-1][20]} req/s")
+
+
+def run_model(repo_id, conf):
+    backend = conf['backend']
+    invalidInputError(backend in ['in_process', 'fastchat', 'vllm'],
+                      "Unknown backend " + backend + ", please check your serving-config.yaml.")
+    load_time = None
+    if backend == 'in_process':
+        model, tokenizer, load_time = load_model(repo_id, conf['local_model_hub'], conf['low_bit'],
+                                                 conf['device'])
+        engine = BenchmarkEngine(model, max_num_seqs=conf['max_num_seqs'])
+    else:
+        from transformers import AutoTokenizer
+        model = None
+        tokenizer = AutoTokenizer.from_pretrained(get_model_path(repo_id, conf['local_model_hub']),
+                                                  trust_remote_code=True)
+    model_name = conf['served_model_name'] or repo_id.split('/')[-1]
+
+    request_rates = conf['request_rates'] if not conf['arrival_trace'] else ['trace']
+    for request_rate in request_rates:
+        rate = float(request_rate) if request_rate != 'trace' else None
+        arrivals = get_arrivals(rate, conf['num_requests'], conf['in_out_pairs'],
+                                conf['arrival_trace'], conf['seed'])
+        peak_mem = 'N/A'
+        if backend == 'in_process':
+            if conf['device'] == 'xpu':
+                torch.xpu.reset_peak_memory_stats()
+            records, bench_start, kv_peak = run_in_process(engine, tokenizer, arrivals,
+                                                           conf['warm_up'])
+            if conf['device'] == 'xpu':
+                peak_mem = round(torch.xpu.max_memory_reserved() / (1024**3), 2)
+        else:
+            records, bench_start, kv_peak = run_api_server(backend, conf['server_url'], model_name,
+                                                           tokenizer, arrivals, conf['warm_up'])
+        summarize(repo_id, conf, request_rate, records, bench_start, kv_peak, load_time, peak_mem)
+
+    if model is not None:
+        # the engine thread blocks on an empty queue and keeps a reference to the model
+        engine.model = None
+        del model, engine
+        if conf['device'] == 'xpu':
+            torch.xpu.empty_cache()
+
+
+if __name__ == '__main__':
+    from omegaconf import OmegaConf
+    conf = OmegaConf.load(f'{current_dir}/serving-config.yaml')
+    today = date.today()
+
+    import pandas as pd
+    for model in conf.repo_id:
+        run_model(model, conf)
+    df = pd.DataFrame(results, columns=CSV_COLUMNS)
+    df.to_csv(f'{current_dir}/{conf["backend"]}-serving-results-{today}.csv')
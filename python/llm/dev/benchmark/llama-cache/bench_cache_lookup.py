@@ -0,0 +1,118 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Microbenchmark of LlamaCache lookup/insert cost as the number of cached states grows,
+# compared with the previous linear longest-prefix scan.
+
+import argparse
+import random
+import time
+from collections import deque, OrderedDict
+
+from ipex_llm.ggml.model.llama.llama import Llama, LlamaCache, LlamaState
+
+
+class LinearScanCache:
+    """The previous LlamaCache implementation, kept here as the baseline."""
+
+    def __init__(self, capacity_bytes=(2 << 30)):
+        self.cache_state = OrderedDict()
+        self.capacity_bytes = capacity_bytes
+
+    @property
+    def cache_size(self):
+        return sum([state.llama_state_size for state in self.cache_state.values()])
+
+    def _find_longest_prefix_key(self, key):
+        min_len = 0
+        min_key = None
+        keys = ((k, Llama.longest_token_prefix(k, key)) for k in self.cache_state.keys())
+        for k, prefix_len in keys:
+            if prefix_len > min_len:
+                min_len = prefix_len
+                min_key = k
+        return min_key
+
+    def __getitem__(self, key):
+        key = tuple(key)
+        _key = self._find_longest_prefix_key(key)
+        value = self.cache_state[_key]
+        self.cache_state.move_to_end(_key)
+        return value
+
+    def __contains__(self, key):
+        return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key, value):
+        key = tuple(key)
+        if key in self.cache_state:
+            del self.cache_state[key]
+        self.cache_state[key] = value
+        while self.cache_size > self.capacity_bytes:
+            self.cache_state.popitem(last=False)
+
+
+def make_keys(num_keys, prefix_len, suffix_len, num_prefixes, vocab_size=32000):
+    # requests share one of a few system prompts, followed by a unique suffix
+    prefixes = [[random.randrange(vocab_size) for _ in range(prefix_len)]
+                for _ in range(num_prefixes)]
+    return [tuple(random.choice(prefixes) +
+                  [random.randrange(vocab_size) for _ in range(suffix_len)])
+            for _ in range(num_keys)]
+
+
+def make_state(state_size):
+    return LlamaState(eval_tokens=deque(), eval_logits=deque(),
+                      llama_state=None, llama_state_size=state_size)
+
+
+def bench(cache_cls, keys, queries):
+    cache = cache_cls()
+    st = time.perf_counter()
+    for key in keys:
+        cache[key] = make_state(1)
+    insert_time = (time.perf_counter() - st) / len(keys)
+    st = time.perf_counter()
+    for query in queries:
+        if query in cache:
+            cache[query]
+    lookup_time = (time.perf_counter() - st) / len(queries)
+    return insert_time, lookup_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark LlamaCache lookup scaling')
+    parser.add_argument('--cache-sizes', type=int, nargs='+', default=[16, 64, 256, 1024],
+                        help='Number of cached states to benchmark with')
+    parser.add_argument('--prefix-len', type=int, default=512,
+                        help='Length of the shared system prompt')
+    parser.add_argument('--suffix-len', type=int, default=256,
+                        help='Length of the per-request part of each key')
+    parser.add_argument('--num-prefixes', type=int, default=4,
+                        help='Number of distinct system prompts')
+    parser.add_argument('--num-queries', type=int, default=200)
+    args = parser.parse_args()
+
+    random.seed(42)
+    print(f"{'num_keys':>10} {'impl':>12} {'insert(us)':>12} {'lookup(us)':>12}")
+    for num_keys in args.cache_sizes:
+        keys = make_keys(num_keys, args.prefix_len, args.suffix_len, args.num_prefixes)
+        queries = [key[:args.prefix_len + args.suffix_len // 2]
+                   for key in random.choices(keys, k=args.num_queries)]
+        for name, cache_cls in [("linear", LinearScanCache), ("trie", LlamaCache)]:
+            insert_time, lookup_time = bench(cache_cls, keys, queries)
+            print(f"{num_keys:>10} {name:>12} {insert_time * 1e6:>12.1f} "
+                  f"{lookup_time * 1e6:>12.1f}")
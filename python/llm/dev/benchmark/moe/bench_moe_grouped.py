@@ -0,0 +1,110 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Microbenchmark of one low-bit Mixtral MoE block on CPU over a sweep of batch sizes,
+# comparing the grouped expert execution with the previous per-expert one-hot loop.
+
+import argparse
+import os
+import time
+import types
+
+import torch
+import torch.nn.functional as F
+from transformers import MixtralConfig
+from transformers.models.mixtral.modeling_mixtral import MixtralSparseMoeBlock
+
+from ipex_llm import optimize_model
+from ipex_llm.transformers.models.mixtral import mixtral_moeblock_forward, mixtral_mlp_forward
+
+
+def one_hot_moeblock_forward(self, hidden_states):
+    """The previous cpu path of `mixtral_moeblock_forward`, kept as the baseline."""
+    hidden_dim = hidden_states.size(-1)
+    router_logits = self.gate(hidden_states)
+    routing_weights = F.softmax(router_logits, dim=1, dtype=torch.float)
+    routing_weights, selected_experts = torch.topk(routing_weights, self.top_k, dim=-1)
+    routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
+    routing_weights = routing_weights.to(hidden_states.dtype)
+
+    final_hidden_states = torch.zeros_like(hidden_states)
+    expert_mask = torch.nn.functional.one_hot(selected_experts,
+                                              num_classes=self.num_experts).permute(2, 1, 0)
+    for expert_idx in range(self.num_experts):
+        expert_layer = self.experts[expert_idx]
+        idx, top_x = torch.where(expert_mask[expert_idx])
+        if top_x.shape[0] == 0:
+            continue
+        top_x_list = top_x.tolist()
+        idx_list = idx.tolist()
+        current_state = hidden_states[None, top_x_list].reshape(-1, hidden_dim)
+        current_hidden_states = expert_layer(current_state,
+                                             routing_weights[top_x_list, idx_list, None])
+        final_hidden_states.index_add_(0, top_x, current_hidden_states.to(hidden_states.dtype))
+    return final_hidden_states, router_logits
+
+
+def bench(fn, warm_up, num_trials):
+    for _ in range(warm_up):
+        result = fn()
+    st = time.perf_counter()
+    for _ in range(num_trials):
+        result = fn()
+    return (time.perf_counter() - st) / num_trials, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark grouped MoE experts on CPU')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[2, 8, 32, 128, 512],
+                        help='Number of tokens sent to the MoE block')
+    parser.add_argument('--expert-threads', type=int, nargs='+', default=[1, 2, 4],
+                        help='Values of IPEX_LLM_MOE_EXPERT_THREADS to benchmark with')
+    parser.add_argument('--hidden-size', type=int, default=4096)
+    parser.add_argument('--intermediate-size', type=int, default=14336)
+    parser.add_argument('--num-experts', type=int, default=8)
+    parser.add_argument('--top-k', type=int, default=2)
+    parser.add_argument('--low-bit', type=str, default='sym_int4')
+    parser.add_argument('--warm-up', type=int, default=1)
+    parser.add_argument('--num-trials', type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(42)
+    config = MixtralConfig(hidden_size=args.hidden_size,
+                           intermediate_size=args.intermediate_size,
+                           num_local_experts=args.num_experts,
+                           num_experts_per_tok=args.top_k)
+    block = MixtralSparseMoeBlock(config).eval()
+    block = optimize_model(block, low_bit=args.low_bit, optimize_llm=False)
+    for expert in block.experts:
+        expert.forward = types.MethodType(mixtral_mlp_forward, expert)
+
+    print(f"{'batch_size':>10} {'impl':>12} {'time(ms)':>10} {'speedup':>10} {'max_diff':>10}")
+    with torch.inference_mode():
+        for batch_size in args.batch_sizes:
+            hidden_states = torch.randn(1, batch_size, args.hidden_size)
+            base_time, (base_out, _) = bench(
+                lambda: one_hot_moeblock_forward(block, hidden_states.view(batch_size, -1)),
+                args.warm_up, args.num_trials)
+            print(f"{batch_size:>10} {'one_hot':>12} {base_time * 1e3:>10.1f}")
+            for num_threads in args.expert_threads:
+                os.environ["IPEX_LLM_MOE_EXPERT_THREADS"] = str(num_threads)
+                grouped_time, (grouped_out, _) = bench(
+                    lambda: mixtral_moeblock_forward(block, hidden_states),
+                    args.warm_up, args.num_trials)
+                max_diff = (base_out - grouped_out.view(batch_size, -1)).abs().max().item()
+                print(f"{batch_size:>10} {f'grouped_{num_threads}':>12} "
+                      f"{grouped_time * 1e3:>10.1f} {base_time / grouped_time:>9.1f}x "
+                      f"{max_diff:>10.2e}")
@@ -19,12 +19,108 @@
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torch.nn import CrossEntropyLoss
 from tqdm import tqdm
+from contextlib import contextmanager
 import gc
 
 from ipex_llm.transformers import AutoModelForCausalLM, AutoModel
 
+# decoder-only rope models whose logits are exactly `lm_head(last_hidden_state)` and whose
+# kv cache is [batch_size, num_heads, seq_len, head_dim] for every layer
+SLIDING_WINDOW_MODEL_TYPES = ["llama", "mistral", "mixtral", "qwen2", "qwen2_moe", "baichuan",
+                              "internlm", "stablelm", "starcoder2", "phi", "phi3", "gemma"]
+
+
+def _chunked_nll(hidden_states, lm_head, labels, chunk_size):
+    # cross entropy of `chunk_size` positions at a time, the full logits never exist
+    nll = torch.zeros(labels.size(0), dtype=torch.float32, device=labels.device)
+    for start in range(0, labels.size(1), chunk_size):
+        logits = lm_head(hidden_states[:, start:start + chunk_size]).float()
+        nll += F.cross_entropy(logits.transpose(1, 2), labels[:, start:start + chunk_size],
+                               reduction="none").sum(1)
+    return nll
+
+
+def _trim_past_key_values(past_key_values, length):
+    # keep the kv of the last `length` tokens, copied since ipex-llm appends new kv
+    # in place from the start of the kv buffers
+    if isinstance(past_key_values, (tuple, list)):
+        return tuple((k[:, :, -length:].clone(), v[:, :, -length:].clone())
+                     for k, v in past_key_values)
+    for name in ["key_cache", "value_cache", "key_scale", "value_scale"]:
+        tensors = getattr(past_key_values, name, [])
+        for i, t in enumerate(tensors):
+            tensors[i] = t[:, :, -length:].clone()
+    if hasattr(past_key_values, "_seen_tokens"):
+        past_key_values._seen_tokens = length
+    else:
+        past_key_values.seen_tokens = length
+    return past_key_values
+
+
+@contextmanager
+def _rotary_length(model, length):
+    # rope embeddings are computed for `seq_len=kv_seq_len` and then indexed by position ids,
+    # the trimmed kv is shorter than the absolute positions of the new tokens, so let them
+    # cover `length` positions instead
+    def hook(module, args, kwargs):
+        if kwargs.get("seq_len", None) is not None:
+            kwargs["seq_len"] = max(kwargs["seq_len"], length)
+        return args, kwargs
+
+    handles = [module.register_forward_pre_hook(hook, with_kwargs=True)
+               for module in model.modules() if type(module).__name__.endswith("RotaryEmbedding")]
+    try:
+        yield
+    finally:
+        for handle in handles:
+            handle.remove()
+
+
+@torch.no_grad()
+def sliding_window_nll(model, input_ids, window, stride, loss_chunk_size=1024):
+    """
+    Negative log likelihood of equal-length sequences `input_ids` [batch_size, seq_len]
+    with strided sliding windows: the first window scores its `window` tokens, then each
+    step feeds `stride` new tokens on top of the kv cache of the last `window - stride`
+    tokens, so every token is scored once with at least `window - stride` tokens of context
+    and no token of the context is recomputed. The kept keys stay rotated at their absolute
+    positions, and the new tokens are fed at their absolute positions as well. The loss is
+    computed from the hidden states `loss_chunk_size` positions at a time.
+
+    Returns the nll sum of each sequence and the number of scored tokens.
+    """
+    base_model = getattr(model, model.base_model_prefix)
+    lm_head = model.get_output_embeddings()
+    device = next(model.parameters()).device
+    batch_size, seq_len = input_ids.shape
+    context_len = window - stride
+    nll = torch.zeros(batch_size, dtype=torch.float64)
+    count = 0
+    past_key_values = None
+    begin = 0
+    while begin < seq_len - 1:
+        end = min(begin + (window if past_key_values is None else stride), seq_len)
+        position_ids = torch.arange(begin, end, device=device).unsqueeze(0).expand(batch_size, -1)
+        with _rotary_length(base_model, end):
+            output = base_model(input_ids=input_ids[:, begin:end].to(device),
+                                position_ids=position_ids,
+                                past_key_values=past_key_values,
+                                use_cache=context_len > 0,
+                                return_dict=True)
+        # the last position of a segment predicts the first token of the next one
+        labels = input_ids[:, begin + 1:end + 1].to(device)
+        hidden_states = output.last_hidden_state[:, :labels.size(1)]
+        nll += _chunked_nll(hidden_states, lm_head, labels, loss_chunk_size).double().cpu()
+        count += labels.size(1)
+        if context_len > 0 and end < seq_len:
+            past_key_values = _trim_past_key_values(output.past_key_values, context_len)
+        del output, hidden_states
+        begin = end
+    return nll, count
+
 class BigDLPPL:
     def __init__(self, model_path, device, **model_kwargs) -> None:
         model_kwargs['trust_remote_code'] = model_kwargs.get('trust_remote_code', True)
@@ -38,43 +134,20 @@ class BigDLPPL:
         self.model.to(device)
 
 
-    def perplexity_hf(self, encoded_texts):
+    def perplexity_hf(self, encoded_texts, batch_size=1, window=None, stride=None,
+                      loss_chunk_size=1024):
+        """
+        Average perplexity of `encoded_texts`. For models in `SLIDING_WINDOW_MODEL_TYPES`,
+        equal-length sequences are evaluated `batch_size` at a time with `sliding_window_nll`,
+        `window` defaults to the whole sequence and `stride` defaults to half the window.
+        """
         self.model.eval()
-        loss_fct = CrossEntropyLoss(reduction="none")
-        ppls = []
-
         try:
-            pbar = tqdm(range(len(encoded_texts)))
-            for bid in pbar:
-                encoded_batch = encoded_texts[bid:bid+1]
-                if type(encoded_batch) == dict:
-                    attn_mask = encoded_batch['attention_mask'] if 'attention_mask' in encoded_batch.keys() else None
-                    encoded_batch = encoded_batch['input_ids']
-                elif type(encoded_batch) == list:
-                    encoded_batch = encoded_batch[0]
-                
-                encoded_batch = encoded_batch.to(self.device)
-                attn_mask = torch.ones_like(encoded_batch)
-
-                out_logits = self.model(encoded_batch).logits
-
-                labels = encoded_batch
-
-                shift_logits = out_logits[..., :-1, :].contiguous()
-                shift_labels = labels[..., 1:].contiguous()
-                shift_attention_mask_batch = attn_mask[..., 1:].contiguous()
-
-                loss_ = loss_fct(shift_logits.transpose(1, 2), shift_labels).float()
-                perplexity_batch = torch.exp2(
-                    (loss_ * shift_attention_mask_batch).sum(1)
-                    / shift_attention_mask_batch.sum(1)
-                )
-                ppls += perplexity_batch.tolist()
-
-                pbar.set_description(f"[{bid:<4}/{len(encoded_texts)}] avg_ppls: {np.mean(np.array(ppls)[~np.isnan(np.array(ppls))]):.4f}")
-                
-                del out_logits, encoded_batch, attn_mask, shift_logits, shift_labels, shift_attention_mask_batch, perplexity_batch
-
+            if self.model.config.model_type in SLIDING_WINDOW_MODEL_TYPES:
+                ppls = self._perplexity_sliding_window(encoded_texts, batch_size, window, stride,
+                                                       loss_chunk_size)
+            else:
+                ppls = self._perplexity_full_logits(encoded_texts)
             ppl_mean = np.mean(np.array(ppls)[~np.isnan(np.array(ppls))])
         finally:
             if self.device == "xpu":
@@ -82,5 +155,73 @@ class BigDLPPL:
                 torch.xpu.empty_cache()
             del self.model
             gc.collect()
-        
-        return ppl_mean
\ No newline at end of file
+
+        return ppl_mean
+
+    def _perplexity_sliding_window(self, encoded_texts, batch_size, window, stride,
+                                   loss_chunk_size):
+        texts = []
+        for encoded_text in encoded_texts:
+            if type(encoded_text) == dict:
+                encoded_text = encoded_text['input_ids']
+            texts.append(encoded_text.view(-1))
+        # only sequences of the same length are batched together
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batches = []
+        for i in order:
+            if batches and len(batches[-1]) < batch_size and \
+                    len(texts[batches[-1][0]]) == len(texts[i]):
+                batches[-1].append(i)
+            else:
+                batches.append([i])
+
+        ppls = []
+        pbar = tqdm(batches)
+        for batch in pbar:
+            input_ids = torch.stack([texts[i] for i in batch])
+            seq_window = min(window or input_ids.size(1), input_ids.size(1))
+            seq_stride = min(stride or max(seq_window // 2, 1), seq_window)
+            nll, count = sliding_window_nll(self.model, input_ids, seq_window, seq_stride,
+                                            loss_chunk_size)
+            # exp2 is kept to stay comparable with the results of `_perplexity_full_logits`
+            ppls += torch.exp2(nll / count).tolist()
+            pbar.set_description(f"[{len(ppls):<4}/{len(texts)}] avg_ppls: {np.mean(np.array(ppls)[~np.isnan(np.array(ppls))]):.4f}")
+            if self.device == "xpu":
+                torch.xpu.empty_cache()
+        return ppls
+
+    def _perplexity_full_logits(self, encoded_texts):
+        loss_fct = CrossEntropyLoss(reduction="none")
+        ppls = []
+        pbar = tqdm(range(len(encoded_texts)))
+        for bid in pbar:
+            encoded_batch = encoded_texts[bid:bid+1]
+            if type(encoded_batch) == dict:
+                attn_mask = encoded_batch['attention_mask'] if 'attention_mask' in encoded_batch.keys() else None
+                encoded_batch = encoded_batch['input_ids']
+            elif type(encoded_batch) == list:
+                encoded_batch = encoded_batch[0]
+            
+            encoded_batch = encoded_batch.to(self.device)
+            attn_mask = torch.ones_like(encoded_batch)
+
+            out_logits = self.model(encoded_batch).logits
+
+            labels = encoded_batch
+
+            shift_logits = out_logits[..., :-1, :].contiguous()
+            shift_labels = labels[..., 1:].contiguous()
+            shift_attention_mask_batch = attn_mask[..., 1:].contiguous()
+
+            loss_ = loss_fct(shift_logits.transpose(1, 2), shift_labels).float()
+            perplexity_batch = torch.exp2(
+                (loss_ * shift_attention_mask_batch).sum(1)
+                / shift_attention_mask_batch.sum(1)
+            )
+            ppls += perplexity_batch.tolist()
+
+            pbar.set_description(f"[{bid:<4}/{len(encoded_texts)}] avg_ppls: {np.mean(np.array(ppls)[~np.isnan(np.array(ppls))]):.4f}")
+            
+            del out_logits, encoded_batch, attn_mask, shift_logits, shift_labels, shift_attention_mask_batch, perplexity_batch
+
+        return ppls
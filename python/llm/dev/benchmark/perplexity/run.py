@@ -39,6 +39,13 @@ def get_arguments():
     parser.add_argument("--precisions", required=False, type=str, default=None, nargs='+')
     parser.add_argument("--device", type=str, default="xpu")
     parser.add_argument("--output_path", default=None)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--window", type=int, default=None,
+                        help="sliding window length, default to the whole sequence")
+    parser.add_argument("--stride", type=int, default=None,
+                        help="new tokens of each sliding window step, default to half the window")
+    parser.add_argument("--loss_chunk_size", type=int, default=1024,
+                        help="number of positions whose logits are computed at a time")
     return parser.parse_args()
     
 
@@ -96,10 +103,12 @@ def main():
         os.makedirs(log_dir, exist_ok=True)
         results = {}
         ppl_evaluator = BigDLPPL(model_path=args.model_path, device=args.device, **model_kwargs)
-        ppl = ppl_evaluator.perplexity_hf(encoded_texts)
+        ppl = ppl_evaluator.perplexity_hf(encoded_texts, batch_size=args.batch_size, window=args.window,
+                                          stride=args.stride, loss_chunk_size=args.loss_chunk_size)
         summary[precision] = ppl
         results['results'] = ppl
-        results['config'] = {"model": model_name, "precision": precision, "device": args.device, "seq_len": args.seq_len, "language": args.language}
+        results['config'] = {"model": model_name, "precision": precision, "device": args.device, "seq_len": args.seq_len, "language": args.language,
+                             "batch_size": args.batch_size, "window": args.window, "stride": args.stride}
         dumped = json.dumps(results, indent=2)
         print(dumped)
 
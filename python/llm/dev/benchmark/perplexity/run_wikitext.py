@@ -18,6 +18,7 @@
 #
 
 import argparse
+import sys
 import torch
 from tqdm import tqdm
 
@@ -30,6 +31,10 @@ parser.add_argument("--stride", type=int, default=0)
 parser.add_argument("--device", type=str, default="xpu")
 parser.add_argument("--precision", type=str, default="sym_int4")
 parser.add_argument("--use-cache", action="store_true")
+parser.add_argument("--batch_size", type=int, default=0,
+                    help="evaluate batch_size shards of the dataset in parallel with the sliding-window "
+                         "engine of ppl.py, with chunk_size as the window length")
+parser.add_argument("--loss_chunk_size", type=int, default=1024)
 args = parser.parse_args()
 
 if args.precision == "fp16":  # ipex fp16
@@ -53,6 +58,18 @@ from transformers import AutoTokenizer
 tokenizer = AutoTokenizer.from_pretrained(args.model_path, trust_remote_code=True)
 encodings = tokenizer(data.decode("utf-8").strip("\n"), return_tensors="pt")
 
+if args.batch_size > 0:
+    from ppl import sliding_window_nll
+    # split the token stream into batch_size shards of the same length
+    shard_len = encodings.input_ids.size(1) // args.batch_size
+    input_ids = encodings.input_ids[0, :shard_len * args.batch_size].view(args.batch_size, shard_len)
+    window = min(args.chunk_size, shard_len)
+    stride = args.stride if 0 < args.stride <= window else max(window // 2, 1)
+    nll, count = sliding_window_nll(model, input_ids, window, stride, args.loss_chunk_size)
+    ppl = torch.exp(nll.sum() / (count * args.batch_size))
+    print("Final ppl estimate: {}".format(ppl.item()))
+    sys.exit(0)
+
 max_length = model.config.max_position_embeddings
 stride = args.chunk_size if args.stride <= 0 else args.stride
 seq_len = encodings.input_ids.size(1)
@@ -0,0 +1,93 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Microbenchmark of the CPU prefill of one rwkv5 linear attention layer, comparing the
+# chunked implementation with the previous per-token loop.
+
+import argparse
+import time
+
+import torch
+
+from ipex_llm.transformers.models import rwkv5
+
+
+def rwkv5_loop(B, H, S, T, n_head, time_decay, time_first, receptance, key, value, state):
+    """The previous per-token loop of rwkv5 `rwkv_linear_attention_cpu`, kept as the baseline."""
+    key = key.to(torch.float32).view(B, T, H, S).transpose(1, 2).transpose(-2, -1)
+    value = value.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+    receptance = receptance.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+    time_decay = torch.exp(-torch.exp(time_decay.float())).reshape(n_head, -1, 1)
+    time_first = time_first.float().reshape(n_head, -1, 1)
+    out = torch.zeros_like(key).reshape(B, T, H, S)
+    for t in range(T):
+        rt = receptance[:, :, t:t + 1, :]
+        kt = key[:, :, :, t:t + 1]
+        vt = value[:, :, t:t + 1, :]
+        at = kt @ vt
+        out[:, t] = (rt @ (time_first * at + state)).squeeze(2)
+        state = at + time_decay * state
+    return out, state
+
+
+def bench(fn, warm_up, num_trials):
+    for _ in range(warm_up):
+        result = fn()
+    st = time.perf_counter()
+    for _ in range(num_trials):
+        result = fn()
+    return (time.perf_counter() - st) / num_trials, result
+
+
+def bench_rwkv5(args, T):
+    H, S = args.hidden_size // args.head_size, args.head_size
+    time_decay = torch.randn(H, S)
+    time_first = torch.randn(H, S)
+    receptance, key, value = (torch.randn(args.batch_size, T, H * S) for _ in range(3))
+    state = torch.zeros(args.batch_size, H, S, S)
+
+    loop_time, (loop_out, _) = bench(
+        lambda: rwkv5_loop(args.batch_size, H, S, T, H, time_decay, time_first,
+                           receptance, key, value, state),
+        args.warm_up, args.num_trials)
+    chunk_time, (chunk_out, _) = bench(
+        lambda: rwkv5.rwkv_linear_attention_chunked(args.batch_size, H, S, T, H, time_decay,
+                                                    time_first, receptance, key, value, state,
+                                                    chunk_size=args.chunk_size),
+        args.warm_up, args.num_trials)
+    return loop_time, chunk_time, (loop_out - chunk_out).abs().max().item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark rwkv5 prefill on CPU')
+    parser.add_argument('--seq-lens', type=int, nargs='+', default=[256, 1024, 4096],
+                        help='Prompt lengths to benchmark with')
+    parser.add_argument('--hidden-size', type=int, default=2048)
+    parser.add_argument('--head-size', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--chunk-size', type=int, default=rwkv5.RWKV_CHUNK_SIZE)
+    parser.add_argument('--warm-up', type=int, default=1)
+    parser.add_argument('--num-trials', type=int, default=3)
+    args = parser.parse_args()
+
+    torch.manual_seed(42)
+    print(f"{'seq_len':>10} {'loop(ms)':>12} {'chunked(ms)':>12} {'speedup':>10} "
+          f"{'max_diff':>10}")
+    with torch.inference_mode():
+        for seq_len in args.seq_lens:
+            loop_time, chunk_time, max_diff = bench_rwkv5(args, seq_len)
+            print(f"{seq_len:>10} {loop_time * 1e3:>12.1f} {chunk_time * 1e3:>12.1f} "
+                  f"{loop_time / chunk_time:>9.1f}x {max_diff:>10.2e}")
@@ -0,0 +1,23 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+export MASTER_ADDR=127.0.0.1
+export MASTER_PORT=9090
+# each stage is bound to the cores and memory of one NUMA node
+NUM_STAGES=$(ls -d /sys/devices/system/node/node[0-9]* | wc -l)
+
+torchrun --standalone --nnodes=1 --nproc-per-node $NUM_STAGES \
+    generate.py --repo-id-or-model-path 'meta-llama/Llama-2-13b-chat-hf' --num-stages $NUM_STAGES --low-bit 'sym_int4'
@@ -51,6 +51,7 @@ import sys
 import uuid
 import time
 import math
+import pickle
 import multiprocessing
 from typing import List, Optional, Union, Generator, Sequence, Iterator, Deque, Tuple
 from collections import deque, OrderedDict
@@ -60,38 +61,149 @@ from . import llama_cpp
 from .llama_types import *
 
 
+class _TokenTrieNode:
+    __slots__ = ("edge", "parent", "children", "key", "n_keys")
+
+    def __init__(self, edge: Tuple[int, ...], parent: Optional["_TokenTrieNode"]):
+        self.edge = edge
+        self.parent = parent
+        self.children = {}
+        # the full key if a state is stored at this node
+        self.key = None
+        # number of stored keys in this subtree
+        self.n_keys = 0
+
+
+class _TokenTrie:
+    """Radix tree over token sequences, used to find the key sharing the longest prefix."""
+
+    def __init__(self):
+        self.root = _TokenTrieNode((), None)
+
+    def _walk(self, key: Tuple[int, ...]):
+        """Return the deepest node on the path of `key` and the length of the match."""
+        node = self.root
+        depth = 0
+        while depth < len(key) and key[depth] in node.children:
+            child = node.children[key[depth]]
+            n = 0
+            for token in child.edge:
+                if depth + n >= len(key) or key[depth + n] != token:
+                    break
+                n += 1
+            depth += n
+            node = child
+            if n < len(child.edge):
+                break
+        return node, depth
+
+    def insert(self, key: Tuple[int, ...]) -> bool:
+        """Insert `key`, return False if it is already present."""
+        node = self.root
+        depth = 0
+        while depth < len(key):
+            child = node.children.get(key[depth])
+            if child is None:
+                child = _TokenTrieNode(key[depth:], node)
+                node.children[key[depth]] = child
+                node = child
+                depth = len(key)
+                break
+            n = 0
+            for token in child.edge:
+                if depth + n >= len(key) or key[depth + n] != token:
+                    break
+                n += 1
+            if n < len(child.edge):
+                # split the edge of child after n tokens
+                upper = _TokenTrieNode(child.edge[:n], node)
+                upper.n_keys = child.n_keys
+                node.children[key[depth]] = upper
+                child.edge = child.edge[n:]
+                child.parent = upper
+                upper.children[child.edge[0]] = child
+                child = upper
+            node = child
+            depth += n
+        if node.key is not None:
+            return False
+        node.key = key
+        while node is not None:
+            node.n_keys += 1
+            node = node.parent
+        return True
+
+    def remove(self, key: Tuple[int, ...]):
+        node, depth = self._walk(key)
+        if depth != len(key) or node.key != key:
+            return
+        node.key = None
+        while node is not None:
+            node.n_keys -= 1
+            parent = node.parent
+            if node.n_keys == 0 and parent is not None:
+                del parent.children[node.edge[0]]
+            node = parent
+
+    def longest_prefix_key(self, key: Tuple[int, ...]) -> Optional[Tuple[int, ...]]:
+        """Return a stored key sharing the longest common prefix with `key`."""
+        node, depth = self._walk(key)
+        if depth == 0:
+            return None
+        # every stored key below `node` shares `depth` tokens with `key`
+        while node.key is None:
+            node = next(c for c in node.children.values() if c.n_keys > 0)
+        return node.key
+
+
 class LlamaCache:
-    """Cache for a llama.cpp model."""
+    """
+    Cache for a llama.cpp model.
 
-    def __init__(self, capacity_bytes: int = (2 << 30)):
+    Keys are indexed by a token trie, so looking up the key sharing the longest prefix
+    costs O(prefix length) instead of a scan over every cached key. States evicted from
+    memory are spilled to `disk_cache_dir` if it is set and loaded back on a hit.
+    """
+
+    def __init__(self, capacity_bytes: int = (2 << 30),
+                 disk_cache_dir: Optional[str] = None,
+                 disk_capacity_bytes: int = (8 << 30)):
         self.cache_state: OrderedDict[Tuple[int, ...], "LlamaState"] = OrderedDict()
         self.capacity_bytes = capacity_bytes
+        self.disk_cache_dir = disk_cache_dir
+        self.disk_capacity_bytes = disk_capacity_bytes
+        # key -> (path, size) of states spilled to disk, in LRU order
+        self.disk_state: OrderedDict[Tuple[int, ...], Tuple[str, int]] = OrderedDict()
+        self.trie = _TokenTrie()
+        self._cache_size = 0
+        self._disk_cache_size = 0
+        if disk_cache_dir is not None:
+            os.makedirs(disk_cache_dir, exist_ok=True)
 
     @property
     def cache_size(self):
-        return sum([state.llama_state_size for state in self.cache_state.values()])
+        return self._cache_size
+
+    @property
+    def disk_cache_size(self):
+        return self._disk_cache_size
 
     def _find_longest_prefix_key(
         self,
         key: Tuple[int, ...],
     ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key = None
-        keys = (
-            (k, Llama.longest_token_prefix(k, key)) for k in self.cache_state.keys()
-        )
-        for k, prefix_len in keys:
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k
-        return min_key
+        return self.trie.longest_prefix_key(key)
 
     def __getitem__(self, key: Sequence[int]) -> "LlamaState":
         key = tuple(key)
         _key = self._find_longest_prefix_key(key)
         invalidInputError(_key is not None, "Key not found.")
-        value = self.cache_state[_key]
-        self.cache_state.move_to_end(_key)
+        if _key in self.disk_state:
+            value = self._load_from_disk(_key)
+            self._add_to_memory(_key, value)
+        else:
+            value = self.cache_state[_key]
+            self.cache_state.move_to_end(_key)
         return value
 
     def __contains__(self, key: Sequence[int]) -> bool:
@@ -100,10 +212,60 @@ class LlamaCache:
     def __setitem__(self, key: Sequence[int], value: "LlamaState"):
         key = tuple(key)
         if key in self.cache_state:
-            del self.cache_state[key]
+            self._cache_size -= self.cache_state.pop(key).llama_state_size
+        elif key in self.disk_state:
+            self._remove_from_disk(key)
+        else:
+            self.trie.insert(key)
+        self._add_to_memory(key, value)
+
+    def _add_to_memory(self, key: Tuple[int, ...], value: "LlamaState"):
         self.cache_state[key] = value
-        while self.cache_size > self.capacity_bytes:
-            self.cache_state.popitem(last=False)
+        self._cache_size += value.llama_state_size
+        while self._cache_size > self.capacity_bytes:
+            evicted_key, evicted = self.cache_state.popitem(last=False)
+            self._cache_size -= evicted.llama_state_size
+            if self.disk_cache_dir is not None:
+                self._save_to_disk(evicted_key, evicted)
+            else:
+                self.trie.remove(evicted_key)
+
+    def _save_to_disk(self, key: Tuple[int, ...], value: "LlamaState"):
+        path = os.path.join(self.disk_cache_dir, f"{uuid.uuid4().hex}.state")
+        with open(path, "wb") as f:
+            pickle.dump({
+                "eval_tokens": list(value.eval_tokens),
+                "eval_logits": list(value.eval_logits),
+                "eval_tokens_maxlen": value.eval_tokens.maxlen,
+                "eval_logits_maxlen": value.eval_logits.maxlen,
+                "llama_state": bytes(value.llama_state),
+                "llama_state_size": value.llama_state_size,
+            }, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.disk_state[key] = (path, value.llama_state_size)
+        self._disk_cache_size += value.llama_state_size
+        while self._disk_cache_size > self.disk_capacity_bytes:
+            evicted_key = next(iter(self.disk_state))
+            self._remove_from_disk(evicted_key)
+            self.trie.remove(evicted_key)
+
+    def _load_from_disk(self, key: Tuple[int, ...]) -> "LlamaState":
+        path, _ = self.disk_state[key]
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        self._remove_from_disk(key)
+        llama_state = data["llama_state"]
+        return LlamaState(
+            eval_tokens=deque(data["eval_tokens"], maxlen=data["eval_tokens_maxlen"]),
+            eval_logits=deque(data["eval_logits"], maxlen=data["eval_logits_maxlen"]),
+            llama_state=(llama_cpp.c_uint8 * len(llama_state)).from_buffer_copy(llama_state),
+            llama_state_size=data["llama_state_size"],
+        )
+
+    def _remove_from_disk(self, key: Tuple[int, ...]):
+        path, size = self.disk_state.pop(key)
+        self._disk_cache_size -= size
+        if os.path.exists(path):
+            os.remove(path)
 
 
 class LlamaState:
@@ -712,7 +874,7 @@ class Llama(GenerationMixin):
                               "logprobs is not supported for models created with logits_all=False")
 
         if self.cache:
-            try:
+            if prompt_tokens in self.cache:
                 cache_item = self.cache[prompt_tokens]
                 cache_prefix_len = Llama.longest_token_prefix(
                     cache_item.eval_tokens, prompt_tokens
@@ -724,7 +886,7 @@ class Llama(GenerationMixin):
                     self.load_state(cache_item)
                     if self.verbose:
                         print("Llama._create_completion: cache hit", file=sys.stderr)
-            except KeyError:
+            else:
                 if self.verbose:
                     print("Llama._create_completion: cache miss", file=sys.stderr)
 
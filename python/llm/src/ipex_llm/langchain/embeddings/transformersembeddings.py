@@ -78,6 +78,8 @@ class TransformersEmbeddings(BaseModel, Embeddings):
     """Keyword arguments to pass to the model."""
     encode_kwargs: Dict[str, Any] = Field(default_factory=dict)
     """Keyword arguments to pass when calling the `encode` method of the model."""
+    batch_size: int = 32
+    """Max number of texts in one forward pass of `embed_documents`."""
 
     @classmethod
     def from_model_id(
@@ -157,6 +159,49 @@ class TransformersEmbeddings(BaseModel, Embeddings):
         embeddings = np.mean(embeddings, axis=0)
         return embeddings
 
+    def pool(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor):
+        """Mean pooling of the hidden states of non-padding tokens."""
+        mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+        return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+    @torch.inference_mode()
+    def embed_batch(self, texts: List[str], **kwargs):
+        """Compute doc embeddings of texts in batches of `batch_size`.
+
+        Texts are sorted by token length so that each batch pads as little as possible,
+        tokenized once and run with one forward pass per batch.
+
+        Args:
+            texts: The list of texts to embed.
+
+        Returns:
+            List of embeddings, one for each text, in the order of `texts`.
+        """
+        all_input_ids = self.tokenizer(texts, **kwargs)["input_ids"]
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = 0
+        order = sorted(range(len(texts)), key=lambda idx: len(all_input_ids[idx]))
+        batch_size = max(1, self.batch_size)
+        embeddings = [None] * len(texts)
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start + batch_size]
+            max_len = max(len(all_input_ids[idx]) for idx in indices)
+            input_ids = torch.full((len(indices), max_len), pad_token_id, dtype=torch.long)
+            attention_mask = torch.zeros((len(indices), max_len), dtype=torch.long)
+            for i, idx in enumerate(indices):
+                seq_len = len(all_input_ids[idx])
+                input_ids[i, :seq_len] = torch.tensor(all_input_ids[idx], dtype=torch.long)
+                attention_mask[i, :seq_len] = 1
+            input_ids = input_ids.to(self.model.device)
+            attention_mask = attention_mask.to(self.model.device)
+            hidden_states = self.model(input_ids, attention_mask=attention_mask,
+                                       return_dict=False)[0]
+            batch_embeddings = self.pool(hidden_states, attention_mask).float().cpu()
+            for i, idx in enumerate(indices):
+                embeddings[idx] = batch_embeddings[i].numpy()
+        return embeddings
+
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Compute doc embeddings using a HuggingFace transformer model.
 
@@ -167,8 +212,8 @@ class TransformersEmbeddings(BaseModel, Embeddings):
             List of embeddings, one for each text.
         """
         texts = list(map(lambda x: x.replace("\n", " "), texts))
-        embeddings = [self.embed(text, **self.encode_kwargs).tolist() for text in texts]
-        return embeddings
+        embeddings = self.embed_batch(texts, **self.encode_kwargs)
+        return [embedding.tolist() for embedding in embeddings]
 
     def embed_query(self, text: str) -> List[float]:
         """Compute query embeddings using a bigdl-llm transformer model.
@@ -193,3 +238,7 @@ class TransformersBgeEmbeddings(TransformersEmbeddings):
         embeddings = self.model(input_ids, return_dict=False)[0].cpu()
         embeddings = torch.nn.functional.normalize(embeddings[:, 0], p=2, dim=1)
         return embeddings[0]
+
+    def pool(self, hidden_states: torch.Tensor, attention_mask: torch.Tensor):
+        """Normalized hidden state of the first ([CLS]) token, texts are right padded."""
+        return torch.nn.functional.normalize(hidden_states[:, 0], p=2, dim=1)
@@ -24,7 +24,8 @@ from accelerate import init_empty_weights
 from accelerate.utils import set_module_tensor_to_device
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
 from ipex_llm.utils.common import invalidInputError
-from ipex_llm.transformers.utils import extract_local_archive_file, get_local_shard_files
+from ipex_llm.transformers.utils import extract_local_archive_file, get_local_shard_files, \
+    load_state_dicts
 import transformers
 import warnings
 from transformers import PreTrainedModel
@@ -47,7 +48,7 @@ def _save_low_bit(self, save_dir, *args, **kwargs):
     if isinstance(self, PreTrainedModel):
         # We borrowed this method to adapt to Transformer model cases
         # as much as possible, and later we may merge these two situations
-        kwargs['safe_serialization'] = False
+        kwargs.setdefault('safe_serialization', True)
         self.save_pretrained(save_dir, *args, **kwargs)
     else:
         # TODO: For the lowbit model still larger than 8GB,
@@ -185,10 +186,15 @@ def load_low_bit(model, model_path):
                                   resolved_archive_file,
                                   subfolder="")
     else:
-        resolved_archive_file = [os.path.join(model_path, PYTORCH_MODEL_NAME)]
+        resolved_archive_file = [resolved_archive_file]
 
-    for model_file in resolved_archive_file:
-        state_dict = torch.load(model_file)
+    if all(f.endswith(".safetensors") for f in resolved_archive_file):
+        # safetensors shards are mmap-ed in parallel and loaded as zero-copy views
+        state_dicts = load_state_dicts(resolved_archive_file)
+    else:
+        state_dicts = (torch.load(f) for f in resolved_archive_file)
+
+    for state_dict in state_dicts:
         for param_name, param in state_dict.items():
             set_module_tensor_to_device(model, param_name, "cpu", param)
     return model
@@ -0,0 +1,396 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+An in-process continuous batching engine used by the BigDL-LLM FastChat worker.
+
+The engine holds a running batch of sequences sharing one left-padded kv cache, stored
+in preallocated buffers with a row per sequence that grow geometrically, so a decode step
+only writes the kv of the new tokens. Between two decode steps, it prefills newly arrived
+requests in chunks and copies their prompt kv into free rows, and sequences that are
+finished or cancelled are evicted right after the step that finished them, their rows
+being reused by later requests.
+"""
+
+import inspect
+import logging
+import queue
+import threading
+from typing import List, Optional
+
+import torch
+from transformers import LogitsProcessorList
+from transformers.generation.logits_process import (
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from ipex_llm.utils.common import invalidInputError
+
+logger = logging.getLogger(__name__)
+
+KV_CACHE_NAMES = ["key_cache", "value_cache", "key_scale", "value_scale"]
+KV_ALLOC_BLOCK_LENGTH = 256
+
+
+class Sequence:
+    """A request running in `ContinuousBatchingEngine`, tokens are sent to its streamer."""
+
+    def __init__(self, input_ids: torch.Tensor, streamer, max_new_tokens: int,
+                 stop_token_ids: List[int], do_sample: bool = False, temperature: float = 1.0,
+                 top_p: float = 1.0, top_k: int = 0, repetition_penalty: float = 1.0):
+        self.input_ids = input_ids.view(1, -1).cpu()
+        self.token_ids = self.input_ids[0].tolist()
+        self.streamer = streamer
+        self.max_new_tokens = max_new_tokens
+        self.stop_token_ids = set(stop_token_ids)
+        self.num_generated = 0
+        self.finished = False
+        self.cancelled = False
+
+        self.do_sample = do_sample and temperature > 1e-5
+        self.logits_processor = LogitsProcessorList()
+        if repetition_penalty != 1.0:
+            self.logits_processor.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+        if self.do_sample:
+            if temperature != 1.0:
+                self.logits_processor.append(TemperatureLogitsWarper(temperature))
+            if top_k > 0:
+                self.logits_processor.append(TopKLogitsWarper(top_k))
+            if top_p < 1.0:
+                self.logits_processor.append(TopPLogitsWarper(top_p))
+
+    def cancel(self):
+        """Stop generating tokens for this request, e.g. when a stop string is met."""
+        self.cancelled = True
+
+    def sample(self, logits: torch.Tensor) -> int:
+        # logits: [vocab_size]
+        scores = logits.float().unsqueeze(0)
+        if len(self.logits_processor) > 0:
+            scores = self.logits_processor(torch.tensor([self.token_ids]), scores)
+        if self.do_sample:
+            probs = scores.softmax(dim=-1)
+            return torch.multinomial(probs, num_samples=1).item()
+        return torch.argmax(scores, dim=-1).item()
+
+    def append(self, token_id: int):
+        self.token_ids.append(token_id)
+        self.num_generated += 1
+        self.streamer.put(torch.tensor([token_id]))
+        if token_id in self.stop_token_ids or self.num_generated >= self.max_new_tokens:
+            self.finish()
+
+    def finish(self):
+        if not self.finished:
+            self.finished = True
+            self.streamer.end()
+
+
+def _cache_tensors(past_key_values):
+    """
+    Per-layer kv tensors of a legacy tuple or `DynamicCache` kv cache, indexed by entry
+    (key, value, ...) then layer, all are [batch_size, num_heads, seq_len, ...].
+    """
+    if isinstance(past_key_values, (tuple, list)):
+        return [list(tensors) for tensors in zip(*past_key_values)]
+    return [getattr(past_key_values, name) for name in KV_CACHE_NAMES
+            if hasattr(past_key_values, name)]
+
+
+def _make_cache(cache_cls, tensors):
+    """Build a kv cache of `cache_cls` (None for legacy tuples) from `_cache_tensors`."""
+    if cache_cls is None:
+        return tuple(zip(*tensors))
+    past_key_values = cache_cls()
+    names = [name for name in KV_CACHE_NAMES if hasattr(past_key_values, name)]
+    for name, layers in zip(names, tensors):
+        setattr(past_key_values, name, list(layers))
+    seq_len = tensors[0][0].size(2)
+    if hasattr(past_key_values, "_seen_tokens"):
+        past_key_values._seen_tokens = seq_len
+    else:
+        past_key_values.seen_tokens = seq_len
+    return past_key_values
+
+
+def _check_cache(past_key_values):
+    if isinstance(past_key_values, (tuple, list)):
+        return
+    from transformers.cache_utils import DynamicCache
+    from ipex_llm.transformers.kv import (
+        DynamicFp8Cache, DynamicNormalCache, DynamicQuantizedCache
+    )
+    # e.g. `DynamicPagedCache` owns pool buffers and `DynamicSinkCache` a ring buffer,
+    # their tensors cannot be moved between batches
+    invalidInputError(
+        type(past_key_values) in (DynamicCache, DynamicNormalCache,
+                                  DynamicFp8Cache, DynamicQuantizedCache),
+        f"Continuous batching does not support {type(past_key_values).__name__}, "
+        f"unset IPEX_LLM_PAGED_KV_CACHE or use a model with a plain kv cache."
+    )
+
+
+class ContinuousBatchingEngine:
+    """
+    Iteration-level batching of `model` forward for concurrent generation requests.
+
+    :param model: a causal lm whose kv cache is [batch_size, num_heads, seq_len, head_dim]
+        for every layer, either legacy tuples or a `DynamicCache`, `DynamicNormalCache`,
+        `DynamicFp8Cache` or `DynamicQuantizedCache`. Other caches such as
+        `DynamicPagedCache` are refused.
+    :param max_num_seqs: the maximum number of sequences in the running batch.
+    :param prefill_chunk_size: the maximum number of prompt tokens prefilled between two
+        decode steps, longer prompts are prefilled in several chunks.
+    """
+
+    def __init__(self, model, max_num_seqs: int = 16, prefill_chunk_size: int = 512):
+        self.model = model
+        self.max_num_seqs = max(1, max_num_seqs)
+        self.prefill_chunk_size = max(1, prefill_chunk_size)
+        self.device = model.device
+        self.support_position_ids = \
+            "position_ids" in inspect.signature(model.forward).parameters
+        eos_token_id = getattr(model.generation_config, "eos_token_id", None)
+        if eos_token_id is None:
+            self.eos_token_ids = []
+        else:
+            self.eos_token_ids = [eos_token_id] if isinstance(eos_token_id, int) \
+                else list(eos_token_id)
+        self.waiting = queue.Queue()
+        self.reset()
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def reset(self):
+        # running batch, sequence i uses row i of the kv buffers
+        self.sequences: List[Sequence] = []
+        # sequence being prefilled, with the kv cache of its prefilled prompt tokens
+        self.prefilling: Optional[Sequence] = None
+        self.prefill_cache = None
+        self.prefill_length = 0
+
+        # kv buffers indexed by entry then layer, [max_num_seqs, num_heads, capacity, ...],
+        # the running kv is left padded in positions [0, length) of the first rows
+        self.cache_cls = None
+        self.buffers = None
+        self.mask_buffer = None
+        self.length = 0
+
+    @property
+    def capacity(self):
+        return 0 if self.mask_buffer is None else self.mask_buffer.size(1)
+
+    def submit(self, input_ids: torch.Tensor, streamer, max_new_tokens: int,
+               stop_token_ids: List[int], **sampling_kwargs) -> Sequence:
+        """
+        Add a request to the engine, generated tokens are put into `streamer` like
+        ``model.generate(input_ids, streamer=streamer, ...)`` does.
+        """
+        seq = Sequence(input_ids, streamer, max_new_tokens,
+                       list(stop_token_ids) + self.eos_token_ids, **sampling_kwargs)
+        # prompt is the first `put` of `generate`, skipped by `skip_prompt=True` streamers
+        streamer.put(seq.input_ids)
+        if max_new_tokens <= 0:
+            seq.finish()
+        else:
+            self.waiting.put(seq)
+        return seq
+
+    def run(self):
+        while True:
+            try:
+                self.step()
+            except Exception as e:
+                logger.exception(f"continuous batching step failed: {e}")
+                for seq in self.sequences:
+                    seq.finish()
+                if self.prefilling is not None:
+                    self.prefilling.finish()
+                self.reset()
+
+    @torch.inference_mode()
+    def step(self):
+        # prefill new requests between decode steps, at most `prefill_chunk_size` tokens
+        # per step, block when there is nothing to run
+        budget = self.prefill_chunk_size
+        while budget > 0:
+            if self.prefilling is None:
+                if len(self.sequences) >= self.max_num_seqs:
+                    break
+                try:
+                    seq = self.waiting.get(block=len(self.sequences) == 0)
+                except queue.Empty:
+                    break
+                if seq.cancelled:
+                    seq.finish()
+                    continue
+                self.prefilling = seq
+                self.prefill_cache = None
+                self.prefill_length = 0
+            budget -= self.prefill(budget)
+
+        if len(self.sequences) > 0:
+            self.decode()
+            self.evict()
+
+    def prefill(self, max_tokens: int) -> int:
+        """Prefill the next chunk of `self.prefilling`, return the number of tokens."""
+        seq = self.prefilling
+        if seq.cancelled:
+            seq.finish()
+            self.prefilling = None
+            self.prefill_cache = None
+            return 0
+
+        start = self.prefill_length
+        end = min(seq.input_ids.size(1), start + max_tokens)
+        try:
+            output = self.model(input_ids=seq.input_ids[:, start:end].to(self.device),
+                                past_key_values=self.prefill_cache,
+                                use_cache=True,
+                                return_dict=True)
+            _check_cache(output.past_key_values)
+            self.prefill_cache = output.past_key_values
+            self.prefill_length = end
+            if end == seq.input_ids.size(1):
+                self.admit(seq, output.past_key_values)
+                self.prefilling = None
+                self.prefill_cache = None
+                seq.append(seq.sample(output.logits[0, -1]))
+        except Exception:
+            seq.finish()
+            self.prefilling = None
+            self.prefill_cache = None
+            raise
+        self.evict()
+        return end - start
+
+    def admit(self, seq: Sequence, past_key_values):
+        """Copy the prompt kv of `seq` into the first free row of the kv buffers."""
+        tensors = _cache_tensors(past_key_values)
+        prompt_len = tensors[0][0].size(2)
+        if self.buffers is None:
+            self.cache_cls = None if isinstance(past_key_values, (tuple, list)) \
+                else type(past_key_values)
+            self.buffers = [[t.new_zeros((self.max_num_seqs, t.size(1), 0) + t.shape[3:])
+                             for t in layers] for layers in tensors]
+            self.mask_buffer = torch.zeros((self.max_num_seqs, 0), dtype=torch.long,
+                                           device=self.device)
+        if prompt_len > self.length or self.length >= self.capacity:
+            # leave room for the next decode step as well
+            self._move(prompt_len, max(self.length, prompt_len) + 1)
+
+        row = len(self.sequences)
+        start = self.length - prompt_len
+        for buffers, layers in zip(self.buffers, tensors):
+            for buffer, t in zip(buffers, layers):
+                buffer[row, :, start:self.length] = t[0]
+        self.mask_buffer[row, :start] = 0
+        self.mask_buffer[row, start:self.length] = 1
+        self.sequences.append(seq)
+
+    def _move(self, min_length: int, capacity: int):
+        """
+        Move the running kv to end at max(`min_length`, its length without shared left
+        padding), in buffers of at least `capacity` tokens. Buffers grow geometrically,
+        so decode steps only write the new token in place.
+        """
+        num_seqs = len(self.sequences)
+        start = self.length
+        if num_seqs > 0:
+            start = int(self.mask_buffer[:num_seqs, :self.length].any(dim=0).nonzero()[0])
+        length = max(min_length, self.length - start)
+        if capacity > self.capacity:
+            capacity = max(capacity + KV_ALLOC_BLOCK_LENGTH, 2 * self.capacity)
+        elif num_seqs == 0:
+            self.length = length
+            return
+        else:
+            capacity = self.capacity
+
+        offset = length - (self.length - start)
+        for buffers in self.buffers:
+            for i, buffer in enumerate(buffers):
+                new_buffer = buffer.new_zeros(buffer.shape[:2] + (capacity,) + buffer.shape[3:])
+                new_buffer[:num_seqs, :, offset:length] = buffer[:num_seqs, :, start:self.length]
+                buffers[i] = new_buffer
+        mask_buffer = self.mask_buffer.new_zeros((self.max_num_seqs, capacity))
+        mask_buffer[:num_seqs, offset:length] = self.mask_buffer[:num_seqs, start:self.length]
+        self.mask_buffer = mask_buffer
+        self.length = length
+
+    def decode(self):
+        num_seqs = len(self.sequences)
+        if self.length >= self.capacity:
+            self._move(0, self.length + 1)
+        input_ids = torch.tensor([[seq.token_ids[-1]] for seq in self.sequences],
+                                 dtype=torch.long, device=self.device)
+        self.mask_buffer[:num_seqs, self.length] = 1
+        attention_mask = self.mask_buffer[:num_seqs, :self.length + 1]
+        # views of the kv buffers, `DynamicNormalCache` and the like append in place
+        past_key_values = _make_cache(self.cache_cls, [
+            [buffer[:num_seqs, :, :self.length] for buffer in buffers]
+            for buffers in self.buffers
+        ])
+        kwargs = {}
+        if self.support_position_ids:
+            kwargs["position_ids"] = attention_mask.sum(dim=-1, keepdim=True) - 1
+        output = self.model(input_ids=input_ids,
+                            attention_mask=attention_mask,
+                            past_key_values=past_key_values,
+                            use_cache=True,
+                            return_dict=True,
+                            **kwargs)
+        # other caches (e.g. legacy tuples) return new tensors, copy back the new token
+        for buffers, layers in zip(self.buffers, _cache_tensors(output.past_key_values)):
+            for buffer, t in zip(buffers, layers):
+                if t.data_ptr() != buffer.data_ptr():
+                    buffer[:num_seqs, :, self.length] = t[:, :, -1]
+        self.length += 1
+
+        logits = output.logits[:, -1]
+        for i, seq in enumerate(self.sequences):
+            if not seq.finished:
+                seq.append(seq.sample(logits[i]))
+
+    def evict(self):
+        alive = [not seq.finished and not seq.cancelled for seq in self.sequences]
+        if all(alive):
+            return
+        for seq in self.sequences:
+            if seq.cancelled:
+                seq.finish()
+        num_seqs = sum(alive)
+        if num_seqs == 0:
+            self.sequences = []
+            self.length = 0
+            return
+
+        # move the running sequences in rows beyond `num_seqs` to the freed rows, only the
+        # kv of the moved sequences is copied
+        freed = [i for i in range(num_seqs) if not alive[i]]
+        moved = [i for i in range(num_seqs, len(alive)) if alive[i]]
+        for dst, src in zip(freed, moved):
+            for buffers in self.buffers:
+                for buffer in buffers:
+                    buffer[dst, :, :self.length] = buffer[src, :, :self.length]
+            self.mask_buffer[dst, :self.length] = self.mask_buffer[src, :self.length]
+            self.sequences[dst] = self.sequences[src]
+        self.sequences = self.sequences[:num_seqs]
@@ -20,6 +20,7 @@ Relies on load_model method
 """
 
 import os
+import base64
 import torch
 import torch.nn.functional as F
 import gc
@@ -46,10 +47,10 @@ from fastchat.serve.base_model_worker import (
     acquire_worker_semaphore,
     release_worker_semaphore,
 )
-from fastchat.utils import get_context_length, is_partial_stop
+from fastchat.utils import get_context_length
 
 from ipex_llm.transformers.loader import load_model
-from transformers import TextIteratorStreamer
+from ipex_llm.transformers.streamer import IncrementalTextIteratorStreamer, StopStringMatcher
 
 app = FastAPI()
 
@@ -73,6 +74,11 @@ class BigDLLLMWorker(BaseModelWorker):
         load_low_bit_model: bool = False,
         stream_interval: int = 4,
         benchmark: str = "true",
+        embed_max_batch_size: int = 32,
+        embed_max_wait_ms: float = 5.0,
+        continuous_batching: bool = False,
+        max_num_seqs: int = 16,
+        prefill_chunk_size: int = 512,
     ):
         super().__init__(
             controller_addr,
@@ -105,6 +111,29 @@ class BigDLLLMWorker(BaseModelWorker):
             speculative,
             load_low_bit_model,
         )
+        # Based on conditions of different model_type, resolved once at load time
+        model_type = str(type(self.model))
+        self.model_type_dict = {
+            "is_llama": "llama" in model_type,
+            "is_t5": "t5" in model_type,
+            "is_chatglm": "chatglm" in model_type,
+            "is_bert": "bert" in model_type,
+            "is_robert": "robert" in model_type,
+        }
+        self.engine = None
+        if continuous_batching:
+            from ipex_llm.transformers.kv import STANDARD_KV_CACHE_MODEL_TYPES
+            if speculative or self.model.config.is_encoder_decoder or \
+                    self.model.config.model_type not in STANDARD_KV_CACHE_MODEL_TYPES:
+                logger.info(f"Continuous batching is not supported for "
+                            f"{self.model.config.model_type}, fall back to one generate "
+                            f"per request")
+            else:
+                from ipex_llm.serving.fastchat.continuous_batching import \
+                    ContinuousBatchingEngine
+                self.engine = ContinuousBatchingEngine(self.model, max_num_seqs,
+                                                       prefill_chunk_size)
+                logger.info(f"Using continuous batching, max_num_seqs: {max_num_seqs}")
         if benchmark.lower() == "true" and not speculative:
             from ipex_llm.utils.benchmark_util import BenchmarkWrapper
             self.model = BenchmarkWrapper(self.model, do_print=True)
@@ -112,21 +141,26 @@ class BigDLLLMWorker(BaseModelWorker):
         self.stream_interval = stream_interval
         self.context_len = get_context_length(self.model.config)
         self.embed_in_truncate = embed_in_truncate
+        self.embedding_batcher = EmbeddingBatcher(self, embed_max_batch_size, embed_max_wait_ms)
         if not no_register:
             self.init_heart_beat()
 
     def __process_embed_chunk(self, input_ids, attention_mask, **model_type_dict):
         if model_type_dict.get("is_bert"):
-            model_output = self.model(input_ids)
+            model_output = self.model(input_ids, attention_mask=attention_mask)
             if model_type_dict.get("is_robert"):
                 data = model_output.last_hidden_state
             else:
                 data = model_output[0]
         elif model_type_dict.get("is_t5"):
-            model_output = self.model(input_ids, decoder_input_ids=input_ids)
+            model_output = self.model(
+                input_ids, attention_mask=attention_mask, decoder_input_ids=input_ids
+            )
             data = model_output.encoder_last_hidden_state
         else:
-            model_output = self.model(input_ids, output_hidden_states=True)
+            model_output = self.model(
+                input_ids, attention_mask=attention_mask, output_hidden_states=True
+            )
             if model_type_dict.get("is_chatglm"):
                 data = model_output.hidden_states[-1].transpose(0, 1)
             else:
@@ -138,112 +172,133 @@ class BigDLLLMWorker(BaseModelWorker):
             mask = attention_mask.unsqueeze(-1).expand(data.size()).float()
             masked_embeddings = data * mask
             sum_embeddings = torch.sum(masked_embeddings, dim=1)
-        token_num = torch.sum(attention_mask).item()
+        # token num of each input
+        token_num = torch.sum(attention_mask, dim=1)
 
         return sum_embeddings, token_num
 
+    def __embed_batch(self, input_ids, attention_mask):
+        use_cls_pooling = hasattr(self.model, "use_cls_pooling") and self.model.use_cls_pooling
+        if self.embed_in_truncate:
+            embedding, token_num = self.__process_embed_chunk(
+                input_ids, attention_mask, **self.model_type_dict
+            )
+            if not use_cls_pooling:
+                embedding = embedding / token_num.clamp(min=1).unsqueeze(-1)
+        else:
+            embedding = 0
+            token_num = 0
+            for i in range(0, input_ids.size(1), self.context_len):
+                chunk_input_ids = input_ids[:, i:i + self.context_len]
+                chunk_attention_mask = attention_mask[:, i:i + self.context_len]
+
+                # add cls token and mask to get cls embedding
+                if use_cls_pooling:
+                    cls_tokens = (
+                        torch.zeros(
+                            (chunk_input_ids.size(0), 1),
+                            dtype=chunk_input_ids.dtype,
+                            device=chunk_input_ids.device,
+                        )
+                        + self.tokenizer.cls_token_id
+                    )
+                    chunk_input_ids = torch.cat(
+                        [cls_tokens, chunk_input_ids], dim=-1
+                    )
+                    mask = torch.ones(
+                        (chunk_attention_mask.size(0), 1),
+                        dtype=chunk_attention_mask.dtype,
+                        device=chunk_attention_mask.device,
+                    )
+                    chunk_attention_mask = torch.cat(
+                        [mask, chunk_attention_mask], dim=-1
+                    )
+
+                chunk_embeddings, chunk_token_num = self.__process_embed_chunk(
+                    chunk_input_ids, chunk_attention_mask, **self.model_type_dict
+                )
+                if use_cls_pooling:
+                    chunk_embeddings = chunk_embeddings * chunk_token_num.unsqueeze(-1)
+                embedding = embedding + chunk_embeddings
+                token_num = token_num + chunk_token_num
+
+            embedding = embedding / token_num.clamp(min=1).unsqueeze(-1)
+        normalized_embeddings = F.normalize(embedding, p=2, dim=1)
+        return normalized_embeddings, token_num
+
+    @staticmethod
+    def __encode_base64(embeddings: torch.Tensor) -> List[str]:
+        embeddings = embeddings.cpu()
+        return [
+            base64.b64encode(e.numpy().tobytes()).decode("utf-8") for e in embeddings
+        ]
+
     @torch.inference_mode()
-    def get_embeddings(self, params):
-        self.call_ct += 1
+    def get_batch_embeddings(self, params_list):
+        """
+        Compute the embeddings of several `/worker_get_embeddings` requests together.
+        Inputs of all requests are sorted by length and run in padded batches of at most
+        `embedding_batcher.max_batch_size` inputs, then returned per request.
+        """
+        self.call_ct += len(params_list)
 
         try:
             # Get tokenizer
             tokenizer = self.tokenizer
-            ret = {"embedding": [], "token_num": 0}
-
-            # Based on conditions of different model_type
-            model_type_dict = {
-                "is_llama": "llama" in str(type(self.model)),
-                "is_t5": "t5" in str(type(self.model)),
-                "is_chatglm": "chatglm" in str(type(self.model)),
-                "is_bert": "bert" in str(type(self.model)),
-                "is_robert": "robert" in str(type(self.model)),
-            }
+
+            texts = []
+            owners = []
+            for req_idx, params in enumerate(params_list):
+                inputs = params["input"]
+                if isinstance(inputs, str):
+                    inputs = [inputs]
+                texts.extend(inputs)
+                owners.extend([req_idx] * len(inputs))
 
             if self.embed_in_truncate:
                 encoding = tokenizer.batch_encode_plus(
-                    params["input"],
-                    padding=True,
+                    texts,
                     truncation="longest_first",
-                    return_tensors="pt",
                     max_length=self.context_len,
                 )
             else:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"], padding=True, return_tensors="pt"
+                encoding = tokenizer.batch_encode_plus(texts)
+            all_input_ids = encoding["input_ids"]
+
+            # length bucketing: batch inputs of similar length to minimize padding
+            order = sorted(range(len(texts)), key=lambda idx: len(all_input_ids[idx]))
+            max_batch_size = self.embedding_batcher.max_batch_size
+            embeddings = [None] * len(texts)
+            token_nums = [0] * len(texts)
+            for start in range(0, len(order), max_batch_size):
+                indices = order[start:start + max_batch_size]
+                batch = tokenizer.pad(
+                    {"input_ids": [all_input_ids[idx] for idx in indices]},
+                    padding=True,
+                    return_tensors="pt",
                 )
-            input_ids = encoding["input_ids"].to(self.device)
-            # Check if we need attention_mask or not.
-            attention_mask = input_ids != tokenizer.pad_token_id
-
-            base64_encode = params.get("encoding_format", None)
-
-            if self.embed_in_truncate:
-                embedding, token_num = self.__process_embed_chunk(
-                    input_ids, attention_mask, **model_type_dict
+                input_ids = batch["input_ids"].to(self.device)
+                # Check if we need attention_mask or not.
+                attention_mask = (input_ids != tokenizer.pad_token_id).long()
+                batch_embeddings, batch_token_num = self.__embed_batch(
+                    input_ids, attention_mask
                 )
-                if (
-                    not hasattr(self.model, "use_cls_pooling")
-                    or not self.model.use_cls_pooling
-                ):
-                    embedding = embedding / token_num
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-                ret["token_num"] = token_num
-            else:
-                all_embeddings = []
-                all_token_num = 0
-                for i in range(0, input_ids.size(1), self.context_len):
-                    chunk_input_ids = input_ids[:, i:i + self.context_len]
-                    chunk_attention_mask = attention_mask[:, i:i + self.context_len]
-
-                    # add cls token and mask to get cls embedding
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        cls_tokens = (
-                            torch.zeros(
-                                (chunk_input_ids.size(0), 1),
-                                dtype=chunk_input_ids.dtype,
-                                device=chunk_input_ids.device,
-                            )
-                            + tokenizer.cls_token_id
-                        )
-                        chunk_input_ids = torch.cat(
-                            [cls_tokens, chunk_input_ids], dim=-1
-                        )
-                        mask = torch.ones(
-                            (chunk_attention_mask.size(0), 1),
-                            dtype=chunk_attention_mask.dtype,
-                            device=chunk_attention_mask.device,
-                        )
-                        chunk_attention_mask = torch.cat(
-                            [mask, chunk_attention_mask], dim=-1
-                        )
-
-                    chunk_embeddings, token_num = self.__process_embed_chunk(
-                        chunk_input_ids, chunk_attention_mask, **model_type_dict
-                    )
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        all_embeddings.append(chunk_embeddings * token_num)
+                batch_token_num = batch_token_num.tolist()
+                for i, idx in enumerate(indices):
+                    embeddings[idx] = batch_embeddings[i]
+                    token_nums[idx] = batch_token_num[i]
+
+            rets = []
+            for req_idx, params in enumerate(params_list):
+                indices = [idx for idx, owner in enumerate(owners) if owner == req_idx]
+                ret = {"embedding": [], "token_num": sum(token_nums[idx] for idx in indices)}
+                if len(indices) > 0:
+                    normalized_embeddings = torch.stack([embeddings[idx] for idx in indices])
+                    if params.get("encoding_format", None) == "base64":
+                        ret["embedding"] = self.__encode_base64(normalized_embeddings)
                     else:
-                        all_embeddings.append(chunk_embeddings)
-                    all_token_num += token_num
-
-                all_embeddings_tensor = torch.stack(all_embeddings)
-                embedding = torch.sum(all_embeddings_tensor, dim=0) / all_token_num
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-
-                ret["token_num"] = all_token_num
-
-            if base64_encode == "base64":
-                out_embeddings = self.__encode_base64(normalized_embeddings)
-            else:
-                out_embeddings = normalized_embeddings.tolist()
-            ret["embedding"] = out_embeddings
+                        ret["embedding"] = normalized_embeddings.tolist()
+                rets.append(ret)
 
             gc.collect()
             torch.cuda.empty_cache()
@@ -256,12 +311,17 @@ class BigDLLLMWorker(BaseModelWorker):
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.CUDA_OUT_OF_MEMORY,
             }
+            rets = [ret] * len(params_list)
         except (ValueError, RuntimeError) as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
                 "error_code": ErrorCode.INTERNAL_ERROR,
             }
-        return ret
+            rets = [ret] * len(params_list)
+        return rets
+
+    def get_embeddings(self, params):
+        return self.get_batch_embeddings([params])[0]
 
     def generate_stream_gate(self, params):
         self.call_ct += 1
@@ -322,7 +382,7 @@ class BigDLLLMWorker(BaseModelWorker):
                 max_new_tokens = new_max_new_tokens
 
         # Use TextIteratorStreamer for streaming output
-        streamer = TextIteratorStreamer(
+        streamer = IncrementalTextIteratorStreamer(
             tokenizer=self.tokenizer,
             timeout=int(os.getenv("FASTCHAT_WORKER_API_TIMEOUT", 60)),
             skip_prompt=True,
@@ -341,11 +401,26 @@ class BigDLLLMWorker(BaseModelWorker):
             top_k=top_k,
         )
 
-        def model_generate():
-            self.model.generate(input_ids, **generated_kwargs)
+        seq = None
+        if self.engine is not None:
+            # the engine puts tokens into streamer as `generate` does
+            seq = self.engine.submit(
+                input_ids,
+                streamer,
+                max_new_tokens,
+                stop_token_ids,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                top_k=top_k,
+                repetition_penalty=repetition_penalty,
+            )
+        else:
+            def model_generate():
+                self.model.generate(input_ids, **generated_kwargs)
 
-        t1 = Thread(target=model_generate)
-        t1.start()
+            t1 = Thread(target=model_generate)
+            t1.start()
 
         stopped = False
         finish_reason = None
@@ -356,6 +431,8 @@ class BigDLLLMWorker(BaseModelWorker):
             partial_output = ""
             rfind_start = 0
 
+        # match stop strings in new text only
+        stop_matcher = StopStringMatcher(list(stop))
         for i in range(max_new_tokens):
             try:
                 output_token = next(streamer)
@@ -365,40 +442,37 @@ class BigDLLLMWorker(BaseModelWorker):
                 break
             partial_output += output_token
 
-            if i % self.stream_interval == 0 or i == max_new_tokens - 1 or stopped:
-                for each_stop in stop:
-                    pos = partial_output.rfind(each_stop, rfind_start)
-                if pos != -1:
-                    partial_output = partial_output[:pos]
-                    stopped = True
-                    break
-                else:
-                    partially_stopped = is_partial_stop(partial_output, each_stop)
-                    if partially_stopped:
-                        break
-                if not partially_stopped:
-                    json_output = {
-                        "text": partial_output,
-                        "usage": {
-                            "prompt_tokens": input_echo_len,
-                            "completion_tokens": i,
-                            "total_tokens": input_echo_len + i,
-                        },
-                        "finish_reason": None,
-                    }
-                    ret = {
-                        "text": json_output["text"],
-                        "error_code": 0,
-                    }
-                    ret["usage"] = json_output["usage"]
-                    ret["finish_reason"] = json_output["finish_reason"]
-                    yield json.dumps(ret).encode() + b"\0"
-
-            if stopped:
+            pos = stop_matcher.feed(output_token)
+            if pos != -1:
+                partial_output = partial_output[:rfind_start + pos]
+                stopped = True
                 break
+
+            if i % self.stream_interval == 0 or i == max_new_tokens - 1:
+                # hold back the text which may be the beginning of a stop string
+                text_len = len(partial_output) - stop_matcher.partial_len
+                json_output = {
+                    "text": partial_output[:text_len],
+                    "usage": {
+                        "prompt_tokens": input_echo_len,
+                        "completion_tokens": i,
+                        "total_tokens": input_echo_len + i,
+                    },
+                    "finish_reason": None,
+                }
+                ret = {
+                    "text": json_output["text"],
+                    "error_code": 0,
+                }
+                ret["usage"] = json_output["usage"]
+                ret["finish_reason"] = json_output["finish_reason"]
+                yield json.dumps(ret).encode() + b"\0"
         else:
             finish_reason = "length"
 
+        if seq is not None:
+            # free the slot of this request in the running batch
+            seq.cancel()
         if stopped:
             finish_reason = "stop"
         json_output = {
@@ -420,6 +494,70 @@ class BigDLLLMWorker(BaseModelWorker):
         return json.loads(x[:-1].decode())
 
 
+class EmbeddingBatcher:
+    """
+    Merge concurrent `/worker_get_embeddings` requests into batches.
+
+    Requests are queued and the batch is run once it holds `max_batch_size` inputs
+    or `max_wait_ms` has passed since its first request.
+    """
+
+    def __init__(self, worker: BigDLLLMWorker, max_batch_size: int = 32,
+                 max_wait_ms: float = 5.0):
+        self.worker = worker
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+
+    async def submit(self, params):
+        if self.queue is None:
+            # create the queue on the serving event loop
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((params, future))
+        return await future
+
+    @staticmethod
+    def num_inputs(params):
+        inputs = params["input"]
+        return 1 if isinstance(inputs, str) else len(inputs)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = [await self.queue.get()]
+            num_inputs = self.num_inputs(requests[0][0])
+            deadline = loop.time() + self.max_wait
+            while num_inputs < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                num_inputs += self.num_inputs(request[0])
+
+            # a whole batch counts as one model call against `limit_worker_concurrency`
+            await acquire_worker_semaphore()
+            try:
+                rets = await asyncio.to_thread(
+                    self.worker.get_batch_embeddings, [params for params, _ in requests]
+                )
+            except Exception as e:
+                rets = [{
+                    "text": f"{SERVER_ERROR_MSG}\n\n({e})",
+                    "error_code": ErrorCode.INTERNAL_ERROR,
+                }] * len(requests)
+            finally:
+                release_worker_semaphore()
+            for (_, future), ret in zip(requests, rets):
+                if not future.done():
+                    future.set_result(ret)
+
+
 # Below are api interfaces
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
@@ -447,9 +585,9 @@ async def api_get_status(request: Request):
 @app.post("/worker_get_embeddings")
 async def api_get_embeddings(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
-    embedding = worker.get_embeddings(params)
-    release_worker_semaphore()
+    # the batcher takes the worker semaphore per batch, holding it here while queued
+    # would cap a batch at `limit_worker_concurrency` requests
+    embedding = await worker.embedding_batcher.submit(params)
     return JSONResponse(content=embedding)
 
 
@@ -518,6 +656,29 @@ if __name__ == "__main__":
         help="Load models that have been converted/saved using ipex-llm's save_low_bit interface",
     )
     parser.add_argument("--embed-in-truncate", action="store_true")
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        default=False,
+        help="Batch concurrent generate requests at every decoding step",
+    )
+    parser.add_argument(
+        "--max-num-seqs", type=int, default=16,
+        help="Max number of sequences in a batch when using continuous batching"
+    )
+    parser.add_argument(
+        "--prefill-chunk-size", type=int, default=512,
+        help="Max number of prompt tokens prefilled between two decoding steps "
+        "when using continuous batching"
+    )
+    parser.add_argument(
+        "--embed-max-batch-size", type=int, default=32,
+        help="Max number of inputs in one embedding batch"
+    )
+    parser.add_argument(
+        "--embed-max-wait-ms", type=float, default=5.0,
+        help="Max time in ms to wait for more embedding requests to batch together"
+    )
 
     args = parser.parse_args()
     worker = BigDLLLMWorker(
@@ -537,5 +698,10 @@ if __name__ == "__main__":
         args.load_low_bit_model,
         args.stream_interval,
         args.benchmark,
+        args.embed_max_batch_size,
+        args.embed_max_wait_ms,
+        args.continuous_batching,
+        args.max_num_seqs,
+        args.prefill_chunk_size,
     )
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
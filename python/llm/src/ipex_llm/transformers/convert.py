@@ -57,6 +57,9 @@ _IS_VLLM_AVAILABLE = None
 _USE_VLLM = False
 _VLLM_VERSION = None
 
+# default number of threads quantizing weights in `ggml_convert_low_bit` on cpu
+QUANTIZE_THREADS = 4
+
 
 def is_auto_gptq_available():
     return importlib.util.find_spec("auto_gptq") is not None
@@ -299,6 +302,60 @@ def use_scale_search(model_config, qtype):
     return False
 
 
+class _QuantizeExecutor:
+    """
+    Quantize cpu `FP4Params` on a thread pool while the module tree is being walked,
+    the ggml quantize kernels are called through ctypes which releases the GIL.
+    Each param drops its source weight as soon as it is quantized.
+
+    Quantizing a param makes a temporary fp32 copy of its weight, so at most `num_threads`
+    params are in flight, the walk blocks until one of them is done.
+    """
+
+    def __init__(self, num_threads):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from ipex_llm.transformers.low_bit_linear import IQ2_XXS, IQ2_XS, IQ1_S
+        self.pool = ThreadPoolExecutor(max_workers=num_threads)
+        self.in_flight = threading.BoundedSemaphore(num_threads)
+        self.futures = []
+        # these qtypes lazily init global ggml lookup tables, quantize them in order
+        self.serial_qtypes = [IQ2_XXS, IQ2_XS, IQ1_S]
+
+    def quantize(self, param, device):
+        if device.type != "cpu" or param.qtype in self.serial_qtypes:
+            return param.to(device)
+        self.in_flight.acquire()
+        future = self.pool.submit(param.quantize, device.type)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        self.futures.append(future)
+        return param
+
+    def wait(self, check_error=True):
+        """
+        Wait for all params to be quantized. The first quantize error is re-raised only if
+        `check_error`, so that an error of the module walk is not masked by it.
+        """
+        try:
+            for future in self.futures:
+                if check_error:
+                    future.result()
+                else:
+                    future.exception()
+        finally:
+            self.futures = []
+            self.pool.shutdown()
+
+
+def _get_quantize_executor(device):
+    # each quantizing thread holds an fp32 copy of a weight, so the default pool is small
+    num_threads = int(os.environ.get("IPEX_LLM_QUANTIZE_THREADS",
+                                     min(QUANTIZE_THREADS, torch.get_num_threads())))
+    if device == "meta" or num_threads <= 1:
+        return None
+    return _QuantizeExecutor(num_threads)
+
+
 def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                  convert_shape_only=False,
                                  cpu_embedding=False, prefix_name='',
@@ -308,6 +365,7 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                  mixed_precision=False,
                                  act_order=False,
                                  enable_scale_search=False,
+                                 quantize_executor=None,
                                  ):
     from ipex_llm.transformers.low_bit_linear import LowBitLinear, FP4Params, \
         FP16Linear, BF16Linear
@@ -405,7 +463,11 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                              imatrix=cur_imatrix,
                                              in_features=in_features,
                                              enable_xetla=enable_xetla,
-                                             enable_scale_search=enable_scale_search).to(device)
+                                             enable_scale_search=enable_scale_search)
+                    if quantize_executor is not None:
+                        paramsLowBit = quantize_executor.quantize(paramsLowBit, device)
+                    else:
+                        paramsLowBit = paramsLowBit.to(device)
                     new_linear._parameters['weight'] = paramsLowBit
                     if module.bias is not None:
                         new_linear._parameters['bias'] = nn.Parameter(module.bias.data)\
@@ -492,7 +554,11 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                      _shape=None,
                                      convert_shape_only=convert_shape_only,
                                      qtype=embedding_qtype,
-                                     in_features=module.embedding_dim).to(device)
+                                     in_features=module.embedding_dim)
+            if quantize_executor is not None:
+                paramsLowBit = quantize_executor.quantize(paramsLowBit, device)
+            else:
+                paramsLowBit = paramsLowBit.to(device)
             q_embedding._parameters['weight'] = paramsLowBit
             model._modules[name] = q_embedding
             # Force requires grad to False to avoid unexpected errors
@@ -516,6 +582,7 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                 mixed_precision=mixed_precision,
                 act_order=act_order,
                 enable_scale_search=enable_scale_search,
+                quantize_executor=quantize_executor,
             )
             has_been_replaced = _flag or has_been_replaced
     return model, has_been_replaced
@@ -804,18 +871,26 @@ def ggml_convert_low_bit(model, qtype, optimize_model=True,
     enable_scale_search = use_scale_search(model_config, qtype)
 
     # mixed quantization needs model_config to choose custom quantization strategy
-    model, has_been_replaced = _replace_with_low_bit_linear(
-        model, qtype, modules_to_not_convert,
-        convert_shape_only, cpu_embedding,
-        imatrix_data=imatrix_data,
-        embedding_qtype=embedding_qtype,
-        model_config=model_config,
-        torch_dtype=torch_dtype,
-        enable_xetla=enable_xetla,
-        mixed_precision=mixed_precision,
-        act_order=act_order,
-        enable_scale_search=enable_scale_search,
-    )
+    quantize_executor = _get_quantize_executor(device)
+    replaced = False
+    try:
+        model, has_been_replaced = _replace_with_low_bit_linear(
+            model, qtype, modules_to_not_convert,
+            convert_shape_only, cpu_embedding,
+            imatrix_data=imatrix_data,
+            embedding_qtype=embedding_qtype,
+            model_config=model_config,
+            torch_dtype=torch_dtype,
+            enable_xetla=enable_xetla,
+            mixed_precision=mixed_precision,
+            act_order=act_order,
+            enable_scale_search=enable_scale_search,
+            quantize_executor=quantize_executor,
+        )
+        replaced = True
+    finally:
+        if quantize_executor is not None:
+            quantize_executor.wait(check_error=replaced)
     if not has_been_replaced:
         warnings.warn(
             "No linear modules were found in "
@@ -25,6 +25,15 @@ qtype_map = {
     7: "sym_int8",      # q8_0
     8: "sym_int5",      # q5_0
     9: "asym_int5",     # q5_1
+    10: "q2_k",         # q2_k
+    11: "q4_k",         # q3_k_s
+    12: "q4_k",         # q3_k_m
+    13: "q4_k",         # q3_k_l
+    14: "gguf_q4k_s",   # q4_k_s
+    15: "gguf_q4k_m",   # q4_k_m
+    16: "q5_k",         # q5_k_s
+    17: "q5_k",         # q5_k_m
+    18: "q6_k",         # q6_k
 }
 
 
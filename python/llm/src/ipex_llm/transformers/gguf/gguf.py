@@ -18,12 +18,15 @@
 # and https://github.com/ggerganov/llama.cpp/blob/master/ggml-quants.c
 # and https://github.com/ggerganov/llama.cpp/blob/master/llama.cpp
 
+import os
+import mmap
 import struct
 import functools
 import torch
-import numpy
 
 from io import BufferedReader
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from ipex_llm.utils.common import invalidInputError
 
@@ -193,12 +196,12 @@ class GGUFTensorLoader:
             7: 24,      # q5_1
             8: 34,      # q8_0
             9: 40,      # q8_1
-            10: 0,      # q2_k
-            11: 0,      # q3_k
-            12: 0,      # q4_k
-            13: 0,      # q5_k
+            10: 84,     # q2_k
+            11: 110,    # q3_k
+            12: 144,    # q4_k
+            13: 176,    # q5_k
             14: 210,    # q6_k
-            15: 0,      # q8_k
+            15: 292,    # q8_k
             16: 1,      # i8
             17: 2,      # i16
             18: 4,      # i32
@@ -213,12 +216,12 @@ class GGUFTensorLoader:
             7: self.convert_q5_1_tensor,        # q5_1
             8: self.convert_q8_0_tensor,        # q8_0
             9: self.convert_unknown_tensor,     # q8_1
-            10: self.convert_unknown_tensor,    # q2_k
-            11: self.convert_unknown_tensor,    # q3_k
-            12: self.convert_unknown_tensor,    # q4_k
-            13: self.convert_unknown_tensor,    # q5_k
+            10: self.convert_q2_k_tensor,       # q2_k
+            11: self.convert_q3_k_tensor,       # q3_k
+            12: self.convert_q4_k_tensor,       # q4_k
+            13: self.convert_q5_k_tensor,       # q5_k
             14: self.convert_q6_k_tensor,       # q6_k
-            15: self.convert_unknown_tensor,    # q8_k
+            15: self.convert_q8_k_tensor,       # q8_k
             16: self.convert_unknown_tensor,    # i8
             17: self.convert_unknown_tensor,    # i16
             18: self.convert_unknown_tensor,    # i32
@@ -227,42 +230,53 @@ class GGUFTensorLoader:
         self.fpath = fpath
         self.infos = tensor_infos.infos
         self.base_offset = tensor_infos.base_offset
+        self.num_threads = int(os.environ.get("IPEX_LLM_GGUF_LOAD_THREADS",
+                                              min(8, os.cpu_count() or 1)))
 
-    def __iter__(self):
+    def _convert_tensor(self, buffer, info):
+        name, ndims, dims, qtype, offset = info
+        total_ne = functools.reduce(lambda x, y: x * y, dims)
+        invalidInputError(total_ne % self.block_ne[qtype] == 0,
+                          f"wrong elements num: {dims}")
+
+        size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
+        invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
+
+        # zero-copy view of the mapped file, only the converted tensor is materialized
+        tensor = torch.frombuffer(buffer, dtype=torch.uint8,
+                                  offset=self.base_offset + offset, count=size)
+        tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
+        return name, tensor
+
+    def _iter_tensors(self):
         with open(self.fpath, 'rb') as f:
-            for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
-                total_ne = functools.reduce(lambda x, y: x * y, dims)
-                invalidInputError(total_ne % self.block_ne[qtype] == 0,
-                                  f"wrong elements num: {dims}")
-
-                size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
-                invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
-
-                offset += self.base_offset
-                f.seek(offset)
-                data = f.read(size)
-                arr = numpy.frombuffer(data, dtype=numpy.uint8).copy()
-                tensor = torch.from_numpy(arr)
-                tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
+            # copy-on-write mapping, so that tensors viewing the file are writable
+            # without touching the file. The mapping lives as long as those tensors.
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        # convert tensors on a thread pool (torch ops release the GIL) while the
+        # caller consumes them in order, at most `2 * num_threads` tensors ahead
+        num_threads = self.num_threads
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            futures = deque()
+            infos = iter(tqdm(self.infos, desc="Loading gguf tensors"))
+            for info in infos:
+                futures.append(executor.submit(self._convert_tensor, buffer, info))
+                if len(futures) >= 2 * num_threads:
+                    break
+            while futures:
+                name, tensor = futures.popleft().result()
+                info = next(infos, None)
+                if info is not None:
+                    futures.append(executor.submit(self._convert_tensor, buffer, info))
                 yield name, tensor
 
+    def __iter__(self):
+        return self._iter_tensors()
+
     def load_while_process(self, process):
-        with open(self.fpath, 'rb') as f:
-            for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
-                total_ne = functools.reduce(lambda x, y: x * y, dims)
-                invalidInputError(total_ne % self.block_ne[qtype] == 0,
-                                  f"wrong elements num: {dims}")
-
-                size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
-                invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
-
-                offset += self.base_offset
-                f.seek(offset)
-                data = f.read(size)
-                arr = numpy.frombuffer(data, dtype=numpy.uint8)
-                tensor = torch.from_numpy(arr)
-                tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
-                process(name, tensor)
+        for name, tensor in self._iter_tensors():
+            process(name, tensor)
 
     def convert_f32_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         return tensor.view(torch.float)
@@ -341,6 +355,104 @@ class GGUFTensorLoader:
         result = (data * scales).reshape(dims)
         return result
 
+    def convert_q2_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L1936
+
+        block_size = self.block_size[10]
+        tensor = tensor.reshape((-1, block_size))
+
+        scales, qs, d, dmin = (tensor[:, :16], tensor[:, 16:80],
+                               tensor[:, 80:82], tensor[:, 82:])
+        # 2 halves of 128 elements, each holds 4 x 32 elements in bits [0:2], ..., [6:8]
+        shift = torch.tensor([0, 2, 4, 6], dtype=torch.uint8).reshape((1, 1, 4, 1))
+        data = (qs.reshape((-1, 2, 1, 32)) >> shift) & 0B00000011
+        dl = d.view(torch.half) * (scales & 0xF)
+        ml = dmin.view(torch.half) * (scales >> 4)
+
+        result = data.reshape((-1, 16, 16)) * dl.reshape((-1, 16, 1)) - ml.reshape((-1, 16, 1))
+        result = result.reshape(dims)
+        return result
+
+    def convert_q3_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2000
+
+        block_size = self.block_size[11]
+        tensor = tensor.reshape((-1, block_size))
+
+        hmask, qs, scales, d = (tensor[:, :32], tensor[:, 32:96],
+                                tensor[:, 96:108], tensor[:, 108:])
+        # 16 6-bits scales, low 4 bits in scales[0:8], high 2 bits in scales[8:12]
+        shift = torch.tensor([0, 2, 4, 6], dtype=torch.uint8).reshape((1, 4, 1))
+        scales_l = torch.cat([scales[:, :8] & 0xF, scales[:, :8] >> 4], dim=-1)
+        scales_h = ((scales[:, 8:].reshape((-1, 1, 4)) >> shift) & 0B00000011).reshape((-1, 16))
+        scales = (scales_l | (scales_h << 4)).view(torch.int8) - 32
+
+        shift = shift.reshape((1, 1, 4, 1))
+        data_l = (qs.reshape((-1, 2, 1, 32)) >> shift) & 0B00000011
+        shift = torch.arange(0, 8, dtype=torch.uint8).reshape((1, 8, 1))
+        data_h = (hmask.reshape((-1, 1, 32)) >> shift) & 0B00000001
+        # a cleared high bit means -4
+        data = data_l.reshape((-1, 8, 32)).view(torch.int8) - ((1 - data_h) << 2).view(torch.int8)
+        dl = d.view(torch.half) * scales
+
+        result = data.reshape((-1, 16, 16)) * dl.reshape((-1, 16, 1))
+        result = result.reshape(dims)
+        return result
+
+    def _get_k4_scale_min(self, scales: torch.Tensor):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2097
+        sc = torch.cat([scales[:, 0:4] & 0B00111111,
+                        (scales[:, 8:12] & 0xF) | ((scales[:, 0:4] >> 6) << 4)], dim=-1)
+        mn = torch.cat([scales[:, 4:8] & 0B00111111,
+                        (scales[:, 8:12] >> 4) | ((scales[:, 4:8] >> 6) << 4)], dim=-1)
+        return sc, mn
+
+    def convert_q4_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2107
+
+        block_size = self.block_size[12]
+        tensor = tensor.reshape((-1, block_size))
+
+        d, dmin, scales, qs = (tensor[:, :2], tensor[:, 2:4],
+                               tensor[:, 4:16], tensor[:, 16:])
+        sc, mn = self._get_k4_scale_min(scales)
+        dl = d.view(torch.half) * sc
+        ml = dmin.view(torch.half) * mn
+        # 4 x 32 bytes, each holds 2 x 32 elements in low and high 4 bits
+        qs = qs.reshape((-1, 4, 1, 32))
+        data = torch.cat([qs & 0xF, qs >> 4], dim=2)
+
+        result = data.reshape((-1, 8, 32)) * dl.reshape((-1, 8, 1)) - ml.reshape((-1, 8, 1))
+        result = result.reshape(dims)
+        return result
+
+    def convert_q5_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2186
+
+        block_size = self.block_size[13]
+        tensor = tensor.reshape((-1, block_size))
+
+        d, dmin, scales, qh, qs = (tensor[:, :2], tensor[:, 2:4], tensor[:, 4:16],
+                                   tensor[:, 16:48], tensor[:, 48:])
+        sc, mn = self._get_k4_scale_min(scales)
+        dl = d.view(torch.half) * sc
+        ml = dmin.view(torch.half) * mn
+        qs = qs.reshape((-1, 4, 1, 32))
+        data_l = torch.cat([qs & 0xF, qs >> 4], dim=2).reshape((-1, 8, 32))
+        # bit i of qh is the 5th bit of the i-th 32 elements
+        shift = torch.arange(0, 8, dtype=torch.uint8).reshape((1, 8, 1))
+        data_h = (qh.reshape((-1, 1, 32)) >> shift) & 0B00000001
+        data = data_l | (data_h << 4)
+
+        result = data * dl.reshape((-1, 8, 1)) - ml.reshape((-1, 8, 1))
+        result = result.reshape(dims)
+        return result
+
     def convert_q6_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         # see https://github.com/ggerganov/llama.cpp/blob
         # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2263
@@ -366,6 +478,18 @@ class GGUFTensorLoader:
         result = result.reshape(dims)
         return result
 
+    def convert_q8_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see https://github.com/ggerganov/llama.cpp/blob
+        # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2924
+
+        block_size = self.block_size[15]
+        tensor = tensor.reshape((-1, block_size))
+        # bsums in tensor[:, 260:] are only used by dot products
+        d, data = tensor[:, :4], tensor[:, 4:260]
+        result = data.view(torch.int8) * d.view(torch.float)
+        result = result.reshape(dims)
+        return result
+
     def convert_unknown_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         invalidInputError(False, "Unsupported qtype")
 
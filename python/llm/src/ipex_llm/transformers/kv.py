@@ -15,16 +15,31 @@
 #
 
 
+import os
+import heapq
+import threading
 import torch
 
 from .models.utils import (
     init_fp8_kv_cache, append_fp8_kv_cache,
-    init_kv_cache, append_kv_cache
+    init_kv_cache, append_kv_cache,
+    use_cpu_quantize_kv_cache, use_paged_kv_cache
 )
-from typing import Optional, Dict, Tuple, Any
+from typing import Optional, Dict, Tuple, Any, List
+from ipex_llm.utils.common import invalidInputError
 from transformers.cache_utils import DynamicCache
 
 
+KV_CACHE_BLOCK_SIZE = int(os.environ.get("IPEX_LLM_KV_CACHE_BLOCK_SIZE", 64))
+KV_CACHE_POOL_BYTES = int(os.environ.get("IPEX_LLM_KV_CACHE_POOL_BYTES", 1 << 30))
+
+# models whose kv cache is [batch_size, num_heads, seq_len, head_dim] for every layer,
+# which the prefix cache, continuous batching and tree verify rely on
+STANDARD_KV_CACHE_MODEL_TYPES = ["llama", "mistral", "mixtral", "qwen2", "qwen2_moe",
+                                 "baichuan", "internlm", "stablelm", "starcoder2", "phi",
+                                 "phi3", "gemma", "cohere", "minicpm"]
+
+
 class DynamicFp8Cache(DynamicCache):
     def update(
         self,
@@ -85,8 +100,14 @@ class DynamicNormalCache(DynamicCache):
                 # 4.37 uses `seen_tokens`
                 self.seen_tokens += seq_len
 
+        self._append(self.key_cache, self.value_cache, layer_idx, key_states, value_states)
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    def _append(self, key_cache, value_cache, layer_idx, key_states, value_states):
+        batch_size, num_heads, seq_len, head_dim = key_states.shape
+
         # Update the cache
-        if len(self.key_cache) <= layer_idx:
+        if len(key_cache) <= layer_idx:
             k_cache, v_cache = init_kv_cache(
                 batch_size, num_heads, head_dim,
                 0, key_states.size(2) + self.KV_ALLOC_BLOCK_LENGTH,
@@ -94,11 +115,11 @@ class DynamicNormalCache(DynamicCache):
             )
             k_cache, v_cache = append_kv_cache(k_cache, v_cache, key_states, value_states)
 
-            self.key_cache.append(k_cache)
-            self.value_cache.append(v_cache)
+            key_cache.append(k_cache)
+            value_cache.append(v_cache)
         else:
-            k_cache = self.key_cache[layer_idx]
-            v_cache = self.value_cache[layer_idx]
+            k_cache = key_cache[layer_idx]
+            v_cache = value_cache[layer_idx]
 
             kv_seq_len = k_cache.size(2) + key_states.size(2)
             if k_cache.stride(1) < kv_seq_len * k_cache.size(3):
@@ -112,7 +133,732 @@ class DynamicNormalCache(DynamicCache):
                 k_cache = new_k_cache
                 v_cache = new_v_cache
             k_cache, v_cache = append_kv_cache(k_cache, v_cache, key_states, value_states)
-            self.key_cache[layer_idx] = k_cache
-            self.value_cache[layer_idx] = v_cache
+            key_cache[layer_idx] = k_cache
+            value_cache[layer_idx] = v_cache
 
-        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+class DynamicQuantizedCache(DynamicNormalCache):
+    """
+    CPU kv cache which stores keys and values as int8 with a symmetric scale per token
+    and head, about half the memory of a bf16/fp16 cache.
+
+    New tokens are quantized when appended. `attention` dequantizes the kv block by block
+    inside the attention, `update` returns the dequantized kv of the whole layer for the
+    models which do not call `attention`.
+    """
+    # number of tokens dequantized at a time by `attention`
+    DEQUANT_BLOCK_LENGTH = 256
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.key_scale: List[torch.Tensor] = []
+        self.value_scale: List[torch.Tensor] = []
+        # the dtype of the kv before quantization, set when the kv is appended
+        self.dtype = torch.float32
+
+    @staticmethod
+    def quantize(x: torch.Tensor):
+        scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-8) / 127
+        x = torch.round(x.float() / scale).clamp(-127, 127).to(torch.int8)
+        return x, scale
+
+    @staticmethod
+    def dequantize(x: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype):
+        return x.to(dtype) * scale.to(dtype)
+
+    def _quantize_append(self, key_states, value_states, layer_idx):
+        seq_len = key_states.size(2)
+        if layer_idx == 0:
+            if hasattr(self, "_seen_tokens"):
+                # 4.39 uses `_seen_tokens`
+                self._seen_tokens += seq_len
+            else:
+                # 4.37 uses `seen_tokens`
+                self.seen_tokens += seq_len
+        self.dtype = key_states.dtype
+
+        if len(self.key_scale) > layer_idx:
+            # the kv may have been cropped (e.g. by speculative decoding), crop scales as well
+            cur_length = self.key_cache[layer_idx].size(2)
+            self.key_scale[layer_idx] = self.key_scale[layer_idx][:, :, :cur_length, :]
+            self.value_scale[layer_idx] = self.value_scale[layer_idx][:, :, :cur_length, :]
+
+        k_quant, k_scale = self.quantize(key_states)
+        v_quant, v_scale = self.quantize(value_states)
+        self._append(self.key_cache, self.value_cache, layer_idx, k_quant, v_quant)
+        self._append(self.key_scale, self.value_scale, layer_idx, k_scale, v_scale)
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]]=None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        self._quantize_append(key_states, value_states, layer_idx)
+
+        dtype = key_states.dtype
+        return (self.dequantize(self.key_cache[layer_idx], self.key_scale[layer_idx], dtype),
+                self.dequantize(self.value_cache[layer_idx], self.value_scale[layer_idx], dtype))
+
+    def attention(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        attention_mask: Optional[torch.Tensor]=None,
+    ) -> torch.Tensor:
+        """
+        Append the new kv to layer `layer_idx` and return the attention output of
+        `query_states` [batch_size, num_heads, q_len, head_dim] over the whole kv.
+
+        A prompt without past kv attends to its own kv with sdpa. Otherwise the int8 kv is
+        cast to the dtype of the query `DEQUANT_BLOCK_LENGTH` tokens at a time, and as the
+        scales are per token, the key scales are applied to the attention scores and the
+        value scales to the attention probabilities instead of to the kv.
+        """
+        past_len = self.get_seq_length(layer_idx)
+        self._quantize_append(key_states, value_states, layer_idx)
+
+        batch_size, num_heads, q_len, head_dim = query_states.shape
+        num_kv_heads = key_states.size(1)
+        n_rep = num_heads // num_kv_heads
+        kv_len = past_len + q_len
+        dtype = query_states.dtype
+        if attention_mask is not None:
+            attention_mask = attention_mask[:, :, :, :kv_len]
+
+        if past_len == 0:
+            key_states = key_states.repeat_interleave(n_rep, dim=1)
+            value_states = value_states.repeat_interleave(n_rep, dim=1)
+            return torch.nn.functional.scaled_dot_product_attention(
+                query_states, key_states, value_states, attn_mask=attention_mask,
+                is_causal=attention_mask is None and q_len > 1
+            )
+
+        k_quant = self.key_cache[layer_idx]
+        v_quant = self.value_cache[layer_idx]
+        # [batch_size, num_kv_heads, 1, kv_len]
+        k_scale = self.key_scale[layer_idx][:, :, :kv_len].transpose(-1, -2)
+        v_scale = self.value_scale[layer_idx][:, :, :kv_len].transpose(-1, -2)
+
+        # [batch_size, num_kv_heads, n_rep * q_len, head_dim], the heads sharing a kv head
+        # are adjacent
+        query_states = query_states.reshape(batch_size, num_kv_heads, n_rep * q_len, head_dim)
+        scores = torch.empty(batch_size, num_kv_heads, n_rep * q_len, kv_len,
+                             dtype=torch.float32, device=query_states.device)
+        for start in range(0, kv_len, self.DEQUANT_BLOCK_LENGTH):
+            end = min(start + self.DEQUANT_BLOCK_LENGTH, kv_len)
+            k_block = k_quant[:, :, start:end].to(dtype)
+            scores[..., start:end] = torch.matmul(query_states, k_block.transpose(-1, -2))
+        scores *= k_scale * (head_dim ** -0.5)
+        scores = scores.view(batch_size, num_heads, q_len, kv_len)
+        if attention_mask is not None:
+            scores = scores + attention_mask
+        elif q_len > 1:
+            causal_mask = torch.full((q_len, kv_len), float("-inf"), device=scores.device)
+            scores = scores + causal_mask.triu(past_len + 1)
+        probs = torch.nn.functional.softmax(scores, dim=-1)
+        probs = probs.view(batch_size, num_kv_heads, n_rep * q_len, kv_len) * v_scale
+        probs = probs.to(dtype)
+
+        attn_output = None
+        for start in range(0, kv_len, self.DEQUANT_BLOCK_LENGTH):
+            end = min(start + self.DEQUANT_BLOCK_LENGTH, kv_len)
+            v_block = v_quant[:, :, start:end].to(dtype)
+            block_output = torch.matmul(probs[..., start:end], v_block)
+            attn_output = block_output if attn_output is None else attn_output + block_output
+        return attn_output.view(batch_size, num_heads, q_len, head_dim)
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor], Tuple[torch.Tensor]]:
+        # return dequantized kv in its original dtype,
+        # so that `from_legacy_cache` can quantize it again
+        legacy_cache = ()
+        for k, v, k_scale, v_scale in zip(self.key_cache, self.value_cache,
+                                          self.key_scale, self.value_scale):
+            k_scale = k_scale[:, :, :k.size(2), :]
+            v_scale = v_scale[:, :, :v.size(2), :]
+            legacy_cache += ((self.dequantize(k, k_scale, self.dtype),
+                              self.dequantize(v, v_scale, self.dtype)),)
+        return legacy_cache
+
+
+class DynamicSinkCache(DynamicNormalCache):
+    """
+    StreamingLLM style kv cache of bounded size: the first `num_sink_tokens` tokens
+    (attention sinks) are always kept, plus the most recent tokens up to `window_length`
+    tokens in total.
+
+    Like `transformers.SinkCache`, tokens are rotated at their position in the cache rather
+    than in the sequence, so `model.generate` crops the attention mask to `window_length`.
+    Recent tokens are kept in a preallocated ring buffer with keys rotated at their absolute
+    positions, and are rotated back to their cache positions in a second buffer when tokens
+    have been evicted, so no tensor is sliced and concatenated for each new token.
+
+    It supports models using non-scaled rotate-half rope, e.g. llama, mistral and qwen2.
+    The kv returned to single token decoding is not in sequence order once tokens
+    have been evicted, which is fine as long as the attention mask is all ones.
+
+    :param window_length: the maximum number of tokens kept, including sink tokens.
+    :param num_sink_tokens: the number of initial tokens always kept.
+    :param rope_theta: the rope base of the model, i.e. `config.rope_theta`.
+    """
+
+    def __init__(self, window_length: int = 1024, num_sink_tokens: int = 4,
+                 rope_theta: float = 10000.0) -> None:
+        super().__init__()
+        invalidInputError(0 <= num_sink_tokens < window_length,
+                          f"num_sink_tokens should be in [0, {window_length}), "
+                          f"but got {num_sink_tokens}")
+        self.window_length = window_length
+        self.num_sink_tokens = num_sink_tokens
+        self.rope_theta = rope_theta
+        # [bs, n_head, window_length, head_dim] per layer, sink tokens first then a ring buffer
+        self.key_storage: List[torch.Tensor] = []
+        self.value_storage: List[torch.Tensor] = []
+        self.rotated_keys: List[Optional[torch.Tensor]] = []
+        self.evicted: List[int] = []
+        self._rotation = None
+
+    def get_max_length(self) -> Optional[int]:
+        return self.window_length
+
+    def get_usable_length(self, new_seq_length: int, layer_idx: Optional[int] = 0) -> int:
+        length = self.get_seq_length(layer_idx)
+        if length == 0:
+            # the first forward attends to the whole prompt
+            return 0
+        return min(length, self.window_length - new_seq_length)
+
+    def _cos_sin(self, delta: int, x: torch.Tensor):
+        # all layers are rotated by the same delta in a step, so it is computed once
+        key = (delta, x.size(-1), x.dtype, x.device)
+        if self._rotation is None or self._rotation[0] != key:
+            head_dim = x.size(-1)
+            # use float64 as delta grows with the sequence length
+            inv_freq = 1.0 / (self.rope_theta **
+                              (torch.arange(0, head_dim, 2, dtype=torch.float64) / head_dim))
+            angles = delta * inv_freq
+            self._rotation = (key,
+                              angles.cos().to(device=x.device, dtype=x.dtype),
+                              angles.sin().to(device=x.device, dtype=x.dtype))
+        return self._rotation[1], self._rotation[2]
+
+    def _rotate(self, x: torch.Tensor, delta: int, out: Optional[torch.Tensor] = None):
+        # rotate rope embedded `x` by `delta` positions, `out` must not overlap `x`
+        cos, sin = self._cos_sin(delta, x)
+        if out is None:
+            out = torch.empty_like(x)
+        half = x.size(-1) // 2
+        x1, x2 = x[..., :half], x[..., half:]
+        out1, out2 = out[..., :half], out[..., half:]
+        torch.mul(x1, cos, out=out1)
+        out1.addcmul_(x2, sin, value=-1)
+        torch.mul(x2, cos, out=out2)
+        out2.addcmul_(x1, sin)
+        return out
+
+    def _store(self, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor,
+               start: int):
+        # store tokens at absolute positions [start, start + seq_len)
+        k_storage = self.key_storage[layer_idx]
+        v_storage = self.value_storage[layer_idx]
+        sink, window = self.num_sink_tokens, self.window_length
+        ring_size = window - sink
+        seq_len = key_states.size(2)
+
+        num_sink = max(0, min(sink - start, seq_len))
+        if num_sink > 0:
+            k_storage[:, :, start:start + num_sink] = key_states[:, :, :num_sink]
+            v_storage[:, :, start:start + num_sink] = value_states[:, :, :num_sink]
+        # older tokens would be overwritten in the ring buffer anyway
+        offset = max(num_sink, seq_len - ring_size)
+        pos = start + offset
+        while offset < seq_len:
+            slot = sink + (pos - sink) % ring_size
+            n = min(seq_len - offset, window - slot)
+            k_storage[:, :, slot:slot + n] = key_states[:, :, offset:offset + n]
+            v_storage[:, :, slot:slot + n] = value_states[:, :, offset:offset + n]
+            offset += n
+            pos += n
+
+    def _gather(self, layer_idx: int):
+        # kv of a layer in sequence order, keys rotated at their positions in the cache
+        k_storage = self.key_storage[layer_idx]
+        v_storage = self.value_storage[layer_idx]
+        evicted = self.evicted[layer_idx]
+        if evicted == 0:
+            return self.key_cache[layer_idx], self.value_cache[layer_idx]
+        sink, window = self.num_sink_tokens, self.window_length
+        oldest = sink + evicted % (window - sink)
+        recent_k = torch.cat([k_storage[:, :, oldest:], k_storage[:, :, sink:oldest]], dim=2)
+        recent_v = torch.cat([v_storage[:, :, oldest:], v_storage[:, :, sink:oldest]], dim=2)
+        return (torch.cat([k_storage[:, :, :sink], self._rotate(recent_k, -evicted)], dim=2),
+                torch.cat([v_storage[:, :, :sink], recent_v], dim=2))
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]]=None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+
+        batch_size, num_heads, seq_len, head_dim = key_states.shape
+
+        if layer_idx == 0:
+            if hasattr(self, "_seen_tokens"):
+                # 4.39 uses `_seen_tokens`
+                self._seen_tokens += seq_len
+            else:
+                # 4.37 uses `seen_tokens`
+                self.seen_tokens += seq_len
+
+        sink, window = self.num_sink_tokens, self.window_length
+        if len(self.key_storage) <= layer_idx:
+            shape = (batch_size, num_heads, window, head_dim)
+            self.key_storage.append(key_states.new_empty(shape))
+            self.value_storage.append(value_states.new_empty(shape))
+            self.rotated_keys.append(None)
+            self.evicted.append(0)
+            self.key_cache.append(self.key_storage[layer_idx][:, :, :0])
+            self.value_cache.append(self.value_storage[layer_idx][:, :, :0])
+
+        # the decoding fast path may have appended to the storage views in place,
+        # so the current length is taken from `key_cache`
+        length = self.key_cache[layer_idx].size(2)
+        invalidInputError(length == 0 or seq_len <= window - sink,
+                          f"Cannot append {seq_len} tokens to a sink cache of "
+                          f"window length {window} with {sink} sink tokens at once")
+        evicted = self.evicted[layer_idx]
+        new_length = min(length + seq_len, window)
+        new_evicted = evicted + length + seq_len - new_length
+        self.evicted[layer_idx] = new_evicted
+        k_storage = self.key_storage[layer_idx]
+        v_storage = self.value_storage[layer_idx]
+
+        if new_evicted == 0:
+            k_storage[:, :, length:new_length] = key_states
+            v_storage[:, :, length:new_length] = value_states
+            self.key_cache[layer_idx] = k_storage[:, :, :new_length]
+            self.value_cache[layer_idx] = v_storage[:, :, :new_length]
+            return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+        # new tokens are rotated at cache positions `new_length - seq_len + i`,
+        # except for the first forward, which uses their absolute positions
+        start = length + evicted
+        abs_keys = key_states if length == 0 else self._rotate(key_states, new_evicted)
+        self._store(layer_idx, abs_keys, value_states, start)
+        self.key_cache[layer_idx] = k_storage
+        self.value_cache[layer_idx] = v_storage
+
+        if length == 0:
+            # the whole prompt is attended to
+            return key_states, value_states
+        if seq_len > 1:
+            # multiple new tokens need their kv in sequence order for the causal mask
+            return self._gather(layer_idx)
+
+        rotated_keys = self.rotated_keys[layer_idx]
+        if rotated_keys is None:
+            # sink tokens never move, copy them once
+            rotated_keys = k_storage.clone()
+            self.rotated_keys[layer_idx] = rotated_keys
+        self._rotate(k_storage[:, :, sink:], -new_evicted, out=rotated_keys[:, :, sink:])
+        return rotated_keys, v_storage
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor], Tuple[torch.Tensor]]:
+        return tuple(self._gather(layer_idx) for layer_idx in range(len(self.key_storage)))
+
+
+def get_normal_cache_cls(x: torch.Tensor):
+    """Select the kv cache class to use when the fp8 (xpu) kv cache is not used."""
+    if use_cpu_quantize_kv_cache(x):
+        return DynamicQuantizedCache
+    elif use_paged_kv_cache(x):
+        return DynamicPagedCache
+    else:
+        return DynamicNormalCache
+
+
+class KVBlockPool:
+    """
+    A pool of fixed-size KV cache blocks of ``block_size`` tokens shared by the caches of a
+    batch size and KV shape.
+
+    A block is identified by an id, the same id addresses the block of every layer.
+    Blocks are allocated in chunks of ``blocks_per_chunk`` blocks, every layer of a chunk is
+    a ``[blocks_per_chunk, batch_size, num_heads, block_size, head_dim]`` key tensor and a
+    value tensor, so a run of consecutive ids is a single strided view. Free blocks are handed
+    out lowest id first, which keeps the blocks of a sequence mostly consecutive.
+
+    Blocks released by finished requests are reused by later requests. Once the free blocks
+    of all pools exceed ``IPEX_LLM_KV_CACHE_POOL_BYTES``, the chunks without used blocks are
+    released.
+    """
+    blocks_per_chunk = 16
+    _pools = {}
+    _lock = threading.RLock()
+
+    def __init__(self, batch_size, num_heads, head_dim, dtype, device, block_size):
+        self.batch_size = batch_size
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.dtype = dtype
+        self.device = device
+        self.block_size = block_size
+        # chunk_idx -> layer_idx -> (key, value), None once the chunk is released
+        self.chunks: List[Optional[List[Tuple[torch.Tensor, torch.Tensor]]]] = []
+        # chunk_idx -> number of blocks in use
+        self.num_used: List[int] = []
+        # heap of free block ids
+        self.free_ids: List[int] = []
+
+    @classmethod
+    def get_pool(cls, batch_size, num_heads, head_dim, dtype, device, block_size=None):
+        block_size = block_size or KV_CACHE_BLOCK_SIZE
+        key = (batch_size, num_heads, head_dim, dtype, str(device), block_size)
+        with cls._lock:
+            if key not in cls._pools:
+                cls._pools[key] = cls(batch_size, num_heads, head_dim, dtype, device,
+                                      block_size)
+            return cls._pools[key]
+
+    def allocate(self) -> int:
+        """Return the id of a free block."""
+        with self._lock:
+            if not self.free_ids:
+                self._add_chunk()
+            block_id = heapq.heappop(self.free_ids)
+            self.num_used[block_id // self.blocks_per_chunk] += 1
+            return block_id
+
+    def free(self, block_ids: List[int]):
+        """Return blocks to the pool, releasing idle chunks beyond the memory budget."""
+        with self._lock:
+            for block_id in block_ids:
+                heapq.heappush(self.free_ids, block_id)
+                self.num_used[block_id // self.blocks_per_chunk] -= 1
+            KVBlockPool.evict(KV_CACHE_POOL_BYTES)
+
+    def layer_chunk(self, chunk_idx, layer_idx) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Return the key/value tensors of `layer_idx` in chunk `chunk_idx`."""
+        layers = self.chunks[chunk_idx]
+        if len(layers) <= layer_idx:
+            with self._lock:
+                shape = (self.blocks_per_chunk, self.batch_size, self.num_heads,
+                         self.block_size, self.head_dim)
+                while len(layers) <= layer_idx:
+                    # zeros, the unused tail of a block is multiplied by zero probabilities
+                    layers.append((torch.zeros(shape, dtype=self.dtype, device=self.device),
+                                   torch.zeros(shape, dtype=self.dtype, device=self.device)))
+        return layers[layer_idx]
+
+    def _add_chunk(self):
+        if None in self.chunks:
+            chunk_idx = self.chunks.index(None)
+        else:
+            chunk_idx = len(self.chunks)
+            self.chunks.append(None)
+            self.num_used.append(0)
+        self.chunks[chunk_idx] = []
+        first_id = chunk_idx * self.blocks_per_chunk
+        for block_id in range(first_id, first_id + self.blocks_per_chunk):
+            heapq.heappush(self.free_ids, block_id)
+
+    def _chunk_nbytes(self, chunk_idx):
+        return sum(k.nelement() * k.element_size() * 2 for k, _ in self.chunks[chunk_idx])
+
+    @classmethod
+    def free_nbytes(cls) -> int:
+        """The bytes held by free blocks of all pools."""
+        with cls._lock:
+            return sum(pool._chunk_nbytes(chunk_idx) *
+                       (cls.blocks_per_chunk - pool.num_used[chunk_idx]) // cls.blocks_per_chunk
+                       for pool in cls._pools.values()
+                       for chunk_idx, layers in enumerate(pool.chunks) if layers is not None)
+
+    @classmethod
+    def evict(cls, max_free_bytes=0):
+        """Release chunks without used blocks until free blocks hold at most `max_free_bytes`."""
+        with cls._lock:
+            free_bytes = cls.free_nbytes()
+            # the chunks with the highest ids first, the lowest ids are handed out first
+            idle_chunks = [(chunk_idx, pool) for pool in cls._pools.values()
+                           for chunk_idx, layers in enumerate(pool.chunks)
+                           if layers is not None and pool.num_used[chunk_idx] == 0]
+            idle_chunks.sort(key=lambda c: c[0], reverse=True)
+            for chunk_idx, pool in idle_chunks:
+                if free_bytes <= max_free_bytes:
+                    break
+                free_bytes -= pool._chunk_nbytes(chunk_idx)
+                pool.chunks[chunk_idx] = None
+                pool.free_ids = [block_id for block_id in pool.free_ids
+                                 if block_id // cls.blocks_per_chunk != chunk_idx]
+                heapq.heapify(pool.free_ids)
+
+
+class DynamicPagedCache(DynamicNormalCache):
+    """
+    A KV cache stored in the fixed-size blocks of a shared `KVBlockPool`.
+
+    The cache holds a block table, the ids of its blocks in sequence order, shared by all
+    layers. Appending tokens only writes the new tokens into the tail blocks, allocating
+    blocks as needed, the existing tokens are never copied. `attention` computes the
+    attention directly over the blocks, `update`, `__getitem__` and `to_legacy_cache` return
+    contiguous copies, so no tensor outlives the blocks which go back to the pool when the
+    cache is released.
+
+    Enabled on CPU with `IPEX_LLM_PAGED_KV_CACHE=1` for llama, mistral, phi3, qwen2,
+    qwen2_moe, stablelm and starcoder2.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.pool: Optional[KVBlockPool] = None
+        self.block_table: List[int] = []
+        # layer_idx -> number of tokens
+        self.seq_lengths: List[int] = []
+        self._runs = None
+
+    @classmethod
+    def from_legacy_cache(cls, past_key_values=None) -> "DynamicPagedCache":
+        cache = cls()
+        if past_key_values is not None:
+            for layer_idx, (key_states, value_states) in enumerate(past_key_values):
+                cache.append(key_states, value_states, layer_idx)
+        return cache
+
+    def __len__(self):
+        return len(self.seq_lengths)
+
+    def __getitem__(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        invalidInputError(layer_idx < len(self),
+                          f"Cache only has {len(self)} layers, "
+                          f"attempted to access layer with index {layer_idx}")
+        return self._gather(layer_idx)
+
+    def __iter__(self):
+        for layer_idx in range(len(self)):
+            yield self._gather(layer_idx)
+
+    def get_seq_length(self, layer_idx: Optional[int]=0) -> int:
+        if len(self.seq_lengths) <= layer_idx:
+            return 0
+        return self.seq_lengths[layer_idx]
+
+    def to_legacy_cache(self) -> Tuple[Tuple[torch.Tensor], Tuple[torch.Tensor]]:
+        return tuple(self._gather(layer_idx) for layer_idx in range(len(self)))
+
+    def _set_seen_tokens(self, seen_tokens):
+        if hasattr(self, "_seen_tokens"):
+            # 4.39 uses `_seen_tokens`
+            self._seen_tokens = seen_tokens
+        else:
+            # 4.37 uses `seen_tokens`
+            self.seen_tokens = seen_tokens
+
+    def append(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int):
+        """Write `key_states` and `value_states` after the tokens of layer `layer_idx`."""
+        batch_size, num_heads, seq_len, head_dim = key_states.shape
+
+        if layer_idx == 0:
+            self._set_seen_tokens(self.get_seq_length() + seq_len)
+        if self.pool is None:
+            self.pool = KVBlockPool.get_pool(batch_size, num_heads, head_dim,
+                                             key_states.dtype, key_states.device)
+        if len(self.seq_lengths) <= layer_idx:
+            self.seq_lengths.append(0)
+
+        block_size = self.pool.block_size
+        blocks_per_chunk = self.pool.blocks_per_chunk
+        cur_len = self.seq_lengths[layer_idx]
+        new_len = cur_len + seq_len
+        while len(self.block_table) * block_size < new_len:
+            self.block_table.append(self.pool.allocate())
+            self._runs = None
+
+        pos = cur_len
+        while pos < new_len:
+            block_id = self.block_table[pos // block_size]
+            offset = pos % block_size
+            end = min(new_len, pos - offset + block_size)
+            k_chunk, v_chunk = self.pool.layer_chunk(block_id // blocks_per_chunk, layer_idx)
+            idx = block_id % blocks_per_chunk
+            tokens = slice(pos - cur_len, end - cur_len)
+            k_chunk[idx, :, :, offset:offset + end - pos] = key_states[:, :, tokens]
+            v_chunk[idx, :, :, offset:offset + end - pos] = value_states[:, :, tokens]
+            pos = end
+        self.seq_lengths[layer_idx] = new_len
+
+    def _block_runs(self) -> List[List[int]]:
+        # [chunk_idx, index in the chunk, number of blocks] of each run of consecutive blocks
+        if self._runs is None:
+            runs = []
+            for block_id in self.block_table:
+                chunk_idx, idx = divmod(block_id, self.pool.blocks_per_chunk)
+                if runs and runs[-1][0] == chunk_idx and sum(runs[-1][1:]) == idx:
+                    runs[-1][2] += 1
+                else:
+                    runs.append([chunk_idx, idx, 1])
+            self._runs = runs
+        return self._runs
+
+    def _layer_runs(self, layer_idx: int):
+        # yield each run of layer `layer_idx` as [num_blocks, batch_size, num_heads,
+        # block_size, head_dim] key/value views and the number of tokens in it
+        remaining = self.get_seq_length(layer_idx)
+        block_size = self.pool.block_size if self.pool is not None else 1
+        for chunk_idx, idx, num_blocks in self._block_runs():
+            if remaining <= 0:
+                break
+            num_blocks = min(num_blocks, (remaining + block_size - 1) // block_size)
+            k_chunk, v_chunk = self.pool.layer_chunk(chunk_idx, layer_idx)
+            num_tokens = min(remaining, num_blocks * block_size)
+            yield k_chunk[idx:idx + num_blocks], v_chunk[idx:idx + num_blocks], num_tokens
+            remaining -= num_tokens
+
+    @staticmethod
+    def _flatten(run: torch.Tensor) -> torch.Tensor:
+        num_blocks, batch_size, num_heads, block_size, head_dim = run.shape
+        return run.permute(1, 2, 0, 3, 4).reshape(batch_size, num_heads,
+                                                  num_blocks * block_size, head_dim)
+
+    def _gather(self, layer_idx: int, start: int=0) -> Tuple[torch.Tensor, torch.Tensor]:
+        # the tokens from `start` on, `torch.cat` always copies, even a single run
+        keys, values = [], []
+        pos = 0
+        for k_run, v_run, num_tokens in self._layer_runs(layer_idx):
+            if pos + num_tokens > start:
+                offset = max(start - pos, 0)
+                keys.append(self._flatten(k_run)[:, :, offset:num_tokens])
+                values.append(self._flatten(v_run)[:, :, offset:num_tokens])
+            pos += num_tokens
+        return torch.cat(keys, dim=2), torch.cat(values, dim=2)
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]]=None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # the models which support the paged cache call `attention` instead
+        self.append(key_states, value_states, layer_idx)
+        return self._gather(layer_idx)
+
+    def attention(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        attention_mask: Optional[torch.Tensor]=None,
+    ) -> torch.Tensor:
+        """
+        Append the new kv to layer `layer_idx` and return the attention output of
+        `query_states` [batch_size, num_heads, q_len, head_dim] over the whole kv.
+
+        A prompt without past kv attends to its own kv with sdpa, otherwise the attention is
+        computed over the blocks in place, one matmul per run of consecutive blocks.
+        Grouped query heads share their kv head without repeating it.
+        """
+        past_len = self.get_seq_length(layer_idx)
+        self.append(key_states, value_states, layer_idx)
+
+        batch_size, num_heads, q_len, head_dim = query_states.shape
+        num_kv_heads = key_states.size(1)
+        n_rep = num_heads // num_kv_heads
+        kv_len = past_len + q_len
+        if attention_mask is not None:
+            attention_mask = attention_mask[:, :, :, :kv_len]
+
+        if past_len == 0:
+            key_states = key_states.repeat_interleave(n_rep, dim=1)
+            value_states = value_states.repeat_interleave(n_rep, dim=1)
+            return torch.nn.functional.scaled_dot_product_attention(
+                query_states, key_states, value_states, attn_mask=attention_mask,
+                is_causal=attention_mask is None and q_len > 1
+            )
+
+        # [batch_size, num_kv_heads, n_rep * q_len, head_dim], the heads sharing a kv head
+        # are adjacent
+        query_states = query_states.reshape(batch_size, num_kv_heads, n_rep * q_len, head_dim)
+        runs = list(self._layer_runs(layer_idx))
+        scores = []
+        for k_run, _, num_tokens in runs:
+            # [num_blocks, batch_size, num_kv_heads, n_rep * q_len, block_size]
+            run_scores = torch.matmul(query_states, k_run.transpose(-1, -2))
+            scores.append(run_scores.permute(1, 2, 3, 0, 4).flatten(3)[..., :num_tokens])
+        scores = torch.cat(scores, dim=-1).view(batch_size, num_heads, q_len, kv_len)
+        scores = scores.float() * (head_dim ** -0.5)
+        if attention_mask is not None:
+            scores = scores + attention_mask
+        elif q_len > 1:
+            causal_mask = torch.full((q_len, kv_len), float("-inf"), device=scores.device)
+            scores = scores + causal_mask.triu(past_len + 1)
+        probs = torch.nn.functional.softmax(scores, dim=-1).to(value_states.dtype)
+        probs = probs.view(batch_size, num_kv_heads, n_rep * q_len, kv_len)
+
+        attn_output = None
+        start = 0
+        for _, v_run, num_tokens in runs:
+            num_blocks, block_size = v_run.size(0), v_run.size(3)
+            run_probs = probs[..., start:start + num_tokens]
+            if num_tokens < num_blocks * block_size:
+                run_probs = torch.nn.functional.pad(run_probs,
+                                                    (0, num_blocks * block_size - num_tokens))
+            run_probs = run_probs.unflatten(-1, (num_blocks, block_size)).permute(3, 0, 1, 2, 4)
+            run_output = torch.matmul(run_probs, v_run).sum(dim=0)
+            attn_output = run_output if attn_output is None else attn_output + run_output
+            start += num_tokens
+        return attn_output.view(batch_size, num_heads, q_len, head_dim)
+
+    def crop(self, max_length: int):
+        """
+        Keep the first `max_length` tokens, or drop the last `-max_length` tokens if
+        `max_length` is negative, and return the blocks no longer needed to the pool.
+        """
+        if max_length < 0:
+            max_length = self.get_seq_length() + max_length
+        if self.get_seq_length() <= max_length:
+            return
+        self._set_seen_tokens(max_length)
+        self.seq_lengths = [min(seq_len, max_length) for seq_len in self.seq_lengths]
+        if self.pool is not None:
+            num_blocks = (max_length + self.pool.block_size - 1) // self.pool.block_size
+            self.pool.free(self.block_table[num_blocks:])
+            self.block_table = self.block_table[:num_blocks]
+            self._runs = None
+
+    def select_tokens(self, start: int, index: torch.LongTensor):
+        """
+        Replace the tokens from `start` on by the tokens at `start + index`, where `index`
+        of shape [batch_size, num_tokens] selects the tokens of each sequence.
+        """
+        tails = [self._gather(layer_idx, start) for layer_idx in range(len(self))]
+        self.crop(start)
+        for layer_idx, (key_states, value_states) in enumerate(tails):
+            token_index = index[:, None, :, None].expand(-1, key_states.size(1), -1,
+                                                         key_states.size(3))
+            token_index = token_index.to(key_states.device)
+            self.append(key_states.gather(2, token_index),
+                        value_states.gather(2, token_index), layer_idx)
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        for layer_idx in range(len(self)):
+            for k_run, v_run, _ in self._layer_runs(layer_idx):
+                k_run.copy_(k_run.index_select(1, beam_idx.to(k_run.device)))
+                v_run.copy_(v_run.index_select(1, beam_idx.to(v_run.device)))
+
+    def free(self):
+        """Return all blocks to the pool, the cache is empty afterwards."""
+        if getattr(self, "pool", None) is not None and self.block_table:
+            self.pool.free(self.block_table)
+        self.block_table = []
+        self.seq_lengths = []
+        self._runs = None
+
+    def __del__(self):
+        self.free()
@@ -28,7 +28,9 @@ import random
 import logging
 from transformers import GenerationConfig, LogitsProcessorList, StoppingCriteriaList
 from ipex_llm.transformers.speculative import greedy, deepmind_sample, logits_to_probs,\
-    _crop_past_key_values, _prepare_generate_args, _non_cpu_ipex_verify, clear_benchmarks
+    _crop_past_key_values, _prepare_generate_args, _non_cpu_ipex_verify, clear_benchmarks,\
+    _check_croppable_cache, _BatchedOutputs, _batched_prefill, _batched_verify,\
+    _get_draft_length_policy, _check_tree_width, _support_tree_verify, _tree_verify
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.transformers.utils import get_xpu_device_type
 
@@ -38,6 +40,8 @@ logger = logging.getLogger("ipex_llm.lookup")
 from transformers import GenerationMixin
 original_generate = GenerationMixin.generate
 query_group_size = 16
+# the base of the polynomial hash of the prompt ngrams
+NGRAM_HASH_BASE = 1000003
 
 
 @torch.no_grad()
@@ -77,6 +81,7 @@ def generate(
                 logger.warning("Since you call the generate with lookahead parameter, "
                                f"Speculative decoding parameters {spec_params} are "
                                "removed in the generation.")
+            _check_croppable_cache(kwargs.get("past_key_values", None))
             return self.lookup_generate(inputs=inputs,
                                         num_output_tokens=lookahead,
                                         generation_config=generation_config,
@@ -99,10 +104,6 @@ def generate(
 GenerationMixin.generate = generate
 
 
-def tensor2key(key_tensor: torch.LongTensor):
-    return tuple(key_tensor.tolist())
-
-
 # This class is copied from https://github.com/huggingface/transformers/blob/main/src
 # /transformers/generation/candidate_generator.py
 class PromptLookupCandidateGenerator():
@@ -114,6 +115,9 @@ class PromptLookupCandidateGenerator():
     Read the following blog post for more information:
     https://github.com/apoorvumang/prompt-lookup-decoding
 
+    The ngrams of the prompt are indexed at once by their hashes in sorted tensors, and the
+    ngrams followed by accepted tokens are indexed incrementally in a dict.
+
     Args:
         max_matching_ngram_size (`int`):
             The maximum ngram size to be considered for matching in the prompt
@@ -137,33 +141,154 @@ class PromptLookupCandidateGenerator():
             self.max_candidates = 9
             self.min_candidates = 0
 
-        self.lookup_table = {}
+        # all tokens seen so far (on cpu) in a buffer growing geometrically
+        self.token_buffer = None
+        self.num_tokens = 0
+        # prompt_index[n - 1] holds the (ngram hash, next token, count, first start index)
+        # of each distinct pair of an ngram and its next token in the prompt, sorted by hash
+        self.prompt_index = []
+        # ngram_index[n - 1] maps an ngram to {next token: [count, first start index]}
+        # for its occurrences followed by an accepted token
+        self.ngram_index = []
         invalidInputError(self.max_matching_ngram_size > 0 and self.num_output_tokens > 0,
                           "Invalid max_matching_ngram_size or num_output_tokens")
 
+    @property
+    def tokens(self) -> torch.LongTensor:
+        return self.token_buffer[:self.num_tokens]
+
+    @staticmethod
+    def _hash_ngrams(ngrams: torch.LongTensor) -> torch.LongTensor:
+        # polynomial hash of each row, wrapping around in int64
+        hashes = torch.zeros(ngrams.size(0), dtype=torch.long)
+        for i in range(ngrams.size(1)):
+            hashes = hashes * NGRAM_HASH_BASE + ngrams[:, i]
+        return hashes
+
+    def _index_prompt(self, tokens: torch.LongTensor):
+        self.prompt_index = []
+        positions = torch.arange(tokens.size(0))
+        for ngram_size in range(1, self.max_matching_ngram_size + 1):
+            num_ngrams = tokens.size(0) - ngram_size
+            if num_ngrams <= 0:
+                self.prompt_index.append(None)
+                continue
+            # each ngram followed by a token, and the token
+            windows = tokens.unfold(0, ngram_size + 1, 1)
+            ngram_hashes = self._hash_ngrams(windows[:, :ngram_size])
+            pair_hashes = ngram_hashes * NGRAM_HASH_BASE + windows[:, ngram_size]
+            pairs, inverse, counts = torch.unique(pair_hashes, return_inverse=True,
+                                                  return_counts=True)
+            first_starts = torch.full((pairs.size(0),), num_ngrams, dtype=torch.long)
+            first_starts = first_starts.scatter_reduce(0, inverse, positions[:num_ngrams],
+                                                       reduce="amin")
+            ngram_hashes = ngram_hashes[first_starts]
+            order = torch.argsort(ngram_hashes)
+            self.prompt_index.append((ngram_hashes[order], windows[first_starts[order], -1],
+                                      counts[order], first_starts[order]))
+
+    def _index_ngrams(self, tokens: List[int], offset: int, first_end: int):
+        """
+        Index the ngrams of `tokens` (starting at position `offset`) which end at position
+        `first_end` or later and are followed by a token.
+        """
+        for end in range(first_end - offset, len(tokens) - 1):
+            next_token = tokens[end + 1]
+            for ngram_size in range(1, min(self.max_matching_ngram_size, end + 1) + 1):
+                start = end - ngram_size + 1
+                followers = self.ngram_index[ngram_size - 1].setdefault(
+                    tuple(tokens[start:end + 1]), {})
+                if next_token in followers:
+                    followers[next_token][0] += 1
+                else:
+                    followers[next_token] = [1, start + offset]
+
     def init_look_up_table(self,
                            input_ids: torch.LongTensor):
-        for ngram_size in range(self.max_matching_ngram_size, 0, -1):
-            # Create sliding windows of size ngram_size
-            windows = input_ids.unfold(dimension=1, size=ngram_size, step=1)
-            for idx in range(windows.size(1)):
-                window = tensor2key(windows[0, idx])
-                if window not in self.lookup_table:
-                    self.lookup_table[window] = idx
+        tokens = input_ids[0].cpu()
+        self.num_tokens = tokens.size(0)
+        self.token_buffer = torch.empty(max(2 * self.num_tokens, 64), dtype=torch.long)
+        self.token_buffer[:self.num_tokens] = tokens
+        self.ngram_index = [{} for _ in range(self.max_matching_ngram_size)]
+        self._index_prompt(tokens)
+
+    def append_tokens(self, new_tokens: List[int]):
+        """Append accepted tokens and index only the ngrams followed by them."""
+        if len(new_tokens) == 0:
+            return
+        old_len = self.num_tokens
+        new_len = old_len + len(new_tokens)
+        if new_len > self.token_buffer.size(0):
+            token_buffer = torch.empty(2 * new_len, dtype=torch.long)
+            token_buffer[:old_len] = self.token_buffer[:old_len]
+            self.token_buffer = token_buffer
+        self.token_buffer[old_len:new_len] = torch.tensor(new_tokens, dtype=torch.long)
+        self.num_tokens = new_len
+        # the ngrams ending at the old last token are followed by a token from now on
+        offset = max(0, old_len - self.max_matching_ngram_size)
+        self._index_ngrams(self.token_buffer[offset:new_len].tolist(), offset, old_len - 1)
 
     def update_look_up_table(self,
                              new_input_ids: torch.LongTensor):
-        # Maintain a look up table
-        window = tensor2key(new_input_ids[0, -self.max_matching_ngram_size:])
-        for ngram_size in range(self.max_matching_ngram_size):
-            if window[ngram_size:] not in self.lookup_table:
-                self.lookup_table[window[ngram_size:]] = \
-                    new_input_ids.size(1)-self.max_matching_ngram_size+ngram_size
-
-    def get_n_gram_idx(self,
-                       ngram_tensor: torch.LongTensor):
-        key = tensor2key(ngram_tensor)
-        return self.lookup_table[key]
+        self.append_tokens(new_input_ids[0, self.num_tokens:].tolist())
+
+    def _followers(self, ngram: List[int]):
+        """
+        Return {next token: [count, first start index]} for the occurrences of `ngram`
+        followed by a token.
+        """
+        ngram_size = len(ngram)
+        followers = {}
+        if self.prompt_index[ngram_size - 1] is not None:
+            hashes, next_tokens, counts, first_starts = self.prompt_index[ngram_size - 1]
+            ngram_hash = self._hash_ngrams(torch.tensor([ngram], dtype=torch.long))
+            lo = torch.searchsorted(hashes, ngram_hash, side="left").item()
+            hi = torch.searchsorted(hashes, ngram_hash, side="right").item()
+            for i in range(lo, hi):
+                start_idx = first_starts[i].item()
+                # skip the ngrams which only share the hash
+                if self.token_buffer[start_idx:start_idx + ngram_size].tolist() == ngram:
+                    followers[next_tokens[i].item()] = [counts[i].item(), start_idx]
+        for next_token, (count, start_idx) in self.ngram_index[ngram_size - 1].get(
+                tuple(ngram), {}).items():
+            if next_token in followers:
+                followers[next_token][0] += count
+            else:
+                followers[next_token] = [count, start_idx]
+        return followers
+
+    def get_candidate_list(self,
+                           input_ids: torch.LongTensor,
+                           num_candidates: int = 1) -> List[torch.LongTensor]:
+        """
+        Fetches up to `num_candidates` continuations of the longest matching ngram, one per
+        distinct next token. A single candidate follows the first occurrence of the ngram,
+        several candidates are ranked by how often their next token follows the ngram (ties
+        go to the earlier occurrence).
+
+        Return:
+            A list of `torch.LongTensor` of shape `(candidate_length,)`.
+        """
+        input_length = self.num_tokens
+        max_ngram_size = min(self.max_matching_ngram_size, input_length - 1)
+        last_tokens = self.token_buffer[input_length - max_ngram_size:input_length].tolist()
+        for ngram_size in range(max_ngram_size, 0, -1):
+            followers = self._followers(last_tokens[max_ngram_size - ngram_size:])
+            if not followers:
+                continue
+            if num_candidates == 1:
+                start_indices = [min(start_idx for _, start_idx in followers.values())]
+            else:
+                ranked = sorted((-count, start_idx)
+                                for count, start_idx in followers.values())[:num_candidates]
+                start_indices = [start_idx for _, start_idx in ranked]
+            candidates = []
+            for start_idx in start_indices:
+                start_idx += ngram_size
+                end_idx = min(start_idx + self.num_output_tokens, input_length)
+                candidates.append(self.token_buffer[start_idx:end_idx].to(input_ids.device))
+            return candidates
+        return []
 
     def get_candidates(self,
                        input_ids: torch.LongTensor)-> Tuple[torch.LongTensor,
@@ -182,32 +307,16 @@ class PromptLookupCandidateGenerator():
         """
         if self.num_output_tokens == 0:
             return input_ids, None
-        input_length = input_ids.size(1)
-
-        chosen_ids = None
-        for ngram_size in range(min(self.max_matching_ngram_size, input_length - 1), 0, -1):
-            # Convert ngram to a tensor for comparison
-            ngram_tensor = input_ids[0, -ngram_size:]
 
-            # # Get the indices of matches
-            idx = self.get_n_gram_idx(ngram_tensor)
+        candidates = self.get_candidate_list(input_ids, num_candidates=1)
 
-            # Iterate through match indices to find a valid continuation
-            start_idx = idx + ngram_size
-            end_idx = start_idx + self.num_output_tokens
-            end_idx = min(end_idx, input_length)
-
-            if start_idx < end_idx:
-                chosen_ids = input_ids[0, start_idx:end_idx]
-                break
-
-        if chosen_ids is None or len(chosen_ids) == 0:
+        if len(candidates) == 0 or len(candidates[0]) == 0:
             # In case we didn't find a match return the input sequence unchanged,
             # reverts back to autoregressive decoding
             return input_ids, None
 
         # Now need extend input_ids with chosen_ids
-        chosen_ids = chosen_ids.unsqueeze(0)
+        chosen_ids = candidates[0].unsqueeze(0)
         candidate_input_ids = torch.cat((input_ids, chosen_ids), dim=1)
         # assisted_generation expects logits as well, but we don't have those here,
         # so returning None
@@ -241,17 +350,28 @@ def lookup_generate(self,
                     max_matching_ngram_size: int = None,
                     generation_config: Optional[GenerationConfig] = None,
                     attention_mask=None,
+                    draft_length_policy=None,
+                    tree_width=1,
                     **sampling_kwargs):
+    _check_tree_width(tree_width)
     input_ids, generation_config, logits_processor, stopping_criteria, \
         model_kwargs = _prepare_generate_args(self, inputs, generation_config,
                                               **sampling_kwargs)
 
     device_name = get_xpu_device_type(input_ids)
 
+    if input_ids.size(0) > 1:
+        return _batched_lookup_generate(self, input_ids, max_new_tokens, num_output_tokens,
+                                        max_matching_ngram_size, generation_config,
+                                        logits_processor, attention_mask, device_name)
+
     candidates_generator = PromptLookupCandidateGenerator(
         num_output_tokens=num_output_tokens,
         max_matching_ngram_size=max_matching_ngram_size,
         device=device_name)
+    draft_length_policy = _get_draft_length_policy(draft_length_policy,
+                                                   candidates_generator.max_candidates,
+                                                   min_draft_length=0)
 
     step = 0
     step_verify = 0
@@ -261,6 +381,9 @@ def lookup_generate(self,
 
     past_key_values = None
     input_len = input_ids.shape[1]
+    # greedy decoding may verify up to `tree_width` lookup continuations as a token tree
+    use_tree = tree_width > 1 and not generation_config.do_sample and \
+        (attention_mask is None or bool(attention_mask.all()))
 
     while True:
         if step >= max_new_tokens:
@@ -289,6 +412,7 @@ def lookup_generate(self,
             candidates_generator.init_look_up_table(input_ids)
 
             past_key_values = output['past_key_values']
+            use_tree = use_tree and _support_tree_verify(self, past_key_values)
             step += 1
             if self.device.type == 'xpu':
                 torch.xpu.synchronize()
@@ -298,51 +422,75 @@ def lookup_generate(self,
         else:
             cur_len = input_ids.shape[-1]
             toc = time.time()
-            candidate_input_ids, _ = candidates_generator.get_candidates(input_ids=input_ids)
-            candidate_length = candidate_input_ids.shape[1] - input_ids.shape[1]
-            verify_input_ids = candidate_input_ids[:, -candidate_length - 1:]
-            self.draft_num.append(candidate_length)
-            tic = time.time()
-            self.draft_time.append(tic - toc)
-            if attention_mask is None:
-                cur_attention_mask = None
-            else:
-                appended_len = verify_input_ids.size(1) + step - 1
-                ones_to_append = torch.ones(attention_mask.size(0), appended_len,
-                                            device=self.device)
-                cur_attention_mask = torch.cat((attention_mask, ones_to_append), dim=1)
-            output = _non_cpu_ipex_verify(self, verify_input_ids, past_key_values,
-                                          cur_attention_mask, return_dict=True, use_cache=True)
-            if isinstance(output, dict):
-                logits = output['logits']
-                past_key_values = output['past_key_values']
-
-            if len(logits_processor) > 0:
-                for i in range(candidate_length + 1):
-                    logits[:, i, :] = logits_processor(candidate_input_ids[:, : cur_len + i],
-                                                       logits[:, i, :])
-
-            if generation_config.do_sample:
-                output_ids, prob_list = deepmind_sample(logits,
-                                                        top_k=generation_config.top_k,
-                                                        top_p=generation_config.top_p,
-                                                        temperature=generation_config.temperature)
-                output_ids = output_ids.transpose(0, 1)
+            if draft_length_policy is not None:
+                candidates_generator.num_output_tokens = draft_length_policy.next_draft_length()
+            candidates = []
+            if use_tree and candidates_generator.num_output_tokens > 0:
+                candidates = [candidate.tolist() for candidate in
+                              candidates_generator.get_candidate_list(input_ids,
+                                                                      num_candidates=tree_width)
+                              if len(candidate) > 0]
+            if len(candidates) > 1:
+                candidate_length = max(len(candidate) for candidate in candidates)
+                self.draft_num.append(candidate_length)
+                tic = time.time()
+                self.draft_time.append(tic - toc)
+                # continuations sharing a prefix are verified once in a token tree
+                output_ids, past_key_values = _tree_verify(self, input_ids[0, -1].item(),
+                                                           candidates, past_key_values,
+                                                           input_ids, logits_processor)
+                if self.device.type == 'xpu':
+                    torch.xpu.synchronize()
+                toc = time.time()
+                self.verify_time.append(toc - tic)
+                n_matches = output_ids.size(1) - 1
             else:
-                output_ids = greedy(logits)
-
-            if self.device.type == 'xpu':
-                torch.xpu.synchronize()
-            toc = time.time()
-            self.verify_time.append(toc - tic)
-
-            # Compare drafts with target verified outputs
-            # Drafts start from [1, k]
-            # Verified output start from [0, k - 1]
-            # including the one generated by the base model
-
-            n_matches = ((output_ids[:, :-1] != verify_input_ids[:, 1:])
-                         .cumsum(-1) == 0).sum(-1).item()
+                candidate_input_ids, _ = candidates_generator.get_candidates(input_ids=input_ids)
+                candidate_length = candidate_input_ids.shape[1] - input_ids.shape[1]
+                verify_input_ids = candidate_input_ids[:, -candidate_length - 1:]
+                self.draft_num.append(candidate_length)
+                tic = time.time()
+                self.draft_time.append(tic - toc)
+                if attention_mask is None:
+                    cur_attention_mask = None
+                else:
+                    appended_len = verify_input_ids.size(1) + step - 1
+                    ones_to_append = torch.ones(attention_mask.size(0), appended_len,
+                                                device=self.device)
+                    cur_attention_mask = torch.cat((attention_mask, ones_to_append), dim=1)
+                output = _non_cpu_ipex_verify(self, verify_input_ids, past_key_values,
+                                              cur_attention_mask, return_dict=True, use_cache=True)
+                if isinstance(output, dict):
+                    logits = output['logits']
+                    past_key_values = output['past_key_values']
+
+                if len(logits_processor) > 0:
+                    for i in range(candidate_length + 1):
+                        logits[:, i, :] = logits_processor(candidate_input_ids[:, : cur_len + i],
+                                                           logits[:, i, :])
+
+                if generation_config.do_sample:
+                    output_ids, prob_list = deepmind_sample(
+                        logits,
+                        top_k=generation_config.top_k,
+                        top_p=generation_config.top_p,
+                        temperature=generation_config.temperature)
+                    output_ids = output_ids.transpose(0, 1)
+                else:
+                    output_ids = greedy(logits)
+
+                if self.device.type == 'xpu':
+                    torch.xpu.synchronize()
+                toc = time.time()
+                self.verify_time.append(toc - tic)
+
+                # Compare drafts with target verified outputs
+                # Drafts start from [1, k]
+                # Verified output start from [0, k - 1]
+                # including the one generated by the base model
+
+                n_matches = ((output_ids[:, :-1] != verify_input_ids[:, 1:])
+                             .cumsum(-1) == 0).sum(-1).item()
 
             max_matched = n_matches + 1
             mot = time.time()
@@ -364,8 +512,12 @@ def lookup_generate(self,
             accept_rate = self.n_matched/self.n_drafted if self.n_drafted > 0 else 1
             self.accept_rate.append(accept_rate)
             # Update the candidate generation strategy if needed
-            candidates_generator.update_candidate_strategy(candidate_length, n_matches,
-                                                           accept_rate)
+            if draft_length_policy is not None:
+                draft_length_policy.update(candidate_length, n_matches,
+                                           self.draft_time[-1], self.verify_time[-1])
+            else:
+                candidates_generator.update_candidate_strategy(candidate_length, n_matches,
+                                                               accept_rate)
 
             input_ids = torch.cat((input_ids, output_ids), dim=-1)
             candidates_generator.update_look_up_table(input_ids)
@@ -386,5 +538,88 @@ def lookup_generate(self,
     e2e_toc = time.time()
     self.n_token_generated = step
     self.e2e_time_without_first = e2e_toc - e2e_tic
+    if draft_length_policy is not None:
+        self.draft_length_stats = draft_length_policy.stats()
 
     return input_ids[:, : input_len + step]
+
+
+@torch.no_grad()
+def _batched_lookup_generate(self, input_ids, max_new_tokens, num_output_tokens,
+                             max_matching_ngram_size, generation_config, logits_processor,
+                             attention_mask, device_name):
+    """
+    Prompt lookup decoding for bs > 1. Each sequence has its own lookup table and
+    candidate length, all candidates are verified in one padded forward and each
+    sequence keeps its own accepted length.
+    """
+    invalidInputError(self.config.model_type not in ["chatglm", "gpt_bigcode"],
+                      f"Batched prompt lookup decoding does not support "
+                      f"{self.config.model_type} models.")
+    batch_size = input_ids.size(0)
+    outputs = _BatchedOutputs(batch_size, max_new_tokens, generation_config)
+    clear_benchmarks(self)
+    self.accept_rate = []
+
+    tic = time.time()
+    last_ids, past_key_values, attention_mask = _batched_prefill(
+        self, input_ids, attention_mask, generation_config, logits_processor)
+    all_ids = input_ids
+    candidates_generators = []
+    for idx, token_id in enumerate(last_ids.tolist()):
+        outputs.append(idx, [token_id])
+        candidates_generator = PromptLookupCandidateGenerator(
+            num_output_tokens=num_output_tokens,
+            max_matching_ngram_size=max_matching_ngram_size,
+            device=device_name)
+        # index the unpadded prompt and the first token
+        prompt_ids = input_ids[idx][attention_mask[idx].bool()]
+        candidates_generator.init_look_up_table(
+            torch.cat((prompt_ids, last_ids[idx:idx + 1])).unsqueeze(0))
+        candidates_generators.append(candidates_generator)
+    if self.device.type == 'xpu':
+        torch.xpu.synchronize()
+    self.first_token_time = time.time() - tic
+    e2e_tic = time.time()
+
+    while not outputs.all_finished():
+        tic = time.time()
+        candidates = []
+        for idx, candidates_generator in enumerate(candidates_generators):
+            candidate = last_ids.new_empty(0)
+            if not outputs.finished[idx] and candidates_generator.num_output_tokens > 0:
+                candidate_list = candidates_generator.get_candidate_list(
+                    candidates_generator.tokens.unsqueeze(0), num_candidates=1)
+                if len(candidate_list) > 0:
+                    candidate = candidate_list[0][:outputs.remaining(idx) - 1]
+            candidates.append(candidate.to(last_ids.device))
+        toc = time.time()
+        self.draft_time.append(toc - tic)
+        self.draft_num.append(max(len(c) for c in candidates))
+
+        accepted_ids, n_matches, past_key_values, attention_mask, all_ids = _batched_verify(
+            self, last_ids, candidates, past_key_values, attention_mask, all_ids,
+            generation_config, logits_processor)
+        if self.device.type == 'xpu':
+            torch.xpu.synchronize()
+        tic = time.time()
+        self.verify_time.append(tic - toc)
+
+        for idx, candidates_generator in enumerate(candidates_generators):
+            if outputs.finished[idx]:
+                continue
+            self.n_matched += n_matches[idx]
+            self.n_drafted += len(candidates[idx])
+            accept_rate = self.n_matched / self.n_drafted if self.n_drafted > 0 else 1
+            candidates_generator.update_candidate_strategy(len(candidates[idx]),
+                                                           n_matches[idx], accept_rate)
+            new_ids = outputs.append(idx, accepted_ids[idx].tolist())
+            candidates_generator.append_tokens(new_ids)
+        self.accept_num.append(max(n_matches) + 1)
+        self.accept_rate.append(self.n_matched / self.n_drafted if self.n_drafted > 0 else 1)
+        last_ids = torch.stack([ids[-1] for ids in accepted_ids])
+        self.post_time.append(time.time() - tic)
+
+    self.n_token_generated = max(len(tokens) for tokens in outputs.tokens)
+    self.e2e_time_without_first = time.time() - e2e_tic
+    return outputs.to_tensor(input_ids)
@@ -50,7 +50,7 @@ from ipex_llm.ggml.quantize import ggml_tensor_qtype, gguf_mixed_qtype
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.transformers.gguf.api import load_gguf_model
 
-from .utils import logger, load_state_dict
+from .utils import logger, load_state_dict, load_state_dicts
 from .utils import extract_local_archive_file, get_local_shard_files, load_imatrix_data
 
 patched_training_mode = None
@@ -67,7 +67,8 @@ def save_low_bit(self, *args, **kwargs):
     origin_device = self.device
     self.to('cpu')
 
-    kwargs['safe_serialization'] = False
+    # safetensors checkpoints are mmap-ed and loaded zero-copy by `load_low_bit`
+    kwargs.setdefault('safe_serialization', True)
 
     architectures = getattr(self.config, "architectures", None)
     model_type = getattr(self.config, "model_type", None)
@@ -89,6 +90,9 @@ def save_low_bit(self, *args, **kwargs):
     # it's not necessary to load the entire model to extract its keys
     # and we can avoid gc not triggered potentially.
     load_keys = {"all_checkpoint_keys": list(self.state_dict().keys())}
+    # also keep the qtype of each low-bit weight, to validate the model built by `load_low_bit`
+    load_keys["ggml_qtypes"] = {name: param.qtype for name, param in self.named_parameters()
+                                if getattr(param, "qtype", None) is not None}
     with open(os.path.join(args[0], "load_keys.json"), "w") as json_file:
         json.dump(load_keys, json_file)
     if origin_device != 'cpu':
@@ -159,7 +163,16 @@ class _BaseAutoModelClass:
             load_in_low_bit is sym_int4 or asym_int4.
         :param pipeline_parallel_stages: int value, the number of GPUs allocated for
             pipeline parallel. Default to be ``1``. Please set pipeline_parallel_stages > 1
-            to run pipeline parallel inference on multiple GPUs.
+            to run pipeline parallel inference on multiple GPUs, or on multiple NUMA nodes
+            of CPU after ``init_pipeline_parallel(device="cpu")``.
+        :param pipeline_parallel_partition: how decoder layers are split into pipeline stages.
+            Default to be ``None``, i.e. an even split. It could be ``"balanced"`` to balance
+            the weight size of stages (including embedding and lm_head), the path of a
+            json profile saved by setting ``IPEX_LLM_PP_PROFILE`` to balance the measured
+            latency of stages, or a list with the number of layers of each stage.
+        :param pipeline_parallel_stage_speeds: list of relative speeds of the devices of each
+            stage, used together with ``pipeline_parallel_partition``. Default to be ``None``,
+            i.e. all devices run at the same speed.
         :return: a model instance
         """
         pretrained_model_name_or_path = kwargs.get("pretrained_model_name_or_path", None) \
@@ -194,6 +207,8 @@ class _BaseAutoModelClass:
         user_quantization_config = kwargs.pop("quantization_config", None)
         speculative = kwargs.pop("speculative", False)
         pipeline_parallel_stages = kwargs.pop("pipeline_parallel_stages", 1)
+        pipeline_parallel_partition = kwargs.pop("pipeline_parallel_partition", None)
+        pipeline_parallel_stage_speeds = kwargs.pop("pipeline_parallel_stage_speeds", None)
         torch_dtype = kwargs.pop("torch_dtype", None)
         embedding_qtype = kwargs.pop("embedding_qtype", None)
 
@@ -359,7 +374,9 @@ class _BaseAutoModelClass:
                                   "Please make sure you've called `init_pipeline_parallel()` "
                                   "and world size is the same as `pipeline_parallel_stages`")
                 from .pipeline_parallel import pipeline_parallel, pipeline_parallel_generate
-                model = pipeline_parallel(model, pipeline_parallel_stages)
+                model = pipeline_parallel(model, pipeline_parallel_stages,
+                                          pipeline_parallel_partition,
+                                          pipeline_parallel_stage_speeds)
                 import types
                 # add pipeline_parallel_generate to pretrained model dynamically
                 model.pipeline_parallel_generate = types.MethodType(pipeline_parallel_generate,
@@ -381,6 +398,9 @@ class _BaseAutoModelClass:
             from .lookup import lookup_generate
             import types
             model.lookup_generate = types.MethodType(lookup_generate, model)
+            # patch generate to reuse `model.prefix_cache` when it is set
+            from .prefix_cache import patch_generate
+            patch_generate()
         else:
             # load default
             model = cls.HF_Model.from_pretrained(*args, **kwargs)
@@ -536,7 +556,24 @@ class _BaseAutoModelClass:
                                Default to be True.
         :param pipeline_parallel_stages: int value, the number of GPUs allocated for
             pipeline parallel. Default to be ``1``. Please set pipeline_parallel_stages > 1
-            to run pipeline parallel inference on multiple GPUs.
+            to run pipeline parallel inference on multiple GPUs, or on multiple NUMA nodes
+            of CPU after ``init_pipeline_parallel(device="cpu")``.
+        :param pipeline_parallel_partition: how decoder layers are split into pipeline stages.
+            Default to be ``None``, i.e. an even split. It could be ``"balanced"`` to balance
+            the weight size of stages (including embedding and lm_head), the path of a
+            json profile saved by setting ``IPEX_LLM_PP_PROFILE`` to balance the measured
+            latency of stages, or a list with the number of layers of each stage.
+        :param pipeline_parallel_stage_speeds: list of relative speeds of the devices of each
+            stage, used together with ``pipeline_parallel_partition``. Default to be ``None``,
+            i.e. all devices run at the same speed.
+        :param moe_offload_experts: int value, the number of experts of a MoE model kept in
+            RAM on CPU, the other experts are read from the mmap-ed safetensors checkpoint
+            when selected. Default to be ``0``, i.e. all experts are loaded into RAM.
+        :param moe_cache_policy: str value, how to evict experts from RAM when
+            ``moe_offload_experts > 0``, ``'lru'`` (least recently used) or ``'frequency'``
+            (least often selected by the router). Default to be ``'lru'``.
+        :param moe_prefetch: boolean value, whether to prefetch the experts of the next layer
+            selected by its router when ``moe_offload_experts > 0``. Default to be ``True``.
 
         :return: a model instance
         """
@@ -584,6 +621,11 @@ class _BaseAutoModelClass:
         sharded_metadata = None
 
         pipeline_parallel_stages = kwargs.pop("pipeline_parallel_stages", 1)
+        pipeline_parallel_partition = kwargs.pop("pipeline_parallel_partition", None)
+        pipeline_parallel_stage_speeds = kwargs.pop("pipeline_parallel_stage_speeds", None)
+        moe_offload_experts = kwargs.pop("moe_offload_experts", 0)
+        moe_cache_policy = kwargs.pop("moe_cache_policy", "lru")
+        moe_prefetch = kwargs.pop("moe_prefetch", True)
 
         config_dict, _ = PretrainedConfig.get_config_dict(pretrained_model_name_or_path)
         bigdl_transformers_low_bit = config_dict.pop("bigdl_transformers_low_bit", False)
@@ -697,41 +739,70 @@ class _BaseAutoModelClass:
                                      cpu_embedding=cpu_embedding, lightweight_bmm=lightweight_bmm,
                                      embedding_qtype=embedding_qtype, torch_dtype=torch_dtype)
 
+        import json
+        load_keys_path = os.path.join(pretrained_model_name_or_path, "load_keys.json")
+        loaded_data = {}
+        if not is_sharded or os.path.isfile(load_keys_path):
+            with open(load_keys_path, "r") as json_file:
+                loaded_data = json.load(json_file)
         if is_sharded:
             loaded_state_dict_keys = sharded_metadata["all_checkpoint_keys"]
         else:
-            import os
-            import json
-            with open(os.path.join(pretrained_model_name_or_path,
-                                   "load_keys.json"), "r") as json_file:
-                loaded_data = json.load(json_file)
             loaded_state_dict_keys = loaded_data["all_checkpoint_keys"]
 
+        for name, param in model.named_parameters():
+            saved_qtype = loaded_data.get("ggml_qtypes", {}).get(name, None)
+            param_qtype = getattr(param, "qtype", None)
+            invalidInputError(saved_qtype is None or saved_qtype == param_qtype,
+                              f"{name} is saved with qtype {saved_qtype}, "
+                              f"but got {param_qtype} when loading.")
+
+        archive_files = resolved_archive_file if is_sharded else [resolved_archive_file]
+        invalidInputError(moe_offload_experts == 0 or
+                          all(f.endswith(".safetensors") for f in archive_files),
+                          "moe_offload_experts requires a safetensors checkpoint, please save"
+                          " the model again by save_low_bit")
+        if all(f.endswith(".safetensors") for f in archive_files):
+            # mmap all safetensors shards in parallel, `_load_pretrained_model` then
+            # attaches the zero-copy views as parameters instead of reading each shard,
+            # offloaded experts are only read on use
+            state_dicts = dict(zip(archive_files,
+                                   load_state_dicts(archive_files,
+                                                    read_ahead=moe_offload_experts == 0)))
+
+            def load_shard(checkpoint_file, *args, **kwargs):
+                if checkpoint_file in state_dicts:
+                    return state_dicts.pop(checkpoint_file)
+                return load_state_dict(checkpoint_file)
+        else:
+            load_shard = transformers.modeling_utils.load_state_dict
+
         # restore default dtype
         if dtype_orig is not None:
             torch.set_default_dtype(dtype_orig)
 
-        (
-            model,
-            missing_keys,
-            unexpected_keys,
-            mismatched_keys,
-            offload_index,
-            error_msgs,
-        ) = model_class._load_pretrained_model(
-            model,
-            None,
-            loaded_state_dict_keys,  # XXX: rename?
-            resolved_archive_file,
-            pretrained_model_name_or_path,
-            sharded_metadata=sharded_metadata,
-            _fast_init=False,  # always false to avoid pre-init behaviors
-            low_cpu_mem_usage=bigdl_lcmu_enabled,
-            offload_folder=offload_folder,
-            offload_state_dict=offload_state_dict,
-            dtype=torch_dtype,
-            keep_in_fp32_modules=[],
-        )
+        with patch("transformers.modeling_utils.load_state_dict", load_shard):
+            (
+                model,
+                missing_keys,
+                unexpected_keys,
+                mismatched_keys,
+                offload_index,
+                error_msgs,
+            ) = model_class._load_pretrained_model(
+                model,
+                None,
+                loaded_state_dict_keys,  # XXX: rename?
+                resolved_archive_file,
+                pretrained_model_name_or_path,
+                sharded_metadata=sharded_metadata,
+                _fast_init=False,  # always false to avoid pre-init behaviors
+                low_cpu_mem_usage=bigdl_lcmu_enabled,
+                offload_folder=offload_folder,
+                offload_state_dict=offload_state_dict,
+                dtype=torch_dtype,
+                keep_in_fp32_modules=[],
+            )
 
         # make sure token embedding weights are still tied if needed
         model.tie_weights()
@@ -756,9 +827,15 @@ class _BaseAutoModelClass:
         if model.config.model_type == "rwkv":
             model.rwkv.layers_are_rescaled = True
 
+        if moe_offload_experts > 0:
+            from .moe_offload import offload_moe_experts
+            offload_moe_experts(model, moe_offload_experts, moe_cache_policy, moe_prefetch)
+
         if pipeline_parallel_stages > 1:
             from .pipeline_parallel import pipeline_parallel, pipeline_parallel_generate
-            model = pipeline_parallel(model, pipeline_parallel_stages)
+            model = pipeline_parallel(model, pipeline_parallel_stages,
+                                      pipeline_parallel_partition,
+                                      pipeline_parallel_stage_speeds)
             import types
             # add pipeline_parallel_generate to pretrained model dynamically
             model.pipeline_parallel_generate = types.MethodType(pipeline_parallel_generate,
@@ -48,7 +48,8 @@ from ipex_llm.transformers.models.utils import is_enough_kv_cache_room_4_31, \
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb_no_cache_xpu
 from ipex_llm.transformers.models.utils import use_flash_attention, use_sdp, use_sdp_fp8
 from ipex_llm.transformers.models.utils import mlp_fusion_check, fp16_fusion_check
-from ipex_llm.transformers.models.utils import use_decoding_fast_path
+from ipex_llm.transformers.models.utils import use_decoding_fast_path, use_paged_kv_cache, \
+    use_cpu_quantize_kv_cache
 from transformers.modeling_outputs import BaseModelOutputWithPast
 from transformers.models.llama.modeling_llama import LlamaModel
 from ipex_llm.transformers.low_bit_linear import SYM_INT4, FP8E5, IQ2_XXS, FP4
@@ -113,12 +114,18 @@ def llama_model_forward_4_36(
     output_hidden_states: Optional[bool] = None,
     return_dict: Optional[bool] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
-    from ipex_llm.transformers.kv import DynamicFp8Cache
+    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, \
+        get_normal_cache_cls
     use_cache = use_cache if use_cache is not None else self.config.use_cache
     input = input_ids if input_ids is not None else inputs_embeds
     if use_cache and use_quantize_kv_cache(self.layers[0].mlp.up_proj, input):
         if not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
+    elif use_cache and (use_cpu_quantize_kv_cache(input) or use_paged_kv_cache(input)):
+        # the int8 or paged kv cache on CPU, a `DynamicSinkCache` is kept as it is
+        if not isinstance(past_key_values, DynamicNormalCache):
+            cache_cls = get_normal_cache_cls(input)
+            past_key_values = cache_cls.from_legacy_cache(past_key_values)
     return llama_model_forward_4_36_internal(
         self=self,
         input_ids=input_ids,
@@ -146,12 +153,18 @@ def llama_model_forward_4_38(
     return_dict: Optional[bool] = None,
     cache_position: Optional[torch.LongTensor] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
-    from ipex_llm.transformers.kv import DynamicFp8Cache
+    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, \
+        get_normal_cache_cls
     use_cache = use_cache if use_cache is not None else self.config.use_cache
     input = input_ids if input_ids is not None else inputs_embeds
     if use_cache and use_quantize_kv_cache(self.layers[0].mlp.up_proj, input):
         if not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
+    elif use_cache and (use_cpu_quantize_kv_cache(input) or use_paged_kv_cache(input)):
+        # the int8 or paged kv cache on CPU, a `DynamicSinkCache` is kept as it is
+        if not isinstance(past_key_values, DynamicNormalCache):
+            cache_cls = get_normal_cache_cls(input)
+            past_key_values = cache_cls.from_legacy_cache(past_key_values)
     return llama_model_forward_4_38_internal(
         self=self,
         input_ids=input_ids,
@@ -180,12 +193,18 @@ def llama_model_forward_4_41(
     return_dict: Optional[bool] = None,
     cache_position: Optional[torch.LongTensor] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
-    from ipex_llm.transformers.kv import DynamicFp8Cache
+    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, \
+        get_normal_cache_cls
     use_cache = use_cache if use_cache is not None else self.config.use_cache
     input = input_ids if input_ids is not None else inputs_embeds
     if use_cache and use_quantize_kv_cache(self.layers[0].mlp.up_proj, input):
         if not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
+    elif use_cache and (use_cpu_quantize_kv_cache(input) or use_paged_kv_cache(input)):
+        # the int8 or paged kv cache on CPU, a `DynamicSinkCache` is kept as it is
+        if not isinstance(past_key_values, DynamicNormalCache):
+            cache_cls = get_normal_cache_cls(input)
+            past_key_values = cache_cls.from_legacy_cache(past_key_values)
     return llama_model_forward_4_41_internal(
         self=self,
         input_ids=input_ids,
@@ -1264,6 +1283,8 @@ def llama_attention_forward_4_41_original(
     device = hidden_states.device
     # for flash attention
     original_dtype = hidden_states.dtype
+    from ipex_llm.transformers.kv import DynamicSinkCache, DynamicQuantizedCache, \
+        DynamicPagedCache
 
     use_fuse_rope = should_use_fuse_rope(self, hidden_states, position_ids)
     enough_kv_room = is_enough_kv_cache_room_4_36(past_key_value, self.layer_idx, seq_len=q_len)
@@ -1401,7 +1422,11 @@ def llama_attention_forward_4_41_original(
                 query_states, key_states = apply_rotary_pos_emb(query_states, key_states,
                                                                 cos, sin, position_ids, "llama")
 
-        if past_key_value is not None:
+        if isinstance(past_key_value, DynamicSinkCache):
+            key_states, value_states = past_key_value.update(key_states, value_states,
+                                                             self.layer_idx)
+        elif past_key_value is not None and \
+                not isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
             # update the number of seen tokens
             if self.layer_idx == 0:
                 past_key_value._seen_tokens += key_states.shape[-2]
@@ -1445,7 +1470,12 @@ def llama_attention_forward_4_41_original(
     else:
         new_attention_mask = attention_mask
 
-    if not self.training and not hidden_states.requires_grad and \
+    if isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
+        # append the new kv and attend over the paged or int8 kv without gathering it
+        attn_output = past_key_value.attention(query_states, key_states, value_states,
+                                               self.layer_idx, new_attention_mask)
+        attn_weights = None
+    elif not self.training and not hidden_states.requires_grad and \
             use_flash_attention(query_states, key_states, new_attention_mask):
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups)
@@ -1788,6 +1818,8 @@ def llama_attention_forward_4_38_original(
     device = hidden_states.device
     # for flash attention
     original_dtype = hidden_states.dtype
+    from ipex_llm.transformers.kv import DynamicSinkCache, DynamicQuantizedCache, \
+        DynamicPagedCache
 
     use_fuse_rope = should_use_fuse_rope(self, hidden_states, position_ids)
     enough_kv_room = is_enough_kv_cache_room_4_36(past_key_value, self.layer_idx, seq_len=q_len)
@@ -1925,7 +1957,11 @@ def llama_attention_forward_4_38_original(
                 query_states, key_states = apply_rotary_pos_emb(query_states, key_states,
                                                                 cos, sin, position_ids, "llama")
 
-        if past_key_value is not None:
+        if isinstance(past_key_value, DynamicSinkCache):
+            key_states, value_states = past_key_value.update(key_states, value_states,
+                                                             self.layer_idx)
+        elif past_key_value is not None and \
+                not isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
             # update the number of seen tokens
             if self.layer_idx == 0:
                 past_key_value.seen_tokens += key_states.shape[-2]
@@ -1968,7 +2004,12 @@ def llama_attention_forward_4_38_original(
     else:
         new_attention_mask = attention_mask
 
-    if not self.training and not hidden_states.requires_grad and \
+    if isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
+        # append the new kv and attend over the paged or int8 kv without gathering it
+        attn_output = past_key_value.attention(query_states, key_states, value_states,
+                                               self.layer_idx, new_attention_mask)
+        attn_weights = None
+    elif not self.training and not hidden_states.requires_grad and \
             use_flash_attention(query_states, key_states, new_attention_mask):
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups)
@@ -53,7 +53,8 @@ from ipex_llm.transformers.models.utils import is_enough_kv_cache_room_4_31, \
     is_enough_kv_cache_room_4_36
 from ipex_llm.transformers.low_bit_linear import SYM_INT4, FP8E5, IQ2_XXS
 from ipex_llm.transformers.models.utils import use_flash_attention, use_sdp, use_sdp_fp8
-from ipex_llm.transformers.models.utils import use_decoding_fast_path
+from ipex_llm.transformers.models.utils import use_decoding_fast_path, use_paged_kv_cache, \
+    use_cpu_quantize_kv_cache
 from ipex_llm.transformers.models.llama import llama_decoding_fast_path_qtype_check
 from ipex_llm.transformers.models.llama import should_use_xetla_mm_qkv
 from ipex_llm.transformers.models.llama import fuse_qkv_weight_xetla
@@ -200,11 +201,17 @@ def mistral_model_forward_4_36(
     output_hidden_states: Optional[bool] = None,
     return_dict: Optional[bool] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
-    from ipex_llm.transformers.kv import DynamicFp8Cache
+    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, \
+        get_normal_cache_cls
     use_cache = use_cache if use_cache is not None else self.config.use_cache
     if use_cache and use_quantize_kv_cache(self.layers[0].mlp.up_proj, input_ids):
         if not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
+    elif use_cache and (use_cpu_quantize_kv_cache(input_ids) or use_paged_kv_cache(input_ids)):
+        # the int8 or paged kv cache on CPU, a `DynamicSinkCache` is kept as it is
+        if not isinstance(past_key_values, DynamicNormalCache):
+            cache_cls = get_normal_cache_cls(input_ids)
+            past_key_values = cache_cls.from_legacy_cache(past_key_values)
     return MistralModel.forward(
         self=self,
         input_ids=input_ids,
@@ -887,6 +894,8 @@ def mistral_attention_forward_4_36_original(
     device = hidden_states.device
     # for flash attention
     original_dtype = hidden_states.dtype
+    from ipex_llm.transformers.kv import DynamicSinkCache, DynamicQuantizedCache, \
+        DynamicPagedCache
 
     use_fuse_rope = should_use_fuse_rope(self, hidden_states, position_ids)
     enough_kv_room = is_enough_kv_cache_room_4_36(past_key_value, self.layer_idx)
@@ -972,7 +981,11 @@ def mistral_attention_forward_4_36_original(
             query_states, key_states = apply_rotary_pos_emb(query_states, key_states,
                                                             cos, sin, position_ids, "mistral")
 
-        if past_key_value is not None:
+        if isinstance(past_key_value, DynamicSinkCache):
+            key_states, value_states = past_key_value.update(key_states, value_states,
+                                                             self.layer_idx)
+        elif past_key_value is not None and \
+                not isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
             # update the number of seen tokens
             if self.layer_idx == 0:
                 past_key_value.seen_tokens += key_states.shape[-2]
@@ -1017,7 +1030,14 @@ def mistral_attention_forward_4_36_original(
     else:
         attention_dtype = original_dtype
 
-    if fsdp_flag:
+    if isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
+        # append the new kv and attend over the paged or int8 kv without gathering it
+        attn_output = past_key_value.attention(query_states, key_states, value_states,
+                                               self.layer_idx, attention_mask)
+        attn_weights = None
+        attn_output = attn_output.transpose(1, 2).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+    elif fsdp_flag:
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups).to(device,
                                                                          dtype=attention_dtype)
@@ -1116,6 +1136,8 @@ def mistral_attention_forward_4_39_original(
     device = hidden_states.device
     # for flash attention
     original_dtype = hidden_states.dtype
+    from ipex_llm.transformers.kv import DynamicSinkCache, DynamicQuantizedCache, \
+        DynamicPagedCache
 
     use_fuse_rope = should_use_fuse_rope(self, hidden_states, position_ids)
     enough_kv_room = is_enough_kv_cache_room_4_36(past_key_value, self.layer_idx)
@@ -1201,7 +1223,11 @@ def mistral_attention_forward_4_39_original(
             query_states, key_states = apply_rotary_pos_emb(query_states, key_states,
                                                             cos, sin, position_ids, "mistral")
 
-        if past_key_value is not None:
+        if isinstance(past_key_value, DynamicSinkCache):
+            key_states, value_states = past_key_value.update(key_states, value_states,
+                                                             self.layer_idx)
+        elif past_key_value is not None and \
+                not isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
             # update the number of seen tokens
             if self.layer_idx == 0:
                 past_key_value._seen_tokens += key_states.shape[-2]
@@ -1246,7 +1272,14 @@ def mistral_attention_forward_4_39_original(
     else:
         attention_dtype = original_dtype
 
-    if fsdp_flag:
+    if isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
+        # append the new kv and attend over the paged or int8 kv without gathering it
+        attn_output = past_key_value.attention(query_states, key_states, value_states,
+                                               self.layer_idx, attention_mask)
+        attn_weights = None
+        attn_output = attn_output.transpose(1, 2).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+    elif fsdp_flag:
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups).to(device,
                                                                          dtype=attention_dtype)
@@ -57,6 +57,7 @@ from ipex_llm.transformers.models.mistral import should_use_fuse_rope
 from ipex_llm.transformers.models.utils import use_decoding_fast_path
 from ipex_llm.transformers.models.utils import use_flash_attention, use_sdp
 from ipex_llm.transformers.models.utils import mlp_fusion_check, SILU
+from ipex_llm.transformers.models.utils import moe_group_forward
 from ipex_llm.transformers.low_bit_linear import IQ2_XXS
 
 import os
@@ -119,6 +120,11 @@ def mixtral_moeblock_forward(self,
             current_hidden_states = expert_layer(current_state,
                                                  routing_weights[top_x_list, idx_list, None])
             final_hidden_states.index_add_(0, top_x, current_hidden_states.to(hidden_states.dtype))
+    elif hidden_states.device.type == 'cpu':
+        final_hidden_states = moe_group_forward(
+            hidden_states, selected_experts, routing_weights, self.num_experts,
+            lambda expert_idx, x, weights: self.experts[expert_idx](x, weights)
+        )
     else:
         final_hidden_states = torch.zeros(
             (batch_size * sequence_length, hidden_dim),
@@ -42,7 +42,8 @@ from ipex_llm.transformers.models.utils import (
 from ipex_llm.transformers.models.utils import mlp_fusion_check, SILU
 from ipex_llm.transformers.models.utils import use_sdp, use_sdp_causal
 from ipex_llm.transformers.models.utils import use_quantize_kv_cache, restore_fp8_kv_cache
-from ipex_llm.transformers.kv import DynamicNormalCache, DynamicFp8Cache
+from ipex_llm.transformers.kv import DynamicNormalCache, DynamicFp8Cache, DynamicPagedCache, \
+    DynamicQuantizedCache, get_normal_cache_cls
 
 from typing import Optional, Tuple, List
 from transformers.models.phi.modeling_phi import repeat_kv
@@ -127,11 +128,17 @@ def attention_forward(
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states,
                                                         cos, sin, position_ids)
 
-    if past_key_value is not None:
+    if past_key_value is not None and \
+            not isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
         key_states, value_states = past_key_value.update(key_states, value_states,
                                                          self.layer_idx, None)
 
-    if use_sdp(q_len, kv_seq_len, self.head_dim, query_states):
+    if isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
+        # append the new kv and attend over the paged or int8 kv without gathering it
+        attn_output = past_key_value.attention(query_states, key_states, value_states,
+                                               self.layer_idx, attention_mask)
+        attn_weights = None
+    elif use_sdp(q_len, kv_seq_len, self.head_dim, query_states):
         import xe_addons
         if isinstance(past_key_value, DynamicFp8Cache):
             attn_output = xe_addons.sdp_fp8(query_states, key_states, value_states,
@@ -240,7 +247,8 @@ def phi3_model_forward_wrapper(origin_model_forward):
             if use_quantize_kv and not isinstance(past_key_values, DynamicFp8Cache):
                 past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
             if not use_quantize_kv and not isinstance(past_key_values, DynamicNormalCache):
-                past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
+                cache_cls = get_normal_cache_cls(input)
+                past_key_values = cache_cls.from_legacy_cache(past_key_values)
         return origin_model_forward(
             self=self,
             input_ids=input_ids,
@@ -278,7 +286,8 @@ def phi3v_model_forward_wrapper(origin_model_forward):
             if use_quantize_kv and not isinstance(past_key_values, DynamicFp8Cache):
                 past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
             if not use_quantize_kv and not isinstance(past_key_values, DynamicNormalCache):
-                past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
+                cache_cls = get_normal_cache_cls(input_ids)
+                past_key_values = cache_cls.from_legacy_cache(past_key_values)
         return origin_model_forward(
             self=self,
             input_ids=input_ids,
@@ -47,7 +47,8 @@ from torch.nn.functional import scaled_dot_product_attention as sdpa
 from ipex_llm.transformers.models.utils import should_use_fuse_rope
 from ipex_llm.transformers.models.utils import use_quantize_kv_cache, restore_fp8_kv_cache
 from ipex_llm.transformers.models.utils import use_flash_attention, use_sdp, use_sdp_causal
-from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache
+from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, DynamicPagedCache, \
+    DynamicQuantizedCache, get_normal_cache_cls
 from ipex_llm.utils.common import invalidInputError
 
 from transformers.models.qwen2.modeling_qwen2 import Qwen2Attention, Qwen2MLP
@@ -84,7 +85,8 @@ def qwen2_model_forward(
         if use_quantize_kv and not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
         if not use_quantize_kv and not isinstance(past_key_values, DynamicNormalCache):
-            past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
+            cache_cls = get_normal_cache_cls(input)
+            past_key_values = cache_cls.from_legacy_cache(past_key_values)
     return qwen2_model_forward_internal(
         self=self,
         input_ids=input_ids,
@@ -452,12 +454,17 @@ def qwen2_attention_forward(
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states,
                                                         cos, sin, position_ids)
 
-    if past_key_value is not None:
+    if past_key_value is not None and \
+            not isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
         key_states, value_states = past_key_value.update(key_states, value_states,
                                                          self.layer_idx, None)
 
     attn_weights = None
-    if query_states.device.type == "cpu":
+    if isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
+        # append the new kv and attend over the paged or int8 kv without gathering it
+        attn_output = past_key_value.attention(query_states, key_states, value_states,
+                                               self.layer_idx, attention_mask)
+    elif query_states.device.type == "cpu":
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
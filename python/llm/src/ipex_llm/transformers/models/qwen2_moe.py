@@ -43,8 +43,8 @@ import torch.utils.checkpoint
 from torch.nn import CrossEntropyLoss
 from typing import Optional, Tuple, Union, List
 from ipex_llm.utils.common import invalidInputError
-from ipex_llm.transformers.models.utils import use_quantize_kv_cache
-from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache
+from ipex_llm.transformers.models.utils import use_quantize_kv_cache, moe_group_forward
+from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, get_normal_cache_cls
 
 from transformers.models.qwen2_moe.modeling_qwen2_moe import (
     _prepare_4d_causal_attention_mask_for_sdpa, _prepare_4d_causal_attention_mask,
@@ -78,7 +78,8 @@ def qwen2moe_model_forward(
         if use_quantize_kv and not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
         if not use_quantize_kv and not isinstance(past_key_values, DynamicNormalCache):
-            past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
+            cache_cls = get_normal_cache_cls(input)
+            past_key_values = cache_cls.from_legacy_cache(past_key_values)
     return qwen2_moe_model_forward_internal(
         self=self,
         input_ids=input_ids,
@@ -430,6 +431,11 @@ def qwen2moe_moeblock_forward(self, hidden_states: torch.Tensor):
             current_hidden_states = expert_layer(current_state) * \
                 routing_weights[top_x_list, idx_list, None]
             final_hidden_states.index_add_(0, top_x, current_hidden_states.to(hidden_states.dtype))
+    elif hidden_states.device.type == 'cpu':
+        final_hidden_states = moe_group_forward(
+            hidden_states, selected_experts, routing_weights, self.num_experts,
+            lambda expert_idx, x, weights: self.experts[expert_idx](x) * weights
+        )
     else:
         final_hidden_states = torch.zeros(
             (batch_size * sequence_length, hidden_dim),
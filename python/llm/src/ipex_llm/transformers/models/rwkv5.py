@@ -119,6 +119,69 @@ def rwkv_linear_attention_xpu(
     return out
 
 
+RWKV_CHUNK_SIZE = 16
+
+
+def rwkv_linear_attention_chunked(
+    B,
+    H,
+    S,
+    T,
+    n_head,
+    time_decay,
+    time_first,
+    receptance,
+    key,
+    value,
+    state,
+    chunk_size=RWKV_CHUNK_SIZE,
+):
+    """
+    Chunked form of the rwkv5 recurrence, gives the same results as running
+    `out_t = r_t @ (u * k_t^T v_t + s_t)` and `s_{t+1} = k_t^T v_t + w * s_t` token by token.
+
+    Inside a chunk starting with state `s`, token t attends to the earlier tokens j of the chunk
+    with the weights `sum_c r_t[c] * w[c]^(t-1-j) * k_j[c]`, so a chunk takes a few matmuls
+    instead of `chunk_size` serial steps. All decay exponents are non-negative, which keeps
+    the chunked form as stable as the recurrence.
+    """
+    receptance = receptance.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+    key = key.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+    value = value.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+    # log(w) of the decay w = exp(-exp(time_decay)), [H, S]
+    log_decay = -torch.exp(time_decay.float()).reshape(n_head, -1)
+    time_first = time_first.float().reshape(n_head, 1, -1)
+    if state is None:
+        state = key.new_zeros(B, H, S, S)
+
+    # the decays only depend on the distance between tokens, so they are shared by all chunks
+    chunk_size = min(chunk_size, T)
+    pos = torch.arange(chunk_size, dtype=torch.float32, device=key.device)
+    # w^(t-1-j) between tokens of a chunk, masked to j < t, [H, C, C, S]
+    dist = pos.view(-1, 1) - pos.view(1, -1) - 1
+    chunk_decay = torch.exp(dist.clamp(min=0).view(1, chunk_size, chunk_size, 1) *
+                            log_decay.view(H, 1, 1, S))
+    chunk_decay = chunk_decay * (dist >= 0).view(1, chunk_size, chunk_size, 1)
+    # w^t from the chunk start to token t, [H, C, S]
+    decay_in = torch.exp(pos.view(1, -1, 1) * log_decay.view(H, 1, S))
+
+    out = torch.empty_like(value)
+    for start in range(0, T, chunk_size):
+        rc = receptance[:, :, start:start + chunk_size]
+        kc = key[:, :, start:start + chunk_size]
+        vc = value[:, :, start:start + chunk_size]
+        C = rc.size(2)
+        attn = torch.einsum("bhtc,bhjc,htjc->bhtj", rc, kc, chunk_decay[:, :C, :C])
+        bonus = (rc * time_first * kc).sum(-1, keepdim=True)
+        out[:, :, start:start + C] = attn @ vc + bonus * vc + (rc * decay_in[:, :C]) @ state
+        # w^(C-1-j) from token j to the chunk end
+        decay_out = decay_in[:, :C].flip(1)
+        state = torch.exp(C * log_decay).view(H, S, 1) * state + \
+            (kc * decay_out).transpose(-2, -1) @ vc
+
+    return out.transpose(1, 2), state
+
+
 def rwkv_linear_attention_cpu(
     B,
     H,
@@ -137,22 +200,27 @@ def rwkv_linear_attention_cpu(
     ow,
     state,
 ):
-    key = key.to(torch.float32).view(B, T, H, S).transpose(1, 2).transpose(-2, -1)
-    value = value.to(torch.float32).view(B, T, H, S).transpose(1, 2)
-    receptance = receptance.to(torch.float32).view(B, T, H, S).transpose(1, 2)
-    time_decay = torch.exp(-torch.exp(time_decay.float())).reshape(-1, 1, 1).reshape(n_head, -1, 1)
-    time_first = time_first.float().reshape(-1, 1, 1).reshape(n_head, -1, 1)
     lxw = lxw.float()
     lxb = lxb.float()
-    out = torch.zeros_like(key).reshape(B, T, H, S)
-    for t in range(T):
-        rt = receptance[:, :, t:t + 1, :]
-        kt = key[:, :, :, t:t + 1]
-        vt = value[:, :, t:t + 1, :]
-        at = kt @ vt
-        out[:, t] = (rt @ (time_first * at + state)).squeeze(2)
-        with torch.no_grad():
-            state = at + time_decay * state
+    if T > 1:
+        out, state = rwkv_linear_attention_chunked(B, H, S, T, n_head, time_decay, time_first,
+                                                   receptance, key, value, state)
+    else:
+        key = key.to(torch.float32).view(B, T, H, S).transpose(1, 2).transpose(-2, -1)
+        value = value.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+        receptance = receptance.to(torch.float32).view(B, T, H, S).transpose(1, 2)
+        time_decay = torch.exp(-torch.exp(time_decay.float())).reshape(-1, 1, 1)\
+            .reshape(n_head, -1, 1)
+        time_first = time_first.float().reshape(-1, 1, 1).reshape(n_head, -1, 1)
+        out = torch.zeros_like(key).reshape(B, T, H, S)
+        for t in range(T):
+            rt = receptance[:, :, t:t + 1, :]
+            kt = key[:, :, :, t:t + 1]
+            vt = value[:, :, t:t + 1, :]
+            at = kt @ vt
+            out[:, t] = (rt @ (time_first * at + state)).squeeze(2)
+            with torch.no_grad():
+                state = at + time_decay * state
 
     out = out.reshape(B * T, H * S)
     out = F.group_norm(out, num_groups=H, weight=lxw, bias=lxb).reshape(B, T, H * S)
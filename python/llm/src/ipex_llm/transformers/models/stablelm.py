@@ -50,7 +50,8 @@ from ipex_llm.transformers.models.utils import apply_rotary_pos_emb, \
 from ipex_llm.transformers.models.utils import use_sdp, use_sdp_causal
 from ipex_llm.transformers.models.utils import restore_fp8_kv_cache, use_quantize_kv_cache
 from ipex_llm.transformers.models.utils import should_use_fuse_rope
-from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache
+from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, DynamicPagedCache, \
+    DynamicQuantizedCache, get_normal_cache_cls
 
 
 def merge_qkv(module: torch.nn.Module):
@@ -99,7 +100,8 @@ def stablelm_model_forward(
         if use_quantize_kv and not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
         if not use_quantize_kv and not isinstance(past_key_values, DynamicNormalCache):
-            past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
+            cache_cls = get_normal_cache_cls(input_ids)
+            past_key_values = cache_cls.from_legacy_cache(past_key_values)
     return StableLmModel.forward(
         self=self,
         input_ids=input_ids,
@@ -170,12 +172,17 @@ def stablelm_attention_forward(
     query_states = torch.cat((query_rot, query_pass), dim=-1)
     key_states = torch.cat((key_rot, key_pass), dim=-1)
 
-    key_states, value_states = past_key_value.update(key_states, value_states,
-                                                     self.layer_idx, None)
+    if not isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
+        key_states, value_states = past_key_value.update(key_states, value_states,
+                                                         self.layer_idx, None)
 
     # IPEX-LLM OPT: sdp
     attn_weights = None
-    if use_sdp(q_len, kv_seq_len, self.head_dim, query_states):
+    if isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
+        # append the new kv and attend over the paged or int8 kv without gathering it
+        attn_output = past_key_value.attention(query_states, key_states, value_states,
+                                               self.layer_idx, attention_mask)
+    elif use_sdp(q_len, kv_seq_len, self.head_dim, query_states):
         import xe_addons
         if isinstance(past_key_value, DynamicFp8Cache):
             attn_output = xe_addons.sdp_fp8(query_states, key_states, value_states,
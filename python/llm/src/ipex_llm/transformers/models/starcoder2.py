@@ -44,7 +44,8 @@ from ipex_llm.transformers.models.utils import (
     use_quantize_kv_cache, restore_fp8_kv_cache,
     should_use_fuse_rope, use_sdp, use_sdp_causal
 )
-from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache
+from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, DynamicPagedCache, \
+    DynamicQuantizedCache, get_normal_cache_cls
 from ipex_llm.utils.common.log4Error import invalidInputError
 
 from typing import Optional, Tuple, List
@@ -117,11 +118,17 @@ def attention_forward(
     # IPEX-LLM OPT: kv cache and quantize kv cache
     invalidInputError(past_key_value is not None,
                       "`past_key_value` cannot be None")
-    key_states, value_states = past_key_value.update(key_states, value_states,
-                                                     self.layer_idx, None)
+    if not isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
+        key_states, value_states = past_key_value.update(key_states, value_states,
+                                                         self.layer_idx, None)
 
     # IPEX-LLM OPT: sdp
-    if use_sdp(q_len, kv_seq_len, self.head_dim, query_states):
+    if isinstance(past_key_value, (DynamicQuantizedCache, DynamicPagedCache)):
+        # append the new kv and attend over the paged or int8 kv without gathering it
+        attn_output = past_key_value.attention(query_states, key_states, value_states,
+                                               self.layer_idx, attention_mask)
+        attn_weights = None
+    elif use_sdp(q_len, kv_seq_len, self.head_dim, query_states):
         import xe_addons
         if isinstance(past_key_value, DynamicFp8Cache):
             attn_output = xe_addons.sdp_fp8(query_states, key_states, value_states,
@@ -188,7 +195,8 @@ def model_forward(
         if use_quantize_kv and not isinstance(past_key_values, DynamicFp8Cache):
             past_key_values = DynamicFp8Cache.from_legacy_cache(past_key_values)
         if not use_quantize_kv and not isinstance(past_key_values, DynamicNormalCache):
-            past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
+            cache_cls = get_normal_cache_cls(input_ids)
+            past_key_values = cache_cls.from_legacy_cache(past_key_values)
     return Starcoder2Model.forward(
         self=self,
         input_ids=input_ids,
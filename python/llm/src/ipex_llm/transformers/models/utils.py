@@ -76,7 +76,10 @@ def append_kv_cache(cache_k, cache_v, key_states, value_states):
 
 
 def use_quantize_kv_cache(linear: torch.nn.Module, x: torch.Tensor) -> bool:
-    if os.environ.get("BIGDL_QUANTIZE_KV_CACHE", None) is not None:
+    if x.device.type == "cpu":
+        # fp8 kv cache relies on xe_addons, cpu uses `DynamicQuantizedCache` instead
+        return False
+    elif os.environ.get("BIGDL_QUANTIZE_KV_CACHE", None) is not None:
         warnings.warn(
             "`BIGDL_QUANTIZE_KV_CACHE` is deprecated and will be removed in future releases. "
             "Please use `IPEX_LLM_QUANTIZE_KV_CACHE` instead."
@@ -92,6 +95,14 @@ def use_quantize_kv_cache(linear: torch.nn.Module, x: torch.Tensor) -> bool:
             linear.qtype != ggml_tensor_qtype["fp16"] and linear.qtype != ggml_tensor_qtype["bf16"]
 
 
+def use_cpu_quantize_kv_cache(x: torch.Tensor) -> bool:
+    return x.device.type == "cpu" and os.environ.get("IPEX_LLM_QUANTIZE_KV_CACHE", "0") == "1"
+
+
+def use_paged_kv_cache(x: torch.Tensor) -> bool:
+    return x.device.type == "cpu" and os.environ.get("IPEX_LLM_PAGED_KV_CACHE", "0") == "1"
+
+
 def kv_cache_device_check(x: torch.Tensor) -> bool:
     return get_xpu_device_type(x) == "mtl" or \
         ((get_xpu_device_type(x) == "arc" or get_xpu_device_type(x) == "flex") and
@@ -479,3 +490,59 @@ def update_past_key_value(past_key_value, key_states, value_states,
                 v_cache = new_v_cache
             key_states, value_states = append_kv_cache(k_cache, v_cache, key_states, value_states)
     return key_states, value_states
+
+
+_moe_expert_executors = {}
+
+
+def get_moe_expert_executor():
+    num_threads = int(os.environ.get("IPEX_LLM_MOE_EXPERT_THREADS", "1"))
+    if num_threads <= 1:
+        return None
+    if num_threads not in _moe_expert_executors:
+        from concurrent.futures import ThreadPoolExecutor
+        _moe_expert_executors[num_threads] = ThreadPoolExecutor(max_workers=num_threads)
+    return _moe_expert_executors[num_threads]
+
+
+def moe_group_forward(hidden_states, selected_experts, routing_weights, num_experts,
+                      expert_forward):
+    """
+    Run the selected experts of a batch of tokens grouped by expert: tokens are sorted by
+    expert once, so each expert runs on one contiguous slice of them, skipping the experts
+    no token selects. `expert_forward(expert_idx, x, weights)` returns the weighted output of
+    an expert.
+
+    Experts run on a thread pool when `IPEX_LLM_MOE_EXPERT_THREADS` > 1, the cpu low-bit
+    kernels release the GIL.
+    """
+    top_k = selected_experts.size(-1)
+    flat_experts = selected_experts.view(-1)
+    order = torch.argsort(flat_experts, stable=True)
+    token_idx = order // top_k
+    sorted_states = hidden_states.index_select(0, token_idx)
+    sorted_weights = routing_weights.reshape(-1, 1).index_select(0, order)
+    # a single host sync for the sizes of all expert groups
+    counts = torch.bincount(flat_experts, minlength=num_experts).tolist()
+
+    groups = []
+    start = 0
+    for expert_idx, count in enumerate(counts):
+        if count > 0:
+            groups.append((expert_idx, start, start + count))
+        start += count
+
+    def run_expert(expert_idx, start, end):
+        return expert_forward(expert_idx, sorted_states[start:end], sorted_weights[start:end])
+
+    executor = get_moe_expert_executor()
+    if executor is None or len(groups) == 1:
+        outputs = [run_expert(*group) for group in groups]
+    else:
+        futures = [executor.submit(run_expert, *group) for group in groups]
+        outputs = [future.result() for future in futures]
+
+    final_hidden_states = torch.zeros_like(hidden_states)
+    for (_, start, end), output in zip(groups, outputs):
+        final_hidden_states.index_add_(0, token_idx[start:end], output.to(hidden_states.dtype))
+    return final_hidden_states
@@ -0,0 +1,203 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import sys
+import mmap
+import ctypes
+import threading
+import torch
+
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from ipex_llm.utils.common import invalidInputError
+
+
+MOE_CACHE_POLICIES = ["lru", "frequency"]
+
+
+def _page_out(tensor: torch.Tensor):
+    # drop the whole pages of `tensor` from this process, the pages of a mmap-ed checkpoint
+    # are read back from the file on next use. MADV_PAGEOUT never loses data, unlike
+    # MADV_DONTNEED on anonymous memory.
+    advice = getattr(mmap, "MADV_PAGEOUT", None)
+    if advice is None or not sys.platform.startswith("linux") or tensor.numel() == 0:
+        return
+    begin = tensor.data_ptr()
+    end = begin + tensor.numel() * tensor.element_size()
+    begin = (begin + mmap.PAGESIZE - 1) // mmap.PAGESIZE * mmap.PAGESIZE
+    end = end // mmap.PAGESIZE * mmap.PAGESIZE
+    if end > begin:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.madvise(ctypes.c_void_p(begin), ctypes.c_size_t(end - begin), advice)
+
+
+class MoEExpertCache:
+    """
+    Keep at most `capacity` experts of a MoE model in RAM. The weights of the other experts
+    stay as views of the mmap-ed low-bit checkpoint, and an expert is copied into RAM when
+    the router selects it or when it is prefetched, evicting the least recently used
+    (`lru`) or the least often selected (`frequency`) resident expert.
+
+    Both copies hold the same data, so an expert evicted while in use still computes the
+    right result, just from the mmap-ed file.
+    """
+
+    def __init__(self, capacity: int, policy: str="lru", prefetch: bool=True):
+        invalidInputError(capacity > 0, f"capacity should be positive, but got {capacity}")
+        invalidInputError(policy in MOE_CACHE_POLICIES,
+                          f"Unknown moe cache policy {policy}, expected one of "
+                          f"{MOE_CACHE_POLICIES}")
+        self.capacity = capacity
+        self.policy = policy
+        # (layer_idx, expert_idx) -> [(param, offloaded data)]
+        self.experts = {}
+        # resident experts, from the least to the most recently used
+        self.resident = OrderedDict()
+        self.frequency = Counter()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate,
+                "prefetched": self.prefetched, "resident": len(self.resident),
+                "capacity": self.capacity}
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.prefetched = 0
+
+    def register(self, layer_idx: int, expert_idx: int, expert: torch.nn.Module):
+        params = [(param, param.data) for param in expert.parameters()]
+        for _, data in params:
+            _page_out(data)
+        self.experts[(layer_idx, expert_idx)] = params
+
+    def _load(self, key):
+        for param, data in self.experts[key]:
+            param.data = data.clone()
+            _page_out(data)
+
+    def _admit(self, key):
+        # called with `self.lock` held
+        self.resident[key] = None
+        while len(self.resident) > self.capacity:
+            if self.policy == "lru":
+                victim = next(iter(self.resident))
+            else:
+                victim = min((k for k in self.resident if k != key),
+                             key=lambda k: self.frequency[k])
+            del self.resident[victim]
+            for param, data in self.experts[victim]:
+                param.data = data
+
+    def fetch(self, layer_idx: int, expert_idx: int):
+        """Make sure an expert selected by the router is in RAM."""
+        key = (layer_idx, expert_idx)
+        with self.lock:
+            self.frequency[key] += 1
+            future = self.pending.pop(key, None)
+        if future is not None:
+            future.result()
+        with self.lock:
+            if key in self.resident:
+                self.hits += 1
+                self.resident.move_to_end(key)
+                return
+            self.misses += 1
+        self._load(key)
+        with self.lock:
+            self._admit(key)
+
+    def _prefetch(self, key):
+        self._load(key)
+        with self.lock:
+            self._admit(key)
+            self.pending.pop(key, None)
+            self.prefetched += 1
+
+    def prefetch(self, layer_idx: int, expert_ids: List[int]):
+        """Copy experts the router will likely select into RAM in background."""
+        if self.executor is None:
+            return
+        with self.lock:
+            for expert_idx in expert_ids:
+                key = (layer_idx, expert_idx)
+                if key in self.experts and key not in self.resident and \
+                        key not in self.pending:
+                    self.pending[key] = self.executor.submit(self._prefetch, key)
+
+
+def _get_moe_blocks(model):
+    blocks = []
+    for module in model.modules():
+        # mixtral and qwen2_moe keep experts in `experts`, phixtral in `mlp`
+        experts = getattr(module, "experts", getattr(module, "mlp", None))
+        gate = getattr(module, "gate", None)
+        if isinstance(experts, torch.nn.ModuleList) and isinstance(gate, torch.nn.Module):
+            blocks.append((module, experts, gate))
+    return blocks
+
+
+def offload_moe_experts(model, capacity: int, policy: str="lru", prefetch: bool=True):
+    """
+    Offload the experts of a MoE model loaded by `load_low_bit`, only `capacity` experts are
+    kept in RAM by a `MoEExpertCache`, which is returned and set as `model.moe_expert_cache`.
+
+    With `prefetch`, the gate of each layer also runs the gate of the next layer on its
+    input, and the experts these router logits select most are prefetched.
+    """
+    blocks = _get_moe_blocks(model)
+    invalidInputError(len(blocks) > 0,
+                      f"Expert offload only supports MoE models, but got "
+                      f"{model.config.model_type}")
+    invalidInputError(model.device.type == "cpu", "Expert offload only supports cpu")
+
+    cache = MoEExpertCache(capacity, policy, prefetch)
+    for layer_idx, (block, experts, gate) in enumerate(blocks):
+        for expert_idx, expert in enumerate(experts):
+            cache.register(layer_idx, expert_idx, expert)
+            expert.register_forward_pre_hook(
+                lambda module, args, key=(layer_idx, expert_idx): cache.fetch(*key)
+            )
+
+        if prefetch and layer_idx + 1 < len(blocks):
+            next_block, _, next_gate = blocks[layer_idx + 1]
+            top_k = getattr(next_block, "top_k", getattr(next_block, "num_experts_per_tok", 2))
+
+            def prefetch_hook(module, args, output, next_layer=layer_idx + 1,
+                              next_gate=next_gate, top_k=top_k):
+                # `forward` skips the hooks of the next gate
+                router_logits = next_gate.forward(args[0])
+                selected = torch.topk(router_logits, top_k, dim=-1).indices.view(-1)
+                counts = torch.bincount(selected, minlength=router_logits.size(-1))
+                cache.prefetch(next_layer, counts.topk(top_k).indices.tolist())
+
+            gate.register_forward_hook(prefetch_hook)
+
+    model.moe_expert_cache = cache
+    return cache
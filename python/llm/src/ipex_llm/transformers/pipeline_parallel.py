@@ -97,14 +97,275 @@ class Dummy_GLMBlock(nn.Module):
         return hidden_states, kv_cache
 
 
-def init_pipeline_parallel():
-    import oneccl_bindings_for_pytorch
+# syscall number of set_mempolicy on x86_64 and its mode from linux/mempolicy.h
+SYS_SET_MEMPOLICY = 238
+MPOL_PREFERRED = 1
+
+
+def _parse_cpu_list(cpu_list):
+    # e.g. "0-3,8-11" in /sys/devices/system/node/node0/cpulist
+    cpus = set()
+    for part in cpu_list.strip().split(","):
+        if "-" in part:
+            begin, end = part.split("-")
+            cpus.update(range(int(begin), int(end) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+def _get_numa_nodes():
+    node_dir = "/sys/devices/system/node"
+    if not os.path.isdir(node_dir):
+        return {}
+    nodes = {}
+    for name in os.listdir(node_dir):
+        if name.startswith("node") and name[4:].isdigit():
+            with open(os.path.join(node_dir, name, "cpulist")) as f:
+                cpus = _parse_cpu_list(f.read())
+            if len(cpus) > 0:
+                nodes[int(name[4:])] = cpus
+    return nodes
+
+
+def _get_physical_cores(cpus):
+    # keep the first cpu of each core in `cpus`, i.e. drop SMT (hyper-threading) siblings
+    cores = set()
+    for cpu in cpus:
+        path = f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"
+        try:
+            with open(path) as f:
+                siblings = _parse_cpu_list(f.read()) & cpus
+        except OSError:
+            siblings = {cpu}
+        if min(siblings, default=cpu) == cpu:
+            cores.add(cpu)
+    return cores
+
+
+def _set_preferred_numa_node(node):
+    # set_mempolicy(MPOL_PREFERRED, nodemask, maxnode), falls back to other nodes when
+    # this node is out of memory
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    nodemask = (ctypes.c_ulong * (node // 64 + 1))()
+    nodemask[node // 64] = 1 << (node % 64)
+    ret = libc.syscall(SYS_SET_MEMPOLICY, MPOL_PREFERRED, nodemask, ctypes.c_ulong(node + 2))
+    if ret != 0:
+        errno = ctypes.get_errno()
+        logger.warning(f"Failed to prefer the memory of NUMA node {node}: "
+                       f"set_mempolicy returned {ret}, {os.strerror(errno)}")
+        return False
+    return True
+
+
+def bind_numa_node(rank):
+    """
+    Run the pipeline stage of `rank` on the physical cores of one NUMA node and prefer the
+    memory of this node, so that each socket serves the weights of its own stage.
+
+    The stage uses one thread per physical core, whatever `OMP_NUM_THREADS` is (`torchrun`
+    sets it to 1), restrict the cpus of the processes (e.g. with `taskset`) to use fewer.
+    """
+    nodes = _get_numa_nodes()
+    if len(nodes) == 0 or not hasattr(os, "sched_setaffinity"):
+        return None
+    node = sorted(nodes)[rank % len(nodes)]
+    cpus = _get_physical_cores(nodes[node] & os.sched_getaffinity(0))
+    if len(cpus) == 0:
+        return None
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+
+    import platform
+    if platform.machine() == "x86_64":
+        _set_preferred_numa_node(node)
+    logger.info(f"Pipeline stage {rank} is bound to NUMA node {node} with {len(cpus)} cores")
+    return node
+
+
+def init_pipeline_parallel(device="xpu"):
+    """
+    Initialize the process group of pipeline parallel inference.
+
+    :param device: ``"xpu"`` to run a stage on each GPU with oneCCL, or ``"cpu"`` to run a
+        stage on each NUMA node (i.e. socket) of a CPU server with gloo. Set
+        ``IPEX_LLM_PP_NUMA_BIND=0`` to disable the NUMA binding of cpu stages.
+    """
+    invalidInputError(device in ["xpu", "cpu"],
+                      f"Pipeline parallel only supports xpu and cpu, but got {device}")
     os.environ["MASTER_ADDR"] = os.environ.get("MASTER_ADDR", "127.0.0.1")
     os.environ["MASTER_PORT"] = os.environ.get("MASTER_PORT", "29500")
-    dist.init_process_group('ccl')
-
+    if device == "cpu":
+        dist.init_process_group('gloo')
+        if os.environ.get("IPEX_LLM_PP_NUMA_BIND", "1") != "0":
+            bind_numa_node(dist.get_rank())
+    else:
+        import oneccl_bindings_for_pytorch
+        dist.init_process_group('ccl')
+
+
+def get_pipeline_device(rank):
+    if dist.get_backend() == 'gloo':
+        return torch.device('cpu')
+    return torch.device(f'xpu:{rank}')
+
+
+def _is_chatglm(model):
+    return model.config.architectures is not None \
+        and model.config.architectures[0] in ["ChatGLMModel", "ChatGLMForConditionalGeneration"]
+
+
+def _get_pipeline_modules(model):
+    # decoder layers, modules before them (on the first stage) and after them (on the last stage)
+    if _is_chatglm(model):
+        transformer = model._modules['transformer']
+        return transformer.encoder.layers, [transformer.embedding], \
+            [transformer.encoder.final_layernorm, transformer.output_layer]
+    return model._modules['model'].layers, [model._modules['model'].embed_tokens], \
+        [model._modules['model'].norm, model._modules['lm_head']]
+
+
+def _module_bytes(modules):
+    return sum(param.numel() * param.element_size()
+               for module in modules for param in module.parameters())
+
+
+def partition_layers(layer_costs, num_stages, head_cost=0.0, tail_cost=0.0, stage_speeds=None):
+    """
+    Split layers into `num_stages` contiguous stages of at least one layer, minimizing the
+    time of the slowest stage, i.e. the pipeline bubble of the other stages. The first stage
+    also runs the head (embedding) and the last stage the tail (final norm and lm_head), and
+    stage i runs `stage_speeds[i]` times faster than a stage of speed 1.
+
+    Return the number of layers of each stage.
+    """
+    num_layers = len(layer_costs)
+    invalidInputError(num_layers >= num_stages,
+                      f"Cannot split {num_layers} layers into {num_stages} stages")
+    stage_speeds = stage_speeds or [1.0] * num_stages
+    invalidInputError(len(stage_speeds) == num_stages,
+                      f"Expect {num_stages} stage speeds, but got {len(stage_speeds)}")
+    prefix = [0.0]
+    for cost in layer_costs:
+        prefix.append(prefix[-1] + cost)
+
+    def stage_time(stage, start, end):
+        cost = prefix[end] - prefix[start]
+        if stage == 0:
+            cost += head_cost
+        if stage == num_stages - 1:
+            cost += tail_cost
+        return cost / stage_speeds[stage]
+
+    # best[k][j]: min time of the slowest stage when the first k stages run layers [0, j)
+    inf = float("inf")
+    best = [[inf] * (num_layers + 1) for _ in range(num_stages + 1)]
+    split = [[0] * (num_layers + 1) for _ in range(num_stages + 1)]
+    best[0][0] = 0.0
+    for k in range(1, num_stages + 1):
+        for j in range(k, num_layers - (num_stages - k) + 1):
+            for i in range(k - 1, j):
+                time_ = max(best[k - 1][i], stage_time(k - 1, i, j))
+                if time_ < best[k][j]:
+                    best[k][j] = time_
+                    split[k][j] = i
+    sizes = []
+    end = num_layers
+    for k in range(num_stages, 0, -1):
+        start = split[k][end]
+        sizes.append(end - start)
+        end = start
+    return sizes[::-1]
+
+
+def get_pipeline_partition(model, pipeline_parallel_stages, partition=None, stage_speeds=None):
+    """
+    Return the number of decoder layers of each pipeline stage.
+
+    :param partition: ``None`` splits layers evenly, ``'balanced'`` balances the low-bit
+        weight size of the stages (decoding is memory bound), the path of a profile saved
+        with ``IPEX_LLM_PP_PROFILE`` balances the measured latency of the layers, and a list
+        gives the number of layers of each stage.
+    :param stage_speeds: relative speeds of the devices of the stages when balancing.
+    """
+    layers, head, tail = _get_pipeline_modules(model)
+    num_layers = len(layers)
+    if partition is None:
+        slice_size = (num_layers + pipeline_parallel_stages - 1) // pipeline_parallel_stages
+        return [max(0, min(slice_size, num_layers - slice_size * stage))
+                for stage in range(pipeline_parallel_stages)]
+    if isinstance(partition, (list, tuple)):
+        invalidInputError(len(partition) == pipeline_parallel_stages and
+                          sum(partition) == num_layers and min(partition) >= 0,
+                          f"Expect the layer numbers of {pipeline_parallel_stages} stages "
+                          f"summing to {num_layers}, but got {partition}")
+        return list(partition)
+    if partition == "balanced":
+        layer_costs = [_module_bytes([layer]) for layer in layers]
+        # embedding lookups are cheap, only the tail computes on its weights
+        head_cost, tail_cost = 0.0, _module_bytes(tail)
+    else:
+        import json
+        invalidInputError(os.path.isfile(partition),
+                          f"Unknown pipeline partition {partition}, expect None, 'balanced', "
+                          "a list of layer numbers or a profile file")
+        with open(partition) as f:
+            profile = json.load(f)
+        layer_costs = profile["layer_latency"]
+        invalidInputError(len(layer_costs) == num_layers,
+                          f"{partition} profiles {len(layer_costs)} layers, "
+                          f"but the model has {num_layers}")
+        head_cost, tail_cost = profile["head_latency"], profile["tail_latency"]
+    return partition_layers(layer_costs, pipeline_parallel_stages, head_cost, tail_cost,
+                            stage_speeds)
+
+
+def _add_profile_hooks(model, modules, key, speed):
+    # accumulate the latency of `modules` at stage speed 1, for `get_pipeline_partition`
+    def sync():
+        if model.device.type == 'xpu':
+            torch.xpu.synchronize()
 
-def pipeline_parallel(model, pipeline_parallel_stages):
+    def pre_hook(module, args):
+        sync()
+        module._pp_profile_start = time.perf_counter()
+
+    def post_hook(module, args, output):
+        sync()
+        latency, count = model.pipeline_profile.get(key, (0.0, 0))
+        model.pipeline_profile[key] = \
+            (latency + (time.perf_counter() - module._pp_profile_start) * speed, count + 1)
+
+    for module in modules:
+        module.register_forward_pre_hook(pre_hook)
+        module.register_forward_hook(post_hook)
+
+
+def save_pipeline_profile(model, path):
+    """Gather the layer latencies profiled by all stages and save them on rank 0."""
+    profiles = [None] * model.pipeline_parallel_stages
+    dist.all_gather_object(profiles, model.pipeline_profile)
+    if dist.get_rank() != 0:
+        return
+    import json
+    merged = {}
+    for profile in profiles:
+        merged.update(profile)
+
+    def mean_latency(key):
+        latency, count = merged.get(key, (0.0, 0))
+        return latency / max(count, 1)
+
+    num_layers = len(_get_pipeline_modules(model)[0])
+    with open(path, "w") as f:
+        json.dump({"layer_latency": [mean_latency(str(i)) for i in range(num_layers)],
+                   "head_latency": mean_latency("head"),
+                   "tail_latency": mean_latency("tail")}, f)
+    logger.info(f"Pipeline parallel profile is saved to {path}")
+
+
+def pipeline_parallel(model, pipeline_parallel_stages, partition=None, stage_speeds=None):
     global num_layers
     if hasattr(model.config, 'num_hidden_layers'):
         num_layers = model.config.num_hidden_layers
@@ -112,17 +373,39 @@ def pipeline_parallel(model, pipeline_parallel_stages):
         # for chatglm3-6b
         num_layers = model.config.num_layers
 
-    slice_size = (num_layers + pipeline_parallel_stages - 1) // pipeline_parallel_stages
-
     local_rank = dist.get_rank()
 
+    stage_sizes = get_pipeline_partition(model, pipeline_parallel_stages, partition,
+                                         stage_speeds)
+    if local_rank == 0:
+        layers, head, tail = _get_pipeline_modules(model)
+        start = 0
+        for stage, size in enumerate(stage_sizes):
+            modules = list(layers[start:start + size]) + \
+                (head if stage == 0 else []) + \
+                (tail if stage == pipeline_parallel_stages - 1 else [])
+            logger.info(f"Pipeline stage {stage}: layers [{start}, {start + size}), "
+                        f"{_module_bytes(modules) / 2**30:.2f} GB weights")
+            start += size
+
     global layer_start
     global layer_end
-    layer_start = slice_size * local_rank
-    layer_end = layer_start + min(slice_size, num_layers - layer_start)
+    layer_start = sum(stage_sizes[:local_rank])
+    layer_end = layer_start + stage_sizes[local_rank]
+
+    profile_path = os.environ.get("IPEX_LLM_PP_PROFILE", None)
+    if profile_path is not None:
+        speed = stage_speeds[local_rank] if stage_speeds else 1.0
+        model.pipeline_profile = {}
+        layers, head, tail = _get_pipeline_modules(model)
+        for i in range(layer_start, layer_end):
+            _add_profile_hooks(model, [layers[i]], str(i), speed)
+        if local_rank == 0:
+            _add_profile_hooks(model, head, "head", speed)
+        if local_rank == pipeline_parallel_stages - 1:
+            _add_profile_hooks(model, tail, "tail", speed)
 
-    if model.config.architectures is not None \
-       and model.config.architectures[0] in ["ChatGLMModel", "ChatGLMForConditionalGeneration"]:
+    if _is_chatglm(model):
         # for chatglm3-6b
         for i in range(num_layers):
             if i < layer_start or i >= layer_end:
@@ -150,7 +433,7 @@ def pipeline_parallel(model, pipeline_parallel_stages):
             model._modules['lm_head'] = DummyLayer()
 
     model.pipeline_parallel_stages = pipeline_parallel_stages
-    model = model.to(f'xpu:{local_rank}')
+    model = model.to(get_pipeline_device(local_rank))
     return model
 
 
@@ -227,6 +510,9 @@ def pipeline_parallel_generate(self,
 
     self.first_token_time = 0
     self.next_token_time = []
+    # time this stage computes and waits for the other stages (pipeline bubble)
+    compute_time = 0.0
+    bubble_time = 0.0
 
     pad_token_id = generation_config.pad_token_id
     eos_token_id = generation_config.eos_token_id
@@ -252,13 +538,16 @@ def pipeline_parallel_generate(self,
             _input_ids = inputs
 
         tic = time.time()
+        wait_time = 0.0
         if local_rank == 0:
             outputs = self(input_ids=_input_ids, inputs_embeds=None,
                            past_key_values=_past_key_values, use_cache=True)
         else:
             inputs_embeds = torch.empty(_input_ids.shape + (self.config.hidden_size,),
-                                        device=f'xpu:{local_rank}', dtype=self.dtype)
+                                        device=self.device, dtype=self.dtype)
+            wait_start = time.time()
             dist.recv(inputs_embeds, src=pre_rank)
+            wait_time += time.time() - wait_start
             outputs = self(input_ids=None, inputs_embeds=inputs_embeds,
                            past_key_values=_past_key_values, use_cache=True)
 
@@ -268,8 +557,10 @@ def pipeline_parallel_generate(self,
             dist.broadcast(next_ids, src=local_rank)
         else:
             dist.send(outputs[0].to(self.dtype), dst=next_rank)
-            next_ids = torch.empty((bs, 1), device=f'xpu:{local_rank}', dtype=torch.int64)
+            next_ids = torch.empty((bs, 1), device=self.device, dtype=torch.int64)
+            wait_start = time.time()
             dist.broadcast(next_ids, src=self.pipeline_parallel_stages - 1)
+            wait_time += time.time() - wait_start
 
         _input_ids = next_ids
         output_ids = torch.cat([output_ids, next_ids], dim=-1)
@@ -297,6 +588,8 @@ def pipeline_parallel_generate(self,
             self.first_token_time = toc - tic
         else:
             self.next_token_time.append(toc - tic)
+            compute_time += toc - tic - wait_time
+            bubble_time += wait_time
 
         # if eos_token was found in one sentence, set sentence to finished
         if eos_token_id_tensor is not None:
@@ -314,6 +607,19 @@ def pipeline_parallel_generate(self,
         if self.device.type == 'xpu':
             torch.xpu.synchronize()
     self.rest_cost_mean = np.mean(self.next_token_time)
+
+    # next token time spent by each stage on computing and on waiting for the others
+    stage_times = [None] * self.pipeline_parallel_stages
+    dist.all_gather_object(stage_times, (compute_time, bubble_time))
+    self.pipeline_stage_times = stage_times
+    if local_rank == 0:
+        for stage, (stage_compute, stage_bubble) in enumerate(stage_times):
+            total = max(stage_compute + stage_bubble, 1e-9)
+            logger.info(f"Pipeline stage {stage}: compute time {stage_compute:.3f}s, "
+                        f"bubble time {stage_bubble:.3f}s ({stage_bubble / total:.1%})")
+    profile_path = os.environ.get("IPEX_LLM_PP_PROFILE", None)
+    if profile_path is not None:
+        save_pipeline_profile(self, profile_path)
     return output_ids
 
 
@@ -356,6 +662,7 @@ class ModelRunner:
         logger.info(f"Time to load weights: {end - start:.2f}s")
 
         self.model = model
+        self.device = model.device
         self.rank = rank
         self.world_size = world_size
         self.pre_rank = (self.rank - 1) % self.world_size
@@ -414,7 +721,8 @@ class ModelRunner:
             input_ids = None
             inputs_embeds = input
 
-        torch.xpu.empty_cache()
+        if self.device.type == 'xpu':
+            torch.xpu.empty_cache()
         output = self.model(input_ids=input_ids,
                             inputs_embeds=inputs_embeds,
                             past_key_values=_past_key_values,
@@ -430,7 +738,8 @@ class ModelRunner:
         else:
             _past_key_values = output.past_key_values
         self.past_key_values_dict[cur_id] = _past_key_values
-        torch.xpu.synchronize()
+        if self.device.type == 'xpu':
+            torch.xpu.synchronize()
         if not self.pp_config.is_tail:
             return output[0].to(self.dtype)
         else:
@@ -452,8 +761,8 @@ class ModelRunner:
 
         plain_texts = [req.prompt for req in prompt_requests]
         inputs = tokenizer(plain_texts, return_tensors="pt", padding=True)
-        input_ids = inputs.input_ids.to(f'xpu:{self.rank}')
-        attention_mask = inputs.attention_mask.to(f'xpu:{self.rank}')
+        input_ids = inputs.input_ids.to(self.device)
+        attention_mask = inputs.attention_mask.to(self.device)
         new_batch = BatchTask(
             batch_id="batch_" + str(uuid.uuid4()),
             request_ids=request_ids,
@@ -497,7 +806,7 @@ class ModelRunner:
 
             if (cur_batch is not None) and (not cur_batch.stopped) and (cur_input is None):
                 cur_id = cur_batch.batch_id
-                next_ids = torch.empty((cur_batch.batch_size, 1,), device=f'xpu:{self.rank}',
+                next_ids = torch.empty((cur_batch.batch_size, 1,), device=self.device,
                                        dtype=torch.int64)
                 dist.recv(next_ids, src=self.pre_rank)
 
@@ -589,7 +898,7 @@ class ModelRunner:
                 else:
                     cur_len = cur_batch.input_len
                     cur_input = torch.empty((cur_batch.batch_size, cur_len, self.hidden_size,),
-                                            device=f'xpu:{self.rank}', dtype=self.dtype)
+                                            device=self.device, dtype=self.dtype)
                     dist.recv(cur_input, src=self.pre_rank)
 
         output = self.model_step(cur_input, cur_batch)
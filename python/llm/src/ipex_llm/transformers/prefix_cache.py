@@ -0,0 +1,329 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import itertools
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import GenerationConfig, LogitsProcessorList, StoppingCriteriaList
+from transformers.cache_utils import DynamicCache
+
+from ipex_llm.transformers.kv import DynamicFp8Cache, STANDARD_KV_CACHE_MODEL_TYPES
+from ipex_llm.transformers.models.utils import init_fp8_kv_cache
+
+logger = logging.getLogger("ipex_llm.prefix_cache")
+
+# patch GenerationMixin.generate, on top of lookup and speculative generate
+import ipex_llm.transformers.lookup
+from transformers import GenerationMixin
+original_generate = None
+
+
+@torch.no_grad()
+def generate(
+    self,
+    inputs: Optional[torch.Tensor] = None,
+    generation_config: Optional[GenerationConfig] = None,
+    logits_processor: Optional[LogitsProcessorList] = None,
+    stopping_criteria: Optional[StoppingCriteriaList] = None,
+    prefix_allowed_tokens_fn: Optional[Callable[[int, torch.Tensor], List[int]]]=None,
+    synced_gpus: Optional[bool] = None,
+    assistant_model: Optional["PreTrainedModel"] = None,
+    streamer: Optional["BaseStreamer"] = None,
+    **kwargs,
+):
+    prefix_cache = getattr(self, "prefix_cache", None)
+    input_ids = inputs if inputs is not None else kwargs.get("input_ids", None)
+    attention_mask = kwargs.get("attention_mask", None)
+    if (
+        prefix_cache is not None
+        and input_ids is not None and input_ids.dim() == 2 and input_ids.size(0) == 1
+        # generate() expands input_ids for beams and multiple sequences, but not the
+        # injected past_key_values
+        and _generation_arg(self, generation_config, kwargs, "num_beams") == 1
+        and _generation_arg(self, generation_config, kwargs, "num_return_sequences") == 1
+        and kwargs.get("past_key_values", None) is None
+        and not kwargs.get("lookahead", None)
+        and not hasattr(self, "draft_model")
+        and getattr(self.config, "model_type", None) in STANDARD_KV_CACHE_MODEL_TYPES
+        and (attention_mask is None or bool(attention_mask.all()))
+    ):
+        # prefill everything but the last prompt token, reusing the longest cached
+        # prefix, then let generate() continue from the returned kv cache
+        kwargs["past_key_values"] = prefix_cache.prefill(self, input_ids)
+
+    return original_generate(self,
+                             inputs=inputs,
+                             generation_config=generation_config,
+                             logits_processor=logits_processor,
+                             stopping_criteria=stopping_criteria,
+                             prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
+                             synced_gpus=synced_gpus,
+                             assistant_model=assistant_model,
+                             streamer=streamer,
+                             **kwargs)
+
+
+def _generation_arg(model, generation_config, kwargs, name):
+    # kwargs of generate() override `generation_config`, which defaults to the model's
+    if kwargs.get(name, None) is not None:
+        return kwargs[name]
+    if generation_config is None:
+        generation_config = getattr(model, "generation_config", None)
+    value = getattr(generation_config, name, None)
+    return 1 if value is None else value
+
+
+def patch_generate():
+    """Patch ``GenerationMixin.generate`` to reuse ``model.prefix_cache`` when it is set."""
+    global original_generate
+    if original_generate is None:
+        original_generate = GenerationMixin.generate
+        GenerationMixin.generate = generate
+
+
+def _cache_layers(past_key_values):
+    """
+    Return the kv cache as a list of per-layer tuples of tensors of shape
+    [batch_size, num_heads, seq_len, *], i.e. (key, value) or for `DynamicQuantizedCache`
+    (key, value, key_scale, value_scale) so that its kv is stored quantized,
+    or None if it has another layout.
+    """
+    if hasattr(past_key_values, "key_scale"):
+        past_key_values = [(k, v, k_scale[:, :, :k.size(2)], v_scale[:, :, :v.size(2)])
+                           for k, v, k_scale, v_scale in zip(past_key_values.key_cache,
+                                                             past_key_values.value_cache,
+                                                             past_key_values.key_scale,
+                                                             past_key_values.value_scale)]
+    elif hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    if not isinstance(past_key_values, (tuple, list)) or len(past_key_values) == 0:
+        return None
+    layers = []
+    for layer in past_key_values:
+        if not isinstance(layer, (tuple, list)) or len(layer) not in [2, 4]:
+            return None
+        if any(not isinstance(t, torch.Tensor) or t.dim() != 4 or
+               t.size(2) != layer[0].size(2) for t in layer):
+            return None
+        layers.append(tuple(layer))
+    return layers
+
+
+class _RadixNode:
+    """A radix tree node holding the per-layer kv of the tokens on its incoming edge."""
+
+    def __init__(self, tokens: Tuple[int, ...], kv: List[Tuple[torch.Tensor, ...]],
+                 parent: Optional["_RadixNode"]):
+        self.tokens = tokens
+        self.kv = kv
+        self.parent = parent
+        self.children: Dict[int, "_RadixNode"] = {}
+        self.last_access = 0
+        self.nbytes = sum(t.element_size() * t.nelement() for layer in kv for t in layer)
+
+    def split(self, idx: int) -> "_RadixNode":
+        """Split the edge after `idx` tokens and return the new upper node."""
+        upper = _RadixNode(self.tokens[:idx],
+                           [tuple(t[:, :, :idx].clone() for t in layer) for layer in self.kv],
+                           self.parent)
+        upper.last_access = self.last_access
+        self.parent.children[self.tokens[0]] = upper
+        self.tokens = self.tokens[idx:]
+        self.kv = [tuple(t[:, :, idx:].clone() for t in layer) for layer in self.kv]
+        self.nbytes -= upper.nbytes
+        self.parent = upper
+        upper.children[self.tokens[0]] = self
+        return upper
+
+
+class PrefixCache:
+    """
+    Cross-request prompt prefix cache for the transformers kv cache.
+
+    Prompt kv caches are stored in a token radix tree, so requests sharing a system prompt
+    or few-shot preamble share the kv of that prefix. Least recently used leaves are evicted
+    once the cached kv exceeds `capacity_bytes`. Attach it with
+    ``model.prefix_cache = PrefixCache()`` and ``model.generate()`` will skip prefill for the
+    longest cached prefix of a batch size 1 prompt.
+
+    :param capacity_bytes: the maximum size in bytes of cached kv, default to 2GB.
+    """
+
+    def __init__(self, capacity_bytes: int = (2 << 30)):
+        patch_generate()
+        self.capacity_bytes = capacity_bytes
+        self.cache_size = 0
+        self.cache_cls = None
+        self.root = _RadixNode((), [], None)
+        self._clock = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _match(self, tokens: Sequence[int]) -> Tuple[int, List[Tuple["_RadixNode", int]]]:
+        """Return the matched length and the (node, matched tokens on its edge) path."""
+        node = self.root
+        matched = 0
+        path = []
+        while matched < len(tokens) and tokens[matched] in node.children:
+            child = node.children[tokens[matched]]
+            edge_len = 0
+            for token in child.tokens:
+                if matched + edge_len >= len(tokens) or tokens[matched + edge_len] != token:
+                    break
+                edge_len += 1
+            path.append((child, edge_len))
+            matched += edge_len
+            if edge_len < len(child.tokens):
+                break
+            node = child
+        return matched, path
+
+    def match(self, tokens: Sequence[int]):
+        """
+        Look up the longest cached prefix of `tokens`.
+
+        :return: the prefix length and a list of per-layer tuples of tensors of that prefix,
+                 i.e. (key, value) or (key, value, key_scale, value_scale).
+        """
+        with self._lock:
+            matched, path = self._match(tokens)
+            if matched == 0:
+                return 0, None
+            now = next(self._clock)
+            for node, _ in path:
+                node.last_access = now
+            layers = []
+            for layer_idx, layer in enumerate(path[0][0].kv):
+                layers.append(tuple(
+                    torch.cat([node.kv[layer_idx][i][:, :, :n] for node, n in path], dim=2)
+                    for i in range(len(layer))
+                ))
+            return matched, layers
+
+    def insert(self, tokens: Sequence[int], past_key_values) -> bool:
+        """
+        Store the kv of `tokens`, `past_key_values` must cover at least these tokens.
+
+        :return: False if the kv cache layout is not supported and nothing is stored.
+        """
+        cache_cls = type(past_key_values) if isinstance(past_key_values, DynamicCache) else None
+        past_key_values = _cache_layers(past_key_values)
+        if past_key_values is None or past_key_values[0][0].size(2) < len(tokens):
+            logger.debug("skip prefix cache for an unsupported kv cache layout")
+            return False
+        tokens = tuple(tokens)
+        with self._lock:
+            if self.cache_cls is not cache_cls:
+                # kv of a different cache type cannot be mixed
+                self._clear()
+                self.cache_cls = cache_cls
+            matched, path = self._match(tokens)
+            now = next(self._clock)
+            node = self.root
+            for child, edge_len in path:
+                if edge_len < len(child.tokens):
+                    child = child.split(edge_len)
+                child.last_access = now
+                node = child
+            if matched < len(tokens):
+                kv = [tuple(t[:, :, matched:len(tokens)].clone() for t in layer)
+                      for layer in past_key_values]
+                leaf = _RadixNode(tokens[matched:], kv, node)
+                leaf.last_access = now
+                node.children[leaf.tokens[0]] = leaf
+                self.cache_size += leaf.nbytes
+            self._evict()
+        return True
+
+    def _evict(self):
+        while self.cache_size > self.capacity_bytes:
+            leaves = []
+            stack = [self.root]
+            while stack:
+                node = stack.pop()
+                if node.children:
+                    stack.extend(node.children.values())
+                elif node is not self.root:
+                    leaves.append(node)
+            if not leaves:
+                break
+            leaf = min(leaves, key=lambda n: n.last_access)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.cache_size -= leaf.nbytes
+
+    def _clear(self):
+        self.root = _RadixNode((), [], None)
+        self.cache_size = 0
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _restore(self, layers, seq_len):
+        if self.cache_cls is None:
+            return tuple(layers)
+        cache = self.cache_cls()
+        if hasattr(cache, "key_scale"):
+            # quantized kv and its scales are restored as they are
+            for name, tensors in zip(["key_cache", "value_cache", "key_scale", "value_scale"],
+                                     zip(*layers)):
+                setattr(cache, name, list(tensors))
+            if hasattr(cache, "_seen_tokens"):
+                cache._seen_tokens = seq_len
+            else:
+                cache.seen_tokens = seq_len
+        elif issubclass(self.cache_cls, DynamicFp8Cache):
+            # fp8 kv is already quantized, copy it into fresh storage instead of `update`
+            for k, v in layers:
+                batch_size, num_heads, _, head_dim = k.shape
+                k_cache, v_cache = init_fp8_kv_cache(batch_size, num_heads, seq_len, head_dim,
+                                                     device=k.device)
+                k_cache = k_cache.as_strided(k.shape, k_cache.stride(), storage_offset=0)
+                v_cache = v_cache.as_strided(v.shape, v_cache.stride(), storage_offset=0)
+                k_cache[...] = k
+                v_cache[...] = v
+                cache.key_cache.append(k_cache)
+                cache.value_cache.append(v_cache)
+            if hasattr(cache, "_seen_tokens"):
+                cache._seen_tokens = seq_len
+            else:
+                cache.seen_tokens = seq_len
+        else:
+            for layer_idx, (k, v) in enumerate(layers):
+                cache.update(k, v, layer_idx)
+        return cache
+
+    def prefill(self, model, input_ids: torch.LongTensor):
+        """
+        Build the kv cache of ``input_ids[:, :-1]`` for `model`, reusing the longest cached
+        prefix and caching the result.
+        """
+        tokens = input_ids[0, :-1].tolist()
+        if len(tokens) == 0:
+            return None
+        prefix_len, layers = self.match(tokens)
+        past_key_values = self._restore(layers, prefix_len) if prefix_len > 0 else None
+        logger.debug(f"prefix cache hit {prefix_len}/{len(tokens)} tokens")
+        if prefix_len < len(tokens):
+            output = model(input_ids=input_ids[:, prefix_len:-1],
+                           past_key_values=past_key_values,
+                           use_cache=True,
+                           return_dict=True)
+            past_key_values = output.past_key_values
+            self.insert(tokens, past_key_values)
+        return past_key_values
@@ -19,6 +19,7 @@
 # /utils.py
 #
 
+import math
 import torch
 import time
 import os
@@ -41,6 +42,7 @@ else:
     from transformers import top_k_top_p_filtering
 
 from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.models.utils import KV_CACHE_ALLOC_BLOCK_LENGTH
 from transformers.modeling_outputs import CausalLMOutputWithPast
 
 # patch GenerationMixin.generate
@@ -73,7 +75,7 @@ def generate(
             )
             for var in ['max_step_draft', 'th_stop_draft', 'hf_adjust',
                         'auto_th_stop_draft', 'auto_parameters', 'min_step_draft',
-                        'th_batch_num']:
+                        'th_batch_num', 'draft_length_policy', 'tree_width']:
                 kwargs.pop(var, None)
             return original_generate(self,
                                      inputs=inputs,
@@ -87,11 +89,13 @@ def generate(
                                      **kwargs)
         # do speculative decoding
         # TODO: maybe add other way to double check
+        _check_croppable_cache(kwargs.get("past_key_values", None))
         new_speculative_kwargs = {}
         for var in ['max_new_tokens', 'max_step_draft', 'th_stop_draft', 'do_sample',
                     'top_k', 'top_p', 'temperature', 'hf_adjust',
                     'auto_th_stop_draft', 'auto_parameters', 'repetition_penalty',
-                    'attention_mask', 'min_step_draft', 'eos_token_id']:
+                    'attention_mask', 'min_step_draft', 'eos_token_id',
+                    'draft_length_policy', 'tree_width']:
             value = kwargs.pop(var, None)
             if value is not None:
                 new_speculative_kwargs[var] = value
@@ -104,7 +108,7 @@ def generate(
         # related to speculative decoding should be removed
         for var in ['max_step_draft', 'th_stop_draft', 'hf_adjust',
                     'auto_th_stop_draft', 'auto_parameters', 'min_step_draft',
-                    'th_batch_num']:
+                    'th_batch_num', 'draft_length_policy', 'tree_width']:
             kwargs.pop(var, None)
         return original_generate(self,
                                  inputs=inputs,
@@ -170,258 +174,156 @@ def clear_benchmarks(self):
     self.n_matched = 0
 
 
-def _prepare_past_key_values_storage_cpu(self, past_key_values,
-                                         max_new_tokens, _enable_ipex=False):
-    past_key_values_storage = []
-    # init ipex_past_key_values
-    if _enable_ipex:
-        ipex_past_key_values = []
-        cur_len = past_key_values[0][0].size(1)
-        if self.config.model_type == "chatglm":
-            len0 = past_key_values[0][1].size(0)  # seq max length
-            len1 = past_key_values[0][1].size(1)
-            len2 = past_key_values[0][1].size(2)
-            len3 = past_key_values[0][1].size(3)
-            for pkv in past_key_values:
-                key = pkv[1]
-                value = pkv[2]
-                key = key.permute(1, 2, 0, 3).unsqueeze(-3)
-                key = key.expand(-1, -1, query_group_size, -1, -1)
-                key = key.contiguous().view(len1, len2 * query_group_size,
-                                            len0,  len3).permute(2, 0, 1, 3)
-                value = value.permute(1, 2, 0, 3).unsqueeze(-3)
-                value = value.expand(-1, -1, query_group_size, -1, -1)
-                value = value.contiguous().view(len1, len2 * query_group_size,
-                                                len0, len3).permute(2, 0, 1, 3)
-                list = [key[:cur_len, :, :, :], value[:cur_len, :, :, :]]
-                ipex_past_key_values.append(list)
-        elif self.config.model_type == "qwen":
-            ipex_past_key_values = [
-                [pkv[1].permute(1, 0, 2, 3)[:, :cur_len, :, :],
-                    pkv[2].permute(1, 0, 2, 3)[:, :cur_len, :, :]]
-                for pkv in past_key_values
-            ]
-        else:
-            ipex_past_key_values = [
-                [pkv[1].permute(1, 2, 0, 3)[:, :, :cur_len, :],
-                    pkv[2].permute(1, 2, 0, 3)[:, :, :cur_len, :]]
-                for pkv in past_key_values
-            ]
-    if not _enable_ipex:
-        len0 = past_key_values[0][0].size(0)
-        len1 = past_key_values[0][0].size(1)
-        # gpt_bigcode has only 2-dimension kv
-        if len(past_key_values[0][0].shape) == 4:
-            len2 = past_key_values[0][0].size(2)
-            len3 = past_key_values[0][0].size(3)
-        for i in range(len(past_key_values)):
-            if self.config.model_type == "qwen":
-                k0 = torch.ones(len0, len2, len1 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len0, len2, len1 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                k0 = k0.transpose(1, 2)
-                v0 = v0.transpose(1, 2)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:, :len1, :, :] = past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:, :len1, :, :] = past_key_values[i][1].to(
-                    torch.float32)
-            elif self.config.model_type == "chatglm":
-                k0 = torch.ones(len1, len2, len0 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len1, len2, len0 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                k0 = k0.permute(2, 0, 1, 3)
-                v0 = v0.permute(2, 0, 1, 3)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:len0, :, :, :] = past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:len0, :, :, :] = past_key_values[i][1].to(
-                    torch.float32)
-            elif self.config.model_type == "gpt_bigcode":
-                kv = torch.ones(len0 + max_new_tokens, len1,
-                                dtype=torch.float32)
-                past_key_values_storage.append(kv[None, :, :])
-                past_key_values_storage[i][0][:len0, :] = past_key_values[i][0].to(
-                    torch.float32)
-            else:
-                k0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:, :, :len2, :] = past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:, :, :len2, :] = past_key_values[i][1].to(
-                    torch.float32)
-    else:
-        len0 = past_key_values[0][1].size(1)
-        len1 = past_key_values[0][1].size(2)
-        len2 = past_key_values[0][0].size(2)  # seq length
-        len3 = past_key_values[0][1].size(3)
-        for i in range(len(past_key_values)):
-            if self.config.model_type == "chatglm":
-                k0 = torch.ones(len0, len1 * query_group_size, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len0, len1 * query_group_size, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                k0 = k0.permute(2, 0, 1, 3)
-                v0 = v0.permute(2, 0, 1, 3)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:len2, :, :, :] = ipex_past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:len2, :, :, :] = ipex_past_key_values[i][1].to(
-                    torch.float32)
-            elif self.config.model_type == "qwen":
-                k0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                k0 = k0.permute(0, 2, 1, 3)
-                v0 = v0.permute(0, 2, 1, 3)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:, :len2, :, :] = ipex_past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:, :len2, :, :] = ipex_past_key_values[i][1].to(
-                    torch.float32)
-            else:
-                k0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                v0 = torch.ones(len0, len1, len2 + max_new_tokens, len3,
-                                dtype=torch.float32)
-                past_key_values_storage.append((k0, v0))
-                past_key_values_storage[i][0][:, :, :len2, :] = ipex_past_key_values[i][0].to(
-                    torch.float32)
-                past_key_values_storage[i][1][:, :, :len2, :] = ipex_past_key_values[i][1].to(
-                    torch.float32)
-
-    return past_key_values_storage
-
-
-def _prepare_draft_past_key_values_cpu(self, past_key_values,
-                                       past_key_values_storage, _enable_ipex):
-    tmp_past_key_values = []
-    for i in range(len(past_key_values)):
-        if self.config.model_type == "qwen":
-            len1 = past_key_values[0][0].size(1)
-            k0 = past_key_values_storage[i][0][:, :len1, :, :]
-            v0 = past_key_values_storage[i][1][:, :len1, :, :]
-            tmp_past_key_values.append((k0, v0))
-        elif self.config.model_type == "chatglm":
-            if not _enable_ipex:
-                len0 = past_key_values[0][0].size(0)
-            else:
-                len0 = past_key_values[0][0].size(1)
-            k0 = past_key_values_storage[i][0][:len0, :, :, :]
-            v0 = past_key_values_storage[i][1][:len0, :, :, :]
-            tmp_past_key_values.append((k0, v0))
-        elif self.config.model_type == "gpt_bigcode":
-            len0 = past_key_values[0][0].size(0)
-            kv = past_key_values_storage[i][0][:len0, :]
-            tmp_past_key_values.append(kv[None, :, :])
-        else:
-            len2 = past_key_values[0][0].size(2)
-            k0 = past_key_values_storage[i][0][:, :, :len2, :]
-            v0 = past_key_values_storage[i][1][:, :, :len2, :]
-            tmp_past_key_values.append((k0, v0))
-    return tmp_past_key_values
-
-
-def _update_past_key_values_storage_cpu(self, past_key_values, past_key_values_storage,
-                                        original_draft_past_key_values, _enable_ipex=False):
-    for i in range(len(past_key_values)):
-        if not _enable_ipex:
-            if self.config.model_type == "qwen":
-                size = original_draft_past_key_values[i][0].size(1)
-                size1 = past_key_values[i][0].size(1)
-                past_key_values_storage[i][0][:, size:size1, :, :] = \
-                    past_key_values[i][0][:, size:size1, :, :].to(torch.float32)
-                past_key_values_storage[i][1][:, size:size1, :, :] = \
-                    past_key_values[i][1][:, size:size1, :, :].to(torch.float32)
-            elif self.config.model_type == "chatglm":
-                size = original_draft_past_key_values[i][0].size(0)
-                size1 = past_key_values[i][0].size(0)
-                past_key_values_storage[i][0][size:size1, :, :, :] = \
-                    past_key_values[i][0][size:size1, :, :, :].to(torch.float32)
-                past_key_values_storage[i][1][size:size1, :, :, :] = \
-                    past_key_values[i][1][size:size1, :, :, :].to(torch.float32)
-            elif self.config.model_type == "gpt_bigcode":
-                size = original_draft_past_key_values[i][0].size(0)
-                size1 = past_key_values[i][0].size(0)
-                if size < size1:
-                    past_key_values_storage[i][0][size:size1, :] = \
-                        past_key_values[i][0][size:size1, :].to(torch.float32)
-            else:
-                size = original_draft_past_key_values[i][0].size(2)
-                size1 = past_key_values[i][0].size(2)
-                past_key_values_storage[i][0][:, :, size:size1, :] = \
-                    past_key_values[i][0][:, :, size:size1, :].to(torch.float32)
-                past_key_values_storage[i][1][:, :, size:size1, :] = \
-                    past_key_values[i][1][:, :, size:size1, :].to(torch.float32)
+class AdaptiveDraftLength:
+    """
+    Draft length policy for speculative and prompt lookup decoding, which picks the draft
+    length maximizing the expected accepted tokens per second.
+
+    The acceptance rate of each draft position (given all previous positions are accepted)
+    is tracked with an upper confidence bound, so that longer drafts are retried after a
+    run of rejections. Draft time per token and verify time as a linear function of the
+    number of verified tokens are measured on the actual steps.
+
+    A policy may be passed to ``generate`` as ``draft_length_policy``, any object with
+    the same `next_draft_length`, `update` and `stats` methods can be used instead, and
+    ``draft_length_policy="adaptive"`` creates this policy. The statistics are exposed
+    as ``model.draft_length_stats`` after generation.
+
+    :param max_draft_length: the maximum number of draft tokens per step.
+    :param min_draft_length: the minimum number of draft tokens per step.
+    :param exploration: the weight of the upper confidence bound of acceptance rates.
+    :param decay: the decay of the moving averages of step times.
+    """
+
+    def __init__(self, max_draft_length: int, min_draft_length: int = 1,
+                 exploration: float = 0.3, decay: float = 0.9):
+        invalidInputError(0 <= min_draft_length <= max_draft_length,
+                          f"Invalid draft length range [{min_draft_length}, "
+                          f"{max_draft_length}]")
+        self.max_draft_length = max_draft_length
+        self.min_draft_length = min_draft_length
+        self.exploration = exploration
+        self.decay = decay
+        # reached[i]: how many times position i was drafted with positions < i accepted
+        self.reached = [0] * (max_draft_length + 1)
+        self.accepted = [0] * (max_draft_length + 1)
+        # histogram of the number of accepted draft tokens per step
+        self.accept_length_hist = [0] * (max_draft_length + 1)
+        self.draft_lengths = []
+        self.num_steps = 0
+        self.draft_time_per_token = None
+        # decayed sums of 1, n, t, n * n and n * t of verify steps of n tokens
+        self._verify_sums = [0.0] * 5
+
+    def acceptance(self, position: int) -> float:
+        n = self.reached[position]
+        rate = (self.accepted[position] + 1) / (n + 2)
+        bonus = self.exploration * math.sqrt(math.log(self.num_steps + 1) / (n + 1))
+        return min(1.0, rate + bonus)
+
+    def verify_time(self, num_tokens: int) -> float:
+        weight, sum_n, sum_t, sum_nn, sum_nt = self._verify_sums
+        mean_n, mean_t = sum_n / weight, sum_t / weight
+        var_n = sum_nn / weight - mean_n * mean_n
+        slope = 0.0
+        if var_n > 1e-6:
+            slope = max(0.0, (sum_nt / weight - mean_n * mean_t) / var_n)
+        return max(mean_t + slope * (num_tokens - mean_n), 1e-6)
+
+    def next_draft_length(self) -> int:
+        if self._verify_sums[0] == 0:
+            length = self.max_draft_length
         else:
-            size = original_draft_past_key_values[i][0].size(2)
-            size1 = past_key_values[i][0].size(1)
-            if self.config.model_type == "chatglm":
-                size = original_draft_past_key_values[0][0].size(0)
-                size1 = past_key_values[0][0].size(1)
-                len0 = past_key_values[0][1].size(0)  # seq max_length
-                len1 = past_key_values[0][1].size(1)
-                len2 = past_key_values[0][1].size(2)
-                len3 = past_key_values[0][1].size(3)
-                key0 = torch.ones(size1-size, len1, len2, len3,
-                                  dtype=torch.float32)
-                value0 = torch.ones(size1-size, len1, len2, len3,
-                                    dtype=torch.float32)
-                key0 = past_key_values[i][1][size:size1, :, :, :]
-                value0 = past_key_values[i][2][size:size1, :, :, :]
-                key = key0.permute(1, 2, 0, 3).unsqueeze(-3)
-                key = key.expand(-1, -1, query_group_size, -1, -1)
-                key = key.contiguous().view(len1, len2 * query_group_size, size1-size, len3)
-                key = key.permute(2, 0, 1, 3)
-                value = value0.permute(1, 2, 0, 3).unsqueeze(-3)
-                value = value.expand(-1, -1, query_group_size, -1, -1)
-                value = value.contiguous().view(len1, len2 * query_group_size, size1-size, len3)
-                value = value.permute(2, 0, 1, 3)
-                past_key_values_storage[i][0][size:size1, :, :, :] = \
-                    key.to(torch.float32)
-                past_key_values_storage[i][1][size:size1, :, :, :] = \
-                    value.to(torch.float32)
-            elif self.config.model_type == "qwen":
-                size = original_draft_past_key_values[0][0].size(1)
-                delta_past_key = \
-                    past_key_values[i][1][size:size1, :, :, :].permute(1, 0, 2, 3)
-                delta_past_value = \
-                    past_key_values[i][2][size:size1, :, :, :].permute(1, 0, 2, 3)
-                past_key_values_storage[i][0][:, size:size1, :, :] = \
-                    delta_past_key.to(torch.float32)
-                past_key_values_storage[i][1][:, size:size1, :, :] = \
-                    delta_past_value.to(torch.float32)
+            draft_time = self.draft_time_per_token or 0.0
+            length, best_speed = self.min_draft_length, -1.0
+            # expected tokens of a step drafting k tokens, the verified token included
+            expected_tokens, prob = 1.0, 1.0
+            for k in range(self.max_draft_length + 1):
+                if k > 0:
+                    prob *= self.acceptance(k)
+                    expected_tokens += prob
+                if k < self.min_draft_length:
+                    continue
+                speed = expected_tokens / (k * draft_time + self.verify_time(k + 1))
+                if speed > best_speed:
+                    length, best_speed = k, speed
+        self.draft_lengths.append(length)
+        return length
+
+    def update(self, draft_length: int, num_matches: int,
+               draft_time: float, verify_time: float):
+        """Record a step which drafted `draft_length` tokens and accepted `num_matches`."""
+        self.num_steps += 1
+        num_matches = min(num_matches, draft_length)
+        for position in range(1, min(num_matches + 1, draft_length) + 1):
+            self.reached[position] += 1
+            if position <= num_matches:
+                self.accepted[position] += 1
+        self.accept_length_hist[num_matches] += 1
+
+        if draft_length > 0:
+            per_token = draft_time / draft_length
+            if self.draft_time_per_token is None:
+                self.draft_time_per_token = per_token
             else:
-                delta_past_key = \
-                    past_key_values[i][1][size:size1, :, :, :].permute(1, 2, 0, 3)
-                delta_past_value = \
-                    past_key_values[i][2][size:size1, :, :, :].permute(1, 2, 0, 3)
+                self.draft_time_per_token = self.decay * self.draft_time_per_token + \
+                    (1 - self.decay) * per_token
+        n = draft_length + 1
+        for i, x in enumerate([1.0, n, verify_time, n * n, n * verify_time]):
+            self._verify_sums[i] = self.decay * self._verify_sums[i] + x
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "num_steps": self.num_steps,
+            "acceptance_rate": [a / r if r > 0 else None
+                                for a, r in zip(self.accepted[1:], self.reached[1:])],
+            "reached": self.reached[1:],
+            "accept_length_hist": self.accept_length_hist,
+            "draft_lengths": self.draft_lengths,
+            "draft_time_per_token": self.draft_time_per_token,
+            "verify_time": [self.verify_time(n) if self._verify_sums[0] > 0 else None
+                            for n in range(1, self.max_draft_length + 2)],
+        }
+
+
+def _get_draft_length_policy(draft_length_policy, max_draft_length, min_draft_length=1):
+    if draft_length_policy == "adaptive":
+        return AdaptiveDraftLength(max_draft_length, min(min_draft_length, max_draft_length))
+    invalidInputError(draft_length_policy is None or
+                      hasattr(draft_length_policy, "next_draft_length"),
+                      f"Invalid draft_length_policy {draft_length_policy}")
+    return draft_length_policy
+
+
+def _kv_to_bhsd(t, model_type):
+    # legacy kv layouts of some models -> [bs, n_head, seq_len, head_dim]
+    if model_type == "chatglm":
+        return t.permute(1, 2, 0, 3)
+    elif model_type == "qwen":
+        return t.transpose(1, 2)
+    return t
 
-                past_key_values_storage[i][0][:, :, size:size1, :] = \
-                    delta_past_key.to(torch.float32)
-                past_key_values_storage[i][1][:, :, size:size1, :] = \
-                    delta_past_value.to(torch.float32)
+
+def _kv_from_bhsd(t, model_type):
+    if model_type == "chatglm":
+        return t.permute(2, 0, 1, 3)
+    elif model_type == "qwen":
+        return t.transpose(1, 2)
+    return t
 
 
 def _check_and_extend_kv_cache(past_key_values, max_step_draft, kv_alloc_block_len=256,
                                model_type="llama"):
     from ipex_llm.transformers.models.utils import is_enough_kv_cache_room_4_31, \
         extend_kv_cache
+    if _is_shareable_dynamic_cache(past_key_values):
+        return past_key_values, _extend_dynamic_cache(past_key_values, max_step_draft,
+                                                      kv_alloc_block_len)
     enough_kv_room = True
     if model_type not in ["chatglm", "qwen", "baichuan", "llama", "mistral",
                           "gptj", "opt"]:
         return past_key_values, False
-    cache_k = past_key_values[0][0]
-    if model_type == "chatglm":
-        cache_k = cache_k.permute(1, 2, 0, 3)
-    elif model_type == "qwen":
-        cache_k = cache_k.transpose(1, 2)
+    cache_k = _kv_to_bhsd(past_key_values[0][0], model_type)
 
     enough_kv_room = is_enough_kv_cache_room_4_31(past_key_value=(cache_k, None),
                                                   seq_len=max_step_draft)
@@ -430,14 +332,8 @@ def _check_and_extend_kv_cache(past_key_values, max_step_draft, kv_alloc_block_l
     if not enough_kv_room:
         past_key_values = list(past_key_values)
         for i in range(len(past_key_values)):
-            cache_k = past_key_values[i][0]
-            cache_v = past_key_values[i][1]
-            if model_type == "chatglm":
-                cache_k = cache_k.permute(1, 2, 0, 3)
-                cache_v = cache_v.permute(1, 2, 0, 3)
-            elif model_type == "qwen":
-                cache_k = cache_k.transpose(1, 2)
-                cache_v = cache_v.transpose(1, 2)
+            cache_k = _kv_to_bhsd(past_key_values[i][0], model_type)
+            cache_v = _kv_to_bhsd(past_key_values[i][1], model_type)
             new_cache_k, new_cache_v = extend_kv_cache(
                 bsz,
                 num_heads,  # Support GQA
@@ -448,19 +344,166 @@ def _check_and_extend_kv_cache(past_key_values, max_step_draft, kv_alloc_block_l
                 device=device)
             new_cache_k[:] = cache_k
             new_cache_v[:] = cache_v
-            if model_type == "chatglm":
-                past_key_values[i] = (new_cache_k.permute(2, 0, 1, 3),
-                                      new_cache_v.permute(2, 0, 1, 3))
-            elif model_type == "qwen":
-                past_key_values[i] = (new_cache_k.transpose(1, 2), new_cache_v.transpose(1, 2))
-            else:
-                past_key_values[i] = (new_cache_k, new_cache_v)
+            past_key_values[i] = (_kv_from_bhsd(new_cache_k, model_type),
+                                  _kv_from_bhsd(new_cache_v, model_type))
     return past_key_values, not enough_kv_room
 
 
+def _is_shareable_dynamic_cache(past_key_values):
+    # `DynamicCache`s whose `update` appends in place when the buffers have room
+    if version.parse(trans_version) < version.parse("4.36.0"):
+        return False
+    from ipex_llm.transformers.kv import DynamicNormalCache, DynamicQuantizedCache
+    return type(past_key_values) in [DynamicNormalCache, DynamicQuantizedCache]
+
+
+def _extend_dynamic_cache(past_key_values, max_step_draft, kv_alloc_block_len):
+    from ipex_llm.transformers.models.utils import init_kv_cache
+    extended = False
+    names = [("key_cache", "value_cache"), ("key_scale", "value_scale")]
+    for key_name, value_name in names:
+        if not hasattr(past_key_values, key_name):
+            continue
+        key_cache = getattr(past_key_values, key_name)
+        value_cache = getattr(past_key_values, value_name)
+        for i, (k, v) in enumerate(zip(key_cache, value_cache)):
+            bsz, num_heads, seq_len, head_dim = k.shape
+            if k.stride(1) >= (seq_len + max_step_draft) * head_dim:
+                continue
+            new_k, new_v = init_kv_cache(bsz, num_heads, head_dim,
+                                         seq_len, seq_len + max_step_draft + kv_alloc_block_len,
+                                         k.dtype, k.device)
+            new_k[...] = k
+            new_v[...] = v
+            key_cache[i] = new_k
+            value_cache[i] = new_v
+            extended = True
+    return extended
+
+
+class _DraftKVStorage:
+    """
+    The kv of the draft model in fp32 when the target kv is in another dtype: low-bit
+    linears compute in fp32 on CPU, so the draft model cannot attend to or write into the
+    bf16/fp16 kv of the target model. Each round only the tokens accepted since the last
+    round are copied from the target kv, and the draft model appends in place after them.
+    """
+
+    dtype = torch.float32
+
+    def __init__(self, model_type):
+        self.model_type = model_type
+        self.key_cache = []
+        self.value_cache = []
+
+    @staticmethod
+    def needed(past_key_values):
+        if isinstance(past_key_values, (tuple, list)):
+            return isinstance(past_key_values[0], (tuple, list)) and \
+                past_key_values[0][0].dtype != _DraftKVStorage.dtype
+        from ipex_llm.transformers.kv import DynamicNormalCache
+        # `DynamicQuantizedCache` quantizes the draft kv in whatever dtype it comes
+        return type(past_key_values) is DynamicNormalCache and \
+            past_key_values.key_cache[0].dtype != _DraftKVStorage.dtype
+
+    def prepare(self, past_key_values, max_step_draft):
+        from ipex_llm.transformers.models.utils import init_kv_cache
+        if isinstance(past_key_values, (tuple, list)):
+            layers = [(_kv_to_bhsd(k, self.model_type),
+                       _kv_to_bhsd(v, self.model_type)) for k, v in past_key_values]
+        else:
+            layers = list(zip(past_key_values.key_cache, past_key_values.value_cache))
+        bsz, num_heads, seq_len, head_dim = layers[0][0].shape
+        for i, (k, v) in enumerate(layers):
+            if len(self.key_cache) <= i:
+                self.key_cache.append(None)
+                self.value_cache.append(None)
+                copied = 0
+                room = False
+            else:
+                copied = self.key_cache[i].size(2)
+                room = self.key_cache[i].stride(1) >= (seq_len + max_step_draft) * head_dim
+            if not room:
+                new_k, new_v = init_kv_cache(bsz, k.size(1), head_dim, copied,
+                                             seq_len + max_step_draft +
+                                             KV_CACHE_ALLOC_BLOCK_LENGTH,
+                                             self.dtype, k.device)
+                if copied > 0:
+                    new_k[...] = self.key_cache[i]
+                    new_v[...] = self.value_cache[i]
+                self.key_cache[i] = new_k
+                self.value_cache[i] = new_v
+            cache_k = self.key_cache[i]
+            cache_v = self.value_cache[i]
+            size = (cache_k.size(0), cache_k.size(1), seq_len, head_dim)
+            cache_k = cache_k.as_strided(size, cache_k.stride(), storage_offset=0)
+            cache_v = cache_v.as_strided(size, cache_v.stride(), storage_offset=0)
+            # tokens before `copied` are never changed in the target kv, the ones after
+            # may have been written by the draft model in the last round
+            cache_k[:, :, copied:] = k[:, :, copied:]
+            cache_v[:, :, copied:] = v[:, :, copied:]
+            self.key_cache[i] = cache_k
+            self.value_cache[i] = cache_v
+
+        if isinstance(past_key_values, (tuple, list)):
+            return tuple((_kv_from_bhsd(k, self.model_type),
+                          _kv_from_bhsd(v, self.model_type))
+                         for k, v in zip(self.key_cache, self.value_cache))
+        draft_past_key_values = type(past_key_values)()
+        draft_past_key_values.key_cache = list(self.key_cache)
+        draft_past_key_values.value_cache = list(self.value_cache)
+        if hasattr(draft_past_key_values, "_seen_tokens"):
+            draft_past_key_values._seen_tokens = seq_len
+        else:
+            draft_past_key_values.seen_tokens = seq_len
+        return draft_past_key_values
+
+
+def _draft_past_key_values(past_key_values, draft_kv_storage=None, max_step_draft=0):
+    """
+    Let the draft model write its kv right after the target kv in the same buffers,
+    the verify forward of the target model then overwrites it, so no kv is copied.
+    Legacy tuples are never modified by forward, a `DynamicCache` is shallow copied
+    so that the draft tokens are not appended to the cache of the target model.
+    When the draft model computes in another dtype, it uses `draft_kv_storage` instead.
+    """
+    if past_key_values is None:
+        return past_key_values
+    if draft_kv_storage is not None and _DraftKVStorage.needed(past_key_values):
+        return draft_kv_storage.prepare(past_key_values, max_step_draft)
+    if isinstance(past_key_values, (tuple, list)):
+        return past_key_values
+    # other caches cannot share buffers, e.g. paged kv blocks are owned by one cache,
+    # and copying the whole kv for each draft round is slower than no speculation
+    invalidInputError(_is_shareable_dynamic_cache(past_key_values),
+                      f"Speculative decoding on CPU does not support "
+                      f"{type(past_key_values).__name__}.")
+    draft_past_key_values = copy.copy(past_key_values)
+    for name in ["key_cache", "value_cache", "key_scale", "value_scale"]:
+        if hasattr(past_key_values, name):
+            setattr(draft_past_key_values, name, list(getattr(past_key_values, name)))
+    return draft_past_key_values
+
+
+def _check_croppable_cache(past_key_values):
+    if past_key_values is None or isinstance(past_key_values, (tuple, list)):
+        return
+    # rejected draft tokens may have overwritten the oldest tokens in the ring buffer
+    # of a sink cache, so they cannot be cropped
+    from ipex_llm.transformers.kv import DynamicSinkCache
+    invalidInputError(not isinstance(past_key_values, DynamicSinkCache),
+                      "Speculative decoding and prompt lookup do not support DynamicSinkCache.")
+
+
 def _crop_past_key_values(self, past_key_values, new_cache_size, _enable_ipex=False):
     if version.parse(trans_version) >= version.parse("4.36.0"):
-        from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache
+        _check_croppable_cache(past_key_values)
+        from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, \
+            DynamicPagedCache
+        if isinstance(past_key_values, DynamicPagedCache):
+            # returns the blocks of the rejected tokens to the pool
+            past_key_values.crop(-new_cache_size)
+            return past_key_values
         if isinstance(past_key_values, (DynamicFp8Cache, DynamicNormalCache)):
             if hasattr(past_key_values, "_seen_tokens"):
                 past_key_values._seen_tokens -= new_cache_size
@@ -648,6 +691,462 @@ def _non_cpu_ipex_verify(self, verify_input_ids, past_key_values, cur_attention_
     return self(**forward_args)
 
 
+def _get_eos_token_ids(generation_config):
+    eos_token_id = generation_config.eos_token_id
+    if eos_token_id is None:
+        return []
+    return [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id)
+
+
+def _batched_sample(logits, generation_config, return_probs=False):
+    # logits: [bs, seq_len, vocab] -> output_ids: [bs, seq_len]
+    batch_size, seq_len, _ = logits.shape
+    if generation_config.do_sample:
+        prob_list = logits_to_probs(logits,
+                                    top_k=generation_config.top_k,
+                                    top_p=generation_config.top_p,
+                                    temperature=generation_config.temperature)
+        output_ids = multinomial_sample_one_no_sync(prob_list).view(batch_size, seq_len)
+        if return_probs:
+            probs = torch.gather(logits.softmax(-1), -1, output_ids.unsqueeze(-1)).squeeze(-1)
+            return output_ids, probs
+        return output_ids
+    return greedy(logits, return_probs=return_probs)
+
+
+def _batched_forward(model, input_ids, input_mask, past_key_values, attention_mask):
+    """
+    Forward `input_ids` of shape [bs, k] after the kv cache described by `attention_mask`
+    of shape [bs, kv_len], where only the tokens with `input_mask` 1 are real tokens.
+    Each sequence gets its own position ids, so rolled back (masked) kv slots are skipped.
+    """
+    position_ids = attention_mask.sum(-1, keepdim=True) + \
+        torch.arange(input_ids.size(1), device=input_ids.device).unsqueeze(0)
+    cur_attention_mask = torch.cat((attention_mask, input_mask), dim=1)
+    output = model(input_ids=input_ids,
+                   past_key_values=past_key_values,
+                   attention_mask=cur_attention_mask,
+                   position_ids=position_ids,
+                   return_dict=True,
+                   use_cache=True)
+    return output['logits'], output['past_key_values'], cur_attention_mask
+
+
+def _batched_verify(self, last_ids, candidates, past_key_values, attention_mask, all_ids,
+                    generation_config, logits_processor):
+    """
+    Verify per-sequence candidates of different lengths in one padded forward pass.
+
+    Rejected candidates (and padding) of a sequence are masked out in `attention_mask`,
+    then the kv of each sequence is compacted so that they do not stay in the kv cache.
+
+    :return: the accepted output ids of each sequence and the updated kv cache,
+             attention mask and token history.
+    """
+    batch_size = last_ids.size(0)
+    max_candidate_len = max(len(c) for c in candidates)
+    pad_token_id = generation_config.pad_token_id or 0
+    verify_ids = torch.full((batch_size, max_candidate_len + 1), pad_token_id,
+                            dtype=torch.long, device=last_ids.device)
+    verify_mask = torch.zeros_like(verify_ids)
+    verify_ids[:, 0] = last_ids
+    verify_mask[:, 0] = 1
+    for idx, candidate in enumerate(candidates):
+        verify_ids[idx, 1:len(candidate) + 1] = candidate
+        verify_mask[idx, 1:len(candidate) + 1] = 1
+
+    logits, past_key_values, _ = _batched_forward(self, verify_ids, verify_mask,
+                                                  past_key_values, attention_mask)
+    if len(logits_processor) > 0:
+        # the logits after candidate i are only used if candidates up to i are accepted,
+        # so process them on the accepted history followed by these candidates
+        histories = _accepted_history(all_ids, attention_mask)
+        for idx, candidate in enumerate(candidates):
+            row_ids = torch.cat((histories[idx], verify_ids[idx, :len(candidate) + 1]))
+            history_len = histories[idx].size(0)
+            for i in range(len(candidate) + 1):
+                logits[idx:idx + 1, i, :] = logits_processor(
+                    row_ids[:history_len + i + 1].unsqueeze(0), logits[idx:idx + 1, i, :])
+    all_ids = torch.cat((all_ids, verify_ids), dim=1)
+    output_ids = _batched_sample(logits, generation_config)
+
+    matched = (output_ids[:, :-1] == verify_ids[:, 1:]) & verify_mask[:, 1:].bool()
+    n_matches = matched.long().cumprod(-1).sum(-1)
+    accept_mask = torch.arange(verify_ids.size(1), device=verify_ids.device).unsqueeze(0) \
+        <= n_matches.unsqueeze(1)
+    attention_mask = torch.cat((attention_mask, accept_mask.to(attention_mask.dtype)), dim=1)
+
+    n_matches = n_matches.tolist()
+    past_key_values, attention_mask, all_ids = _compact_batched_past_key_values(
+        self, past_key_values, attention_mask, all_ids)
+    accepted_ids = [output_ids[idx, :n + 1] for idx, n in enumerate(n_matches)]
+    return accepted_ids, n_matches, past_key_values, attention_mask, all_ids
+
+
+def _check_tree_width(tree_width):
+    # the model forwards only take the 4d attention mask of tree verify since 4.37
+    invalidInputError(tree_width <= 1 or
+                      version.parse(trans_version) >= version.parse("4.37.0"),
+                      f"tree_width > 1 requires transformers>=4.37.0, "
+                      f"but transformers {trans_version} is installed.")
+
+
+def _support_tree_verify(self, past_key_values):
+    # tree verify needs [bs, n_head, seq_len, head_dim] kv caches
+    from ipex_llm.transformers.kv import DynamicFp8Cache, STANDARD_KV_CACHE_MODEL_TYPES
+    if self.config.model_type not in STANDARD_KV_CACHE_MODEL_TYPES:
+        return False
+    return isinstance(past_key_values, (tuple, list)) or \
+        _is_shareable_dynamic_cache(past_key_values) or \
+        type(past_key_values) is DynamicFp8Cache
+
+
+def _build_token_tree(root_token, candidates):
+    """
+    Merge candidate continuations of `root_token` into a token tree, node 0 is the root.
+
+    :return: the token, parent node and depth of each node, and a {token: node} dict
+             of the children of each node.
+    """
+    tokens, parents, depths = [root_token], [-1], [0]
+    children = [{}]
+    for candidate in candidates:
+        node = 0
+        for token in candidate:
+            child = children[node].get(token)
+            if child is None:
+                child = len(tokens)
+                tokens.append(token)
+                parents.append(node)
+                depths.append(depths[node] + 1)
+                children.append({})
+                children[node][token] = child
+            node = child
+    return tokens, parents, depths, children
+
+
+def _tree_attention_mask(parents, past_length, dtype, device):
+    # each token attends to the kv cache, its ancestors and itself
+    num_nodes = len(parents)
+    mask = torch.zeros(num_nodes, past_length + num_nodes, dtype=dtype)
+    mask[:, :past_length] = 1
+    for i in range(num_nodes):
+        node = i
+        while node >= 0:
+            mask[i, past_length + node] = 1
+            node = parents[node]
+    if version.parse(trans_version) >= version.parse("4.40.0"):
+        # custom 4d masks are passed in the inverted form since 4.40
+        mask = (1 - mask) * torch.finfo(dtype).min
+    return mask[None, None].to(device)
+
+
+def _compact_past_key_values(past_key_values, start, keep):
+    """Move the kv at `start + keep[i]` to `start + i`, and drop the kv after them."""
+    length = start + len(keep)
+    index = None if keep == list(range(len(keep))) else keep
+
+    def compact(t):
+        if index is not None:
+            t[:, :, start:length] = t[:, :, start:][:, :, index]
+        return t[:, :, :length]
+
+    if isinstance(past_key_values, (tuple, list)):
+        return [(compact(k), compact(v)) for k, v in past_key_values]
+    for name in ["key_cache", "value_cache", "key_scale", "value_scale"]:
+        tensors = getattr(past_key_values, name, [])
+        for i, t in enumerate(tensors):
+            tensors[i] = compact(t)
+    if hasattr(past_key_values, "_seen_tokens"):
+        past_key_values._seen_tokens = length
+    else:
+        past_key_values.seen_tokens = length
+    return past_key_values
+
+
+def _compact_batched_past_key_values(self, past_key_values, attention_mask, all_ids):
+    """
+    Move the kv each sequence kept (`attention_mask` 1) after its first masked slot back
+    over the masked slots, so that the masked slots of a sequence are only its left padding
+    and the padding at the end of the shorter sequences, and drop the slots no sequence
+    needs. Only the tokens from the first masked slot of any sequence on are moved.
+
+    :return: the compacted kv cache, attention mask and token history.
+    """
+    mask = attention_mask.bool()
+    # the masked slots after the first kept token, i.e. not the left padding
+    holes = ~mask & (mask.long().cumsum(-1) > 0)
+    if not holes.any():
+        return past_key_values, attention_mask, all_ids
+    seq_len = attention_mask.size(1)
+    start = torch.where(holes.any(-1), holes.long().argmax(-1), seq_len).min().item()
+    new_len = start + mask[:, start:].sum(-1).max().item()
+    # the kept tokens after `start` first, in order
+    index = torch.sort((~mask[:, start:]).int(), dim=1, stable=True).indices
+    index = index[:, :new_len - start]
+    attention_mask = torch.cat((attention_mask[:, :start],
+                                attention_mask[:, start:].gather(1, index)), dim=1)
+    all_ids = torch.cat((all_ids[:, :start], all_ids[:, start:].gather(1, index)), dim=1)
+
+    from ipex_llm.transformers.kv import DynamicPagedCache
+    if isinstance(past_key_values, DynamicPagedCache):
+        past_key_values.select_tokens(start, index)
+        return past_key_values, attention_mask, all_ids
+
+    def compact(t):
+        # t: [bs, n_head, seq_len, head_dim]
+        t[:, :, start:new_len] = t[:, :, start:].gather(
+            2, index[:, None, :, None].expand(-1, t.size(1), -1, t.size(3)))
+        return t[:, :, :new_len]
+
+    if isinstance(past_key_values, (tuple, list)):
+        model_type = self.config.model_type
+        past_key_values = [(_kv_from_bhsd(compact(_kv_to_bhsd(k, model_type)), model_type),
+                            _kv_from_bhsd(compact(_kv_to_bhsd(v, model_type)), model_type))
+                           for k, v in past_key_values]
+        return past_key_values, attention_mask, all_ids
+    _check_croppable_cache(past_key_values)
+    for name in ["key_cache", "value_cache", "key_scale", "value_scale"]:
+        tensors = getattr(past_key_values, name, [])
+        for i, t in enumerate(tensors):
+            tensors[i] = compact(t)
+    if hasattr(past_key_values, "_seen_tokens"):
+        past_key_values._seen_tokens = new_len
+    else:
+        past_key_values.seen_tokens = new_len
+    return past_key_values, attention_mask, all_ids
+
+
+def _tree_verify(self, root_token, candidates, past_key_values, history_ids, logits_processor):
+    """
+    Greedily verify several candidate continuations of `root_token` in one forward.
+    Candidates are merged into a token tree, so shared prefixes are verified once, and
+    a tree attention mask lets each token only see its ancestors.
+
+    :return: the accepted tokens of shape [1, n] (the longest matched path plus the token
+             predicted after it), and the kv cache holding only the kv of that path.
+    """
+    tokens, parents, depths, children = _build_token_tree(root_token, candidates)
+    if isinstance(past_key_values, (tuple, list)):
+        past_length = past_key_values[0][0].size(2)
+    else:
+        past_length = past_key_values.get_seq_length()
+    device = history_ids.device
+    output = self(input_ids=torch.tensor([tokens], dtype=torch.long, device=device),
+                  attention_mask=_tree_attention_mask(parents, past_length, self.dtype, device),
+                  position_ids=torch.tensor([depths], dtype=torch.long, device=device)
+                  + past_length,
+                  past_key_values=past_key_values,
+                  return_dict=True,
+                  use_cache=True)
+    logits = output['logits'][0]
+    if len(logits_processor) > 0:
+        for i in range(len(tokens)):
+            path = []
+            node = i
+            while node > 0:
+                path.append(tokens[node])
+                node = parents[node]
+            path_ids = torch.tensor([path[::-1]], dtype=torch.long, device=device)
+            logits[i:i + 1] = logits_processor(torch.cat((history_ids, path_ids), dim=-1),
+                                               logits[i:i + 1])
+    predicted = logits.argmax(-1).tolist()
+
+    accepted = [0]
+    while predicted[accepted[-1]] in children[accepted[-1]]:
+        accepted.append(children[accepted[-1]][predicted[accepted[-1]]])
+    output_ids = torch.tensor([[predicted[node] for node in accepted]],
+                              dtype=torch.long, device=device)
+    past_key_values = _compact_past_key_values(output['past_key_values'], past_length, accepted)
+    return output_ids, past_key_values
+
+
+class _BatchedOutputs:
+    """Per-sequence generated tokens, stopped on eos or `max_new_tokens` independently."""
+
+    def __init__(self, batch_size, max_new_tokens, generation_config):
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = _get_eos_token_ids(generation_config)
+        self.pad_token_id = generation_config.pad_token_id or 0
+        self.tokens = [[] for _ in range(batch_size)]
+        self.finished = [max_new_tokens <= 0] * batch_size
+
+    def remaining(self, idx):
+        return self.max_new_tokens - len(self.tokens[idx])
+
+    def append(self, idx, token_ids):
+        token_ids = token_ids[:self.remaining(idx)]
+        for pos, token_id in enumerate(token_ids):
+            if token_id in self.eos_token_ids:
+                token_ids = token_ids[:pos + 1]
+                self.finished[idx] = True
+                break
+        self.tokens[idx].extend(token_ids)
+        if self.remaining(idx) <= 0:
+            self.finished[idx] = True
+        return token_ids
+
+    def all_finished(self):
+        return all(self.finished)
+
+    def to_tensor(self, input_ids):
+        length = max(len(tokens) for tokens in self.tokens)
+        generate_ids = torch.full((input_ids.size(0), length), self.pad_token_id,
+                                  dtype=torch.long, device=input_ids.device)
+        for idx, tokens in enumerate(self.tokens):
+            generate_ids[idx, :len(tokens)] = torch.tensor(tokens, dtype=torch.long)
+        return torch.cat((input_ids, generate_ids), dim=-1)
+
+
+def _accepted_history(all_ids, attention_mask):
+    # the tokens of each sequence without left padding and rejected candidates
+    return [ids[mask.bool()] for ids, mask in zip(all_ids, attention_mask)]
+
+
+def _process_logits(logits_processor, histories, logits):
+    """Apply `logits_processor` to `logits` of shape [bs, vocab] on each sequence's history."""
+    if len(logits_processor) == 0:
+        return logits
+    for idx, history in enumerate(histories):
+        logits[idx:idx + 1] = logits_processor(history.unsqueeze(0), logits[idx:idx + 1])
+    return logits
+
+
+def _batched_prefill(self, input_ids, attention_mask, generation_config, logits_processor):
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    # left padded prompts: the first real token of each sequence gets position 0
+    position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+    output = self(input_ids=input_ids,
+                  attention_mask=attention_mask,
+                  position_ids=position_ids,
+                  return_dict=True,
+                  use_cache=True)
+    logits = output['logits'][:, -1:]
+    logits[:, -1, :] = _process_logits(logits_processor,
+                                       _accepted_history(input_ids, attention_mask),
+                                       logits[:, -1, :])
+    output_ids = _batched_sample(logits, generation_config)
+    return output_ids[:, 0], output['past_key_values'], attention_mask
+
+
+@torch.no_grad()
+def _batched_speculative_generate(self, input_ids, draft_model, max_new_tokens,
+                                  max_step_draft, th_stop_draft, min_step_draft,
+                                  generation_config, logits_processor,
+                                  attention_mask=None, streamer=None):
+    """
+    Speculative decoding for bs > 1. Each sequence stops drafting on its own (when its
+    draft prob falls below `th_stop_draft`), all drafts are verified in one padded forward
+    and each sequence keeps its own accepted length.
+    """
+    invalidInputError(self.config.model_type not in ["chatglm", "gpt_bigcode"],
+                      f"Batched speculative decoding does not support "
+                      f"{self.config.model_type} models.")
+    batch_size = input_ids.size(0)
+    outputs = _BatchedOutputs(batch_size, max_new_tokens, generation_config)
+    self.clear_benchmarks()
+
+    tic = time.time()
+    last_ids, past_key_values, attention_mask = _batched_prefill(
+        self, input_ids, attention_mask, generation_config, logits_processor)
+    all_ids = input_ids
+    for idx, token_id in enumerate(last_ids.tolist()):
+        outputs.append(idx, [token_id])
+    if streamer is not None:
+        streamer.put(last_ids.unsqueeze(1).cpu())
+    if self.device.type == 'xpu':
+        torch.xpu.synchronize()
+    self.first_token_time = time.time() - tic
+    e2e_tic = time.time()
+
+    while not outputs.all_finished():
+        # Draft model auto-regressively generates tokens for every sequence,
+        # each sequence stops drafting on its own
+        tic = time.time()
+        draft_ids = []
+        draft_lens = [0] * batch_size
+        drafting = [not finished for finished in outputs.finished]
+        draft_past_key_values = past_key_values
+        draft_attention_mask = attention_mask
+        draft_input_ids = last_ids.unsqueeze(1)
+        draft_histories = [torch.cat((history, draft_input_ids[idx])) for idx, history
+                           in enumerate(_accepted_history(all_ids, attention_mask))]
+        draft_input_mask = torch.ones_like(draft_input_ids)
+        for step_draft in range(max_step_draft):
+            logits, draft_past_key_values, draft_attention_mask = _batched_forward(
+                draft_model, draft_input_ids, draft_input_mask,
+                draft_past_key_values, draft_attention_mask)
+            logits[:, -1, :] = _process_logits(logits_processor, draft_histories,
+                                               logits[:, -1, :])
+            draft_output_ids, draft_output_probs = _batched_sample(logits, generation_config,
+                                                                   return_probs=True)
+            draft_ids.append(draft_output_ids)
+            draft_output_probs = draft_output_probs[:, 0].tolist()
+            for idx in range(batch_size):
+                if not drafting[idx]:
+                    continue
+                draft_lens[idx] += 1
+                if (draft_output_probs[idx] < th_stop_draft and
+                        draft_lens[idx] >= min_step_draft) or \
+                        draft_lens[idx] + 1 >= outputs.remaining(idx):
+                    drafting[idx] = False
+            if not any(drafting):
+                break
+            draft_input_ids = draft_output_ids
+            if len(logits_processor) > 0:
+                draft_histories = [torch.cat((history, draft_input_ids[idx])) for idx, history
+                                   in enumerate(draft_histories)]
+        n_draft_steps = len(draft_ids)
+        if not isinstance(past_key_values, (tuple, list)):
+            # the draft model appended to the same `Cache` object, roll it back
+            past_key_values = _crop_past_key_values(self, draft_past_key_values,
+                                                    n_draft_steps)
+        draft_ids = torch.cat(draft_ids, dim=1)
+        candidates = [draft_ids[idx, :n] for idx, n in enumerate(draft_lens)]
+        if self.device.type == 'xpu':
+            torch.xpu.synchronize()
+        toc = time.time()
+        self.draft_time.append(toc - tic)
+        self.draft_num.append(max(draft_lens))
+
+        # Target model verifies all drafts in one padded forward
+        tic = time.time()
+        accepted_ids, n_matches, past_key_values, attention_mask, all_ids = _batched_verify(
+            self, last_ids, candidates, past_key_values, attention_mask, all_ids,
+            generation_config, logits_processor)
+        if self.device.type == 'xpu':
+            torch.xpu.synchronize()
+        toc = time.time()
+        self.verify_time.append(toc - tic)
+        self.generate_time.append(self.draft_time[-1] + self.verify_time[-1])
+
+        new_tokens = []
+        for idx in range(batch_size):
+            if outputs.finished[idx]:
+                new_tokens.append([])
+                continue
+            new_tokens.append(outputs.append(idx, accepted_ids[idx].tolist()))
+            self.n_matched += n_matches[idx]
+            self.n_drafted += draft_lens[idx]
+        self.accept_num.append(max(n_matches) + 1)
+        last_ids = torch.stack([ids[-1] for ids in accepted_ids])
+        if streamer is not None:
+            streamer.put(_pad_new_tokens(new_tokens, outputs.pad_token_id))
+
+    if streamer is not None:
+        streamer.end()
+    self.n_token_generated = max(len(tokens) for tokens in outputs.tokens)
+    self.e2e_time_without_first = time.time() - e2e_tic
+    return outputs.to_tensor(input_ids)
+
+
+def _pad_new_tokens(new_tokens, pad_token_id):
+    length = max(len(tokens) for tokens in new_tokens)
+    return torch.tensor([tokens + [pad_token_id] * (length - len(tokens))
+                         for tokens in new_tokens], dtype=torch.long)
+
+
 @torch.no_grad()
 def speculative_generate(self,
                          inputs: Optional[torch.Tensor] = None,
@@ -662,9 +1161,12 @@ def speculative_generate(self,
                          generation_config: Optional[GenerationConfig] = None,
                          attention_mask=None,
                          streamer: Optional["BaseStreamer"] = None,
+                         draft_length_policy=None,
+                         tree_width=1,
                          **sampling_kwargs):
     invalidInputError(draft_model is not None,
                       "Draft model should be provided.")
+    _check_tree_width(tree_width)
     # min_step_draft >= 1. Since the max_step_draft may adjust,
     # min_step_draft can > max_step_draft
     min_step_draft = min_step_draft if min_step_draft >= 1 else 1
@@ -673,21 +1175,31 @@ def speculative_generate(self,
         model_kwargs = _prepare_generate_args(self, inputs, generation_config, streamer,
                                               **sampling_kwargs)
 
+    from ipex_llm.transformers.convert import get_enable_ipex
+    _enable_ipex = get_enable_ipex()
+
+    if input_ids.size(0) > 1:
+        invalidInputError(not _enable_ipex,
+                          "Batched speculative decoding is not supported with IPEX.")
+        return _batched_speculative_generate(self, input_ids, draft_model, max_new_tokens,
+                                             max_step_draft, th_stop_draft, min_step_draft,
+                                             generation_config, logits_processor,
+                                             attention_mask=attention_mask,
+                                             streamer=streamer)
+
     step = 0
     step_draft = 0
     step_verify = 0
 
     draft_gen_length = max_step_draft + 6 if hf_adjust else max_step_draft + 1
+    draft_length_policy = _get_draft_length_policy(draft_length_policy, max_step_draft)
     current_input_ids = input_ids
     generate_ids = torch.empty([input_ids.size(0), max_new_tokens+max_step_draft],
                                dtype=torch.long, device=self.device)
     draft_generate_ids = torch.empty([input_ids.size(0), draft_gen_length],
                                      dtype=torch.long, device=self.device)
     past_key_values = None
-    past_key_values_storage = []
-
-    from ipex_llm.transformers.convert import get_enable_ipex
-    _enable_ipex = get_enable_ipex()
+    draft_kv_storage = _DraftKVStorage(self.config.model_type)
 
     if _enable_ipex:
         if not ((self.config.model_type == 'baichuan') or
@@ -702,6 +1214,12 @@ def speculative_generate(self,
             query_group_size = draft_model.config.num_attention_heads // \
                 draft_model.config.multi_query_group_num
 
+    # greedy decoding on CPU may verify a token tree made of the draft tokens and the
+    # top `tree_width` alternatives of the draft model at each position
+    use_tree = tree_width > 1 and not generation_config.do_sample and \
+        self.device.type == 'cpu' and not _enable_ipex and \
+        (attention_mask is None or bool(attention_mask.all()))
+
     tmp_matchness = 0
     e2e_tic = 0.0
 
@@ -752,6 +1270,7 @@ def speculative_generate(self,
             generate_ids[:, step] = output_ids
             current_input_ids = output_ids
             past_key_values = output['past_key_values']
+            use_tree = use_tree and _support_tree_verify(self, past_key_values)
             step += 1
             if self.device.type == 'xpu':
                 torch.xpu.synchronize()
@@ -760,22 +1279,23 @@ def speculative_generate(self,
             e2e_tic = time.time()
         else:
             draft_current_input_ids = current_input_ids
+            if draft_length_policy is not None:
+                max_step_draft = max(1, draft_length_policy.next_draft_length())
             # Target model KV cache to draft model
 
-            if self.device.type == 'cpu':
-                # init past_key_values_storage and assign initial fp32 value
-                if _enable_ipex:
-                    draft_past_key_values = past_key_values
-                else:
-                    if step == 1:
-                        past_key_values_storage = \
-                            _prepare_past_key_values_storage_cpu(self, past_key_values,
-                                                                 max_new_tokens, _enable_ipex)
-                    # each iter cut off cur_len kv_cache from past_key_values1
-                    draft_past_key_values = \
-                        _prepare_draft_past_key_values_cpu(self, past_key_values,
-                                                           past_key_values_storage,  _enable_ipex)
-                    original_draft_past_key_values = draft_past_key_values
+            if self.device.type == 'cpu' and _enable_ipex:
+                draft_past_key_values = past_key_values
+            elif self.device.type == 'cpu':
+                # draft and verify share the target kv buffers in the model dtype,
+                # grown by blocks when there is no room for the next draft and verify
+                verify_len = max_step_draft * tree_width + 1 if use_tree else max_step_draft + 1
+                past_key_values, extend_kv = _check_and_extend_kv_cache(past_key_values,
+                                                                        verify_len,
+                                                                        KV_CACHE_ALLOC_BLOCK_LENGTH,
+                                                                        self.config.model_type)
+                draft_past_key_values = _draft_past_key_values(past_key_values,
+                                                               draft_kv_storage,
+                                                               max_step_draft)
             else:
                 past_key_values, extend_kv = _check_and_extend_kv_cache(past_key_values,
                                                                         max_step_draft,
@@ -784,6 +1304,7 @@ def speculative_generate(self,
                 draft_past_key_values = past_key_values
             draft_generate_ids[:, 0] = current_input_ids
             draft_prob_list = []
+            draft_alternatives = []
             tic = time.time()
             random_probs = None
             if generation_config.do_sample:
@@ -893,6 +1414,9 @@ def speculative_generate(self,
                     draft_output_ids, draft_output_probs = greedy(
                         logits,
                         return_probs=True)
+                    if use_tree:
+                        draft_alternatives.append(
+                            torch.topk(logits[0, -1], tree_width).indices.tolist())
                 draft_generate_ids[:, step_draft+1] = draft_output_ids
                 draft_current_input_ids = draft_output_ids
                 draft_past_key_values = draft_output['past_key_values']
@@ -916,21 +1440,80 @@ def speculative_generate(self,
             # input.size is k + 1, 1 previous token + k drafts
             # verified output.size is k + 1, k token + 1 final
             # Final token is always accepted
-            if attention_mask is None:
-                cur_attention_mask = None
+            if use_tree:
+                # the draft tokens and their alternatives form a tree rooted at the
+                # current token, the target model verifies all branches in one forward
+                chain = drafted_input_ids[0, 1:].tolist()
+                candidates = [chain]
+                for i, alternatives in enumerate(draft_alternatives[:len(chain)]):
+                    candidates.extend([chain[:i] + [token] for token in alternatives
+                                       if token != chain[i]])
+                history_ids = torch.cat((input_ids, generate_ids[:, :step]), dim=-1)
+                output_ids, past_key_values = _tree_verify(self, drafted_input_ids[0, 0].item(),
+                                                           candidates, past_key_values,
+                                                           history_ids, logits_processor)
+                max_matched = output_ids.size(1)
+                toc = time.time()
+                self.verify_time.append(toc - tic)
+                self.generate_time.append(self.draft_time[-1] + self.verify_time[-1])
             else:
-                appended_len = drafted_input_ids.size(1) + step - 1
-                ones_to_append = torch.ones(attention_mask.size(0), appended_len,
-                                            device=self.device)
-                cur_attention_mask = torch.cat((attention_mask, ones_to_append), dim=1)
-            if _enable_ipex and hasattr(self, "trace_graph"):
-                if self.config.model_type == "baichuan":
-                    if self.config.hidden_size == 4096:
+                if attention_mask is None:
+                    cur_attention_mask = None
+                else:
+                    appended_len = drafted_input_ids.size(1) + step - 1
+                    ones_to_append = torch.ones(attention_mask.size(0), appended_len,
+                                                device=self.device)
+                    cur_attention_mask = torch.cat((attention_mask, ones_to_append), dim=1)
+                if _enable_ipex and hasattr(self, "trace_graph"):
+                    if self.config.model_type == "baichuan":
+                        if self.config.hidden_size == 4096:
+                            past_key_value_len = past_key_values[0][0].shape[2]
+                            seq_len = drafted_input_ids.shape[1]
+                            seq_len_with_past = seq_len + past_key_value_len
+                            position_ids = torch.arange(past_key_value_len,
+                                                        seq_len_with_past,
+                                                        dtype=torch.long,
+                                                        device=drafted_input_ids.device)
+                            position_ids = position_ids.unsqueeze(0).view(-1, seq_len)
+                            output = self.trace_graph(input_ids=drafted_input_ids,
+                                                      attention_mask=cur_attention_mask,
+                                                      past_key_values=past_key_values,
+                                                      position_ids=position_ids,
+                                                      )
+                        elif self.config.hidden_size == 5120:
+                            output = self.trace_graph(input_ids=drafted_input_ids,
+                                                      attention_mask=cur_attention_mask,
+                                                      past_key_values=past_key_values,
+                                                      )
+                    elif "llama" in self.config.model_type:
+                        past_key_value_len = past_key_values[0][0].shape[2]
+                        position_ids = torch.arange(drafted_input_ids.shape[1], dtype=torch.long,
+                                                    device=drafted_input_ids.device).unsqueeze(0)
+                        position_ids = position_ids.repeat(1, 1) + past_key_value_len
+                        output = self.trace_graph(input_ids=drafted_input_ids,
+                                                  attention_mask=cur_attention_mask,
+                                                  position_ids=position_ids,
+                                                  past_key_values=past_key_values,
+                                                  )
+                    elif "chatglm" in self.config.model_type:
+                        past_key_value_len = past_key_values[0][0].shape[2]
+                        position_ids = torch.arange(drafted_input_ids.shape[1], dtype=torch.long,
+                                                    device=drafted_input_ids.device).unsqueeze(0)
+                        position_ids = position_ids.repeat(1, 1) + past_key_value_len
+                        output = self.trace_graph(input_ids=drafted_input_ids,
+                                                  attention_mask=cur_attention_mask,
+                                                  position_ids=position_ids,
+                                                  return_last_logit=torch.tensor(False),
+                                                  past_key_values=past_key_values,)
+                    elif "qwen" in self.config.model_type:
+                        output = self.trace_graph(input_ids=drafted_input_ids,
+                                                  attention_mask=cur_attention_mask,
+                                                  past_key_values=past_key_values)
+                    elif "mistral" in self.config.model_type:
                         past_key_value_len = past_key_values[0][0].shape[2]
                         seq_len = drafted_input_ids.shape[1]
-                        seq_len_with_past = seq_len + past_key_value_len
                         position_ids = torch.arange(past_key_value_len,
-                                                    seq_len_with_past,
+                                                    seq_len + past_key_value_len,
                                                     dtype=torch.long,
                                                     device=drafted_input_ids.device)
                         position_ids = position_ids.unsqueeze(0).view(-1, seq_len)
@@ -939,113 +1522,73 @@ def speculative_generate(self,
                                                   past_key_values=past_key_values,
                                                   position_ids=position_ids,
                                                   )
-                    elif self.config.hidden_size == 5120:
-                        output = self.trace_graph(input_ids=drafted_input_ids,
-                                                  attention_mask=cur_attention_mask,
-                                                  past_key_values=past_key_values,
-                                                  )
-                elif "llama" in self.config.model_type:
-                    past_key_value_len = past_key_values[0][0].shape[2]
-                    position_ids = torch.arange(drafted_input_ids.shape[1], dtype=torch.long,
-                                                device=drafted_input_ids.device).unsqueeze(0)
-                    position_ids = position_ids.repeat(1, 1) + past_key_value_len
-                    output = self.trace_graph(input_ids=drafted_input_ids,
-                                              attention_mask=cur_attention_mask,
-                                              position_ids=position_ids,
-                                              past_key_values=past_key_values,
-                                              )
-                elif "chatglm" in self.config.model_type:
-                    past_key_value_len = past_key_values[0][0].shape[2]
-                    position_ids = torch.arange(drafted_input_ids.shape[1], dtype=torch.long,
-                                                device=drafted_input_ids.device).unsqueeze(0)
-                    position_ids = position_ids.repeat(1, 1) + past_key_value_len
-                    output = self.trace_graph(input_ids=drafted_input_ids,
-                                              attention_mask=cur_attention_mask,
-                                              position_ids=position_ids,
-                                              return_last_logit=torch.tensor(False),
-                                              past_key_values=past_key_values,)
-                elif "qwen" in self.config.model_type:
-                    output = self.trace_graph(input_ids=drafted_input_ids,
-                                              attention_mask=cur_attention_mask,
-                                              past_key_values=past_key_values)
-                elif "mistral" in self.config.model_type:
-                    past_key_value_len = past_key_values[0][0].shape[2]
-                    seq_len = drafted_input_ids.shape[1]
-                    position_ids = torch.arange(past_key_value_len,
-                                                seq_len + past_key_value_len,
-                                                dtype=torch.long,
-                                                device=drafted_input_ids.device)
-                    position_ids = position_ids.unsqueeze(0).view(-1, seq_len)
-                    output = self.trace_graph(input_ids=drafted_input_ids,
-                                              attention_mask=cur_attention_mask,
-                                              past_key_values=past_key_values,
-                                              position_ids=position_ids,
-                                              )
-                logits = output[0]
-                past_key_values = output[1]
-            else:
-                output = _non_cpu_ipex_verify(self, drafted_input_ids, past_key_values,
-                                              cur_attention_mask, return_dict=True, use_cache=True)
-            if isinstance(output, dict):
-                logits = output['logits']
-                past_key_values = output['past_key_values']
-            temp_input_ids = torch.cat((input_ids, generate_ids[:, :step],
-                                        draft_generate_ids[:, 1:step_draft + 2]), dim=-1)
-            for i in range(logits.size(1)):
-                logits[:, i, :] = logits_processor(temp_input_ids[:, :input_ids.size(1)+step+i],
-                                                   logits[:, i, :])
-            if generation_config.do_sample:
-                target_probs = logits_to_probs(logits,
-                                               top_k=generation_config.top_k,
-                                               top_p=generation_config.top_p,
-                                               temperature=generation_config.temperature)
-            else:
-                output_ids = greedy(logits)
-            if self.device.type == 'xpu':
-                torch.xpu.synchronize()
-                if extend_kv:
-                    torch.xpu.empty_cache()
-            toc = time.time()
-            self.verify_time.append(toc - tic)
-            self.generate_time.append(self.draft_time[-1] + self.verify_time[-1])
-
-            if past_key_values is None:
-                past_key_values = output['past_key_values']
+                    logits = output[0]
+                    past_key_values = output[1]
+                else:
+                    output = _non_cpu_ipex_verify(self, drafted_input_ids, past_key_values,
+                                                  cur_attention_mask, return_dict=True,
+                                                  use_cache=True)
+                if isinstance(output, dict):
+                    logits = output['logits']
+                    past_key_values = output['past_key_values']
+                temp_input_ids = torch.cat((input_ids, generate_ids[:, :step],
+                                            draft_generate_ids[:, 1:step_draft + 2]), dim=-1)
+                for i in range(logits.size(1)):
+                    logits[:, i, :] = logits_processor(temp_input_ids[:, :input_ids.size(1)+step+i],
+                                                       logits[:, i, :])
+                if generation_config.do_sample:
+                    target_probs = logits_to_probs(logits,
+                                                   top_k=generation_config.top_k,
+                                                   top_p=generation_config.top_p,
+                                                   temperature=generation_config.temperature)
+                else:
+                    output_ids = greedy(logits)
+                if self.device.type == 'xpu':
+                    torch.xpu.synchronize()
+                    if extend_kv:
+                        torch.xpu.empty_cache()
+                toc = time.time()
+                self.verify_time.append(toc - tic)
+                self.generate_time.append(self.draft_time[-1] + self.verify_time[-1])
+
+                if past_key_values is None:
+                    past_key_values = output['past_key_values']
 
-            if generation_config.do_sample:
-                draft_tokens = drafted_input_ids[:, 1:].squeeze(0)
-                draft_probs = torch.stack(draft_prob_list).squeeze((1, 2))
-
-                # q: target prob, p: draft prob
-                # q >= p: always accept draft token
-                # q < p: q/p prob to accept draft token
-                p = draft_probs[torch.arange(0, drafted_n_tokens), draft_tokens]
-                q = target_probs[torch.arange(0, drafted_n_tokens), draft_tokens]
-                accept_draft_prob = torch.minimum(torch.ones(()), q[:drafted_n_tokens] / p)
-                rejected_locations = (random_probs[:drafted_n_tokens] > accept_draft_prob).nonzero()
-
-                if rejected_locations.shape[0] == 0:    # All draft tokens have been accepted
-                    max_matched = drafted_n_tokens + 1
-                    last_token = multinomial_sample_one_no_sync(target_probs[-1])
-                    output_ids = torch.cat([draft_tokens, last_token])
+                if generation_config.do_sample:
+                    draft_tokens = drafted_input_ids[:, 1:].squeeze(0)
+                    draft_probs = torch.stack(draft_prob_list).squeeze((1, 2))
+
+                    # q: target prob, p: draft prob
+                    # q >= p: always accept draft token
+                    # q < p: q/p prob to accept draft token
+                    p = draft_probs[torch.arange(0, drafted_n_tokens), draft_tokens]
+                    q = target_probs[torch.arange(0, drafted_n_tokens), draft_tokens]
+                    accept_draft_prob = torch.minimum(torch.ones(()), q[:drafted_n_tokens] / p)
+                    rejected_locations = \
+                        (random_probs[:drafted_n_tokens] > accept_draft_prob).nonzero()
+
+                    if rejected_locations.shape[0] == 0:    # All draft tokens have been accepted
+                        max_matched = drafted_n_tokens + 1
+                        last_token = multinomial_sample_one_no_sync(target_probs[-1])
+                        output_ids = torch.cat([draft_tokens, last_token])
+                    else:
+                        max_matched = rejected_locations[0].item()
+                        p = draft_probs[max_matched]
+                        q = target_probs[max_matched]
+                        resample_prob = q - p
+                        resample_prob = torch.where(resample_prob > 0, resample_prob, 0.0)
+                        resample_prob = resample_prob / resample_prob.sum()
+                        next_token = multinomial_sample_one_no_sync(resample_prob)
+                        output_ids = torch.cat([draft_tokens[:max_matched], next_token])
+                        max_matched += 1
+                    output_ids = output_ids.unsqueeze(0)
                 else:
-                    max_matched = rejected_locations[0].item()
-                    p = draft_probs[max_matched]
-                    q = target_probs[max_matched]
-                    resample_prob = q - p
-                    resample_prob = torch.where(resample_prob > 0, resample_prob, 0.0)
-                    resample_prob = resample_prob / resample_prob.sum()
-                    next_token = multinomial_sample_one_no_sync(resample_prob)
-                    output_ids = torch.cat([draft_tokens[:max_matched], next_token])
-                    max_matched += 1
-                output_ids = output_ids.unsqueeze(0)
-            else:
-                # Compare drafts with target verified outputs
-                # Drafts start from [1, k]
-                # Verified output start from [0, k - 1]
-                # including the one generated by the base model
-                max_matched = ((output_ids[:, :-1] != drafted_input_ids[:, 1:]).cumsum(-1) == 0)
-                max_matched = max_matched.sum(-1).item() + 1
+                    # Compare drafts with target verified outputs
+                    # Drafts start from [1, k]
+                    # Verified output start from [0, k - 1]
+                    # including the one generated by the base model
+                    max_matched = ((output_ids[:, :-1] != drafted_input_ids[:, 1:]).cumsum(-1) == 0)
+                    max_matched = max_matched.sum(-1).item() + 1
 
             max_of_max_matched = output_ids.size(1)
             # Accept number is max_matched, min is 1
@@ -1058,12 +1601,6 @@ def speculative_generate(self,
                                                              new_cache_size,
                                                              _enable_ipex)
 
-            # Each iter assign new_matched kv_cache to past_key_values1
-            if self.device.type == 'cpu' and (not _enable_ipex):
-                _update_past_key_values_storage_cpu(self, past_key_values, past_key_values_storage,
-                                                    original_draft_past_key_values,
-                                                    _enable_ipex)
-
             generate_ids[:, step:step+output_ids.size(1)] = output_ids
             current_input_ids = output_ids[:, -1:]
             if streamer is not None:
@@ -1074,6 +1611,9 @@ def speculative_generate(self,
             self.n_matched += max_matched - 1
             self.n_drafted += drafted_n_tokens
             step_verify += 1
+            if draft_length_policy is not None:
+                draft_length_policy.update(drafted_n_tokens, max_matched - 1,
+                                           self.draft_time[-1], self.verify_time[-1])
 
             if auto_th_stop_draft and step_verify % auto_parameters[0] == 0:
                 tmp_matchness = auto_parameters[1]*(tmp_matchness) + \
@@ -1088,7 +1628,7 @@ def speculative_generate(self,
                 th_stop_draft = auto_parameters[4] * th_stop_draft + \
                     (1-auto_parameters[4]) * new_th_stop_draft
 
-            if hf_adjust:
+            if hf_adjust and draft_length_policy is None:
                 if (max_matched - 1) == max_step_draft:
                     max_step_draft = min(draft_gen_length - 1, max_step_draft + 1)
                 else:
@@ -1116,6 +1656,8 @@ def speculative_generate(self,
     e2e_toc = time.time()
     self.n_token_generated = step
     self.e2e_time_without_first = e2e_toc - e2e_tic
+    if draft_length_policy is not None:
+        self.draft_length_stats = draft_length_policy.stats()
 
     generate_ids = torch.cat([input_ids, generate_ids[:, :step]], dim=-1)
 
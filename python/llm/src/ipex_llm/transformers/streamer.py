@@ -22,6 +22,147 @@ from typing import Optional, List
 import torch
 from transformers import TextIteratorStreamer
 
+from ipex_llm.utils.common import invalidInputError
+
+
+class IncrementalDetokenizer:
+    """
+    Decode a growing sequence of tokens into text increments.
+
+    Each step only decodes a short tail window starting from the previous read offset,
+    instead of the whole sequence, so the cost per token stays constant. Text ending with
+    an incomplete utf-8 character is held back until the following tokens complete it.
+    """
+
+    def __init__(self, tokenizer: "AutoTokenizer", **decode_kwargs):
+        self.tokenizer = tokenizer
+        self.decode_kwargs = decode_kwargs
+        self.reset()
+
+    def reset(self):
+        self.tokens = []
+        self.read_offset = 0
+
+    def put(self, token_ids: List[int]) -> str:
+        self.tokens.extend(token_ids)
+        # tokens[:read_offset] are the context of the window, decoded in the previous step
+        prefix_text = self.tokenizer.decode(self.tokens[:self.read_offset], **self.decode_kwargs)
+        new_text = self.tokenizer.decode(self.tokens, **self.decode_kwargs)
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        self.tokens = self.tokens[self.read_offset:]
+        self.read_offset = len(self.tokens)
+        return new_text[len(prefix_text):]
+
+    def flush(self) -> str:
+        prefix_text = self.tokenizer.decode(self.tokens[:self.read_offset], **self.decode_kwargs)
+        new_text = self.tokenizer.decode(self.tokens, **self.decode_kwargs)
+        self.reset()
+        return new_text[len(prefix_text):]
+
+
+class StopStringMatcher:
+    """
+    Find stop strings in streamed text with an Aho-Corasick automaton, fed with new text only.
+
+    Besides complete matches, `partial_len` is the length of the longest suffix of the text
+    fed so far which is a prefix of some stop string, i.e. the text that should be held back.
+    """
+
+    def __init__(self, stop_strings: List[str]):
+        self.goto = [{}]
+        self.fail = [0]
+        self.depth = [0]
+        # length of the longest stop string ending at each state, 0 if none
+        self.match_len = [0]
+        for stop_string in stop_strings:
+            if not stop_string:
+                continue
+            state = 0
+            for char in stop_string:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.depth.append(self.depth[state] + 1)
+                    self.match_len.append(0)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.match_len[state] = max(self.match_len[state], len(stop_string))
+
+        # breadth-first to build failure links
+        frontier = list(self.goto[0].values())
+        while frontier:
+            next_frontier = []
+            for state in frontier:
+                for char, child in self.goto[state].items():
+                    fail = self.fail[state]
+                    while fail and char not in self.goto[fail]:
+                        fail = self.fail[fail]
+                    fail = self.goto[fail].get(char, 0)
+                    self.fail[child] = fail if fail != child else 0
+                    self.match_len[child] = max(self.match_len[child],
+                                                self.match_len[self.fail[child]])
+                    next_frontier.append(child)
+            frontier = next_frontier
+
+        self.state = 0
+        self.num_chars = 0
+
+    @property
+    def partial_len(self) -> int:
+        return self.depth[self.state]
+
+    def feed(self, text: str) -> int:
+        """
+        Feed new text, return the start offset (in all text fed so far) of the first stop
+        string found, or -1 if there is none.
+        """
+        for char in text:
+            state = self.state
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            self.state = self.goto[state].get(char, 0)
+            self.num_chars += 1
+            if self.match_len[self.state] > 0:
+                return self.num_chars - self.match_len[self.state]
+        return -1
+
+
+class IncrementalTextIteratorStreamer(TextIteratorStreamer):
+    """
+    A TextIteratorStreamer which decodes tokens incrementally with `IncrementalDetokenizer`.
+
+    Like TextIteratorStreamer, one (maybe empty) text is put into the queue for each call
+    of `put`.
+    """
+
+    def __init__(
+        self,
+        tokenizer: "AutoTokenizer",
+        skip_prompt: bool = False,
+        timeout: Optional[float] = None,
+        **decode_kwargs
+    ):
+        super().__init__(tokenizer, skip_prompt, timeout, **decode_kwargs)
+        self.detokenizer = IncrementalDetokenizer(tokenizer, **decode_kwargs)
+
+    def put(self, value):
+        if len(value.shape) > 1:
+            invalidInputError(value.shape[0] == 1,
+                              "IncrementalTextIteratorStreamer only supports batch size 1")
+            value = value[0]
+
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+
+        self.on_finalized_text(self.detokenizer.put(value.tolist()))
+
+    def end(self):
+        printable_text = self.detokenizer.flush()
+        self.next_tokens_are_prompt = True
+        self.on_finalized_text(printable_text, stream_end=True)
+
 
 class BatchTextIteratorStreamer(TextIteratorStreamer):
     """
@@ -57,8 +198,8 @@ class BatchTextIteratorStreamer(TextIteratorStreamer):
     ):
         super().__init__(tokenizer, skip_prompt, timeout, **decode_kwargs)
         self.batch_size = batch_size
-        self.token_cache = [[] for _ in range(batch_size)]
-        self.print_len = [0 for _ in range(batch_size)]
+        self.detokenizers = [IncrementalDetokenizer(tokenizer, **decode_kwargs)
+                             for _ in range(batch_size)]
         self.generate_exception = None
 
     def put(self, value):
@@ -73,37 +214,12 @@ class BatchTextIteratorStreamer(TextIteratorStreamer):
 
         printable_texts = list()
         for idx in range(self.batch_size):
-            self.token_cache[idx].extend(value[idx].tolist())
-            text = self.tokenizer.decode(self.token_cache[idx], **self.decode_kwargs)
-
-            if text.endswith("\n"):
-                printable_text = text[self.print_len[idx]:]
-                self.token_cache[idx] = []
-                self.print_len[idx] = 0
-                # If the last token is a CJK character, we print the characters.
-            elif len(text) > 0 and self._is_chinese_char(ord(text[-1])):
-                printable_text = text[self.print_len[idx]:]
-                self.print_len[idx] += len(printable_text)
-            else:
-                printable_text = text[self.print_len[idx]:text.rfind(" ") + 1]
-                self.print_len[idx] += len(printable_text)
-            printable_texts.append(printable_text)
+            printable_texts.append(self.detokenizers[idx].put(value[idx].tolist()))
 
         self.on_finalized_text(printable_texts)
 
     def end(self):
-        printable_texts = list()
-        for idx in range(self.batch_size):
-            if len(self.token_cache[idx]) > 0:
-                text = self.tokenizer.decode(
-                    self.token_cache[idx], **self.decode_kwargs
-                )
-                printable_text = text[self.print_len[idx]:]
-                self.token_cache[idx] = []
-                self.print_len[idx] = 0
-            else:
-                printable_text = ""
-            printable_texts.append(printable_text)
+        printable_texts = [detokenizer.flush() for detokenizer in self.detokenizers]
 
         self.next_tokens_are_prompt = True
         self.on_finalized_text(printable_texts, stream_end=True)
@@ -56,11 +56,45 @@ logger = logging.getLogger(__name__)
 
 WEIGHTS_NAME = "pytorch_model.bin"
 WEIGHTS_INDEX_NAME = "pytorch_model.bin.index.json"
+SAFE_WEIGHTS_NAME = "model.safetensors"
+SAFE_WEIGHTS_INDEX_NAME = "model.safetensors.index.json"
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
 
 
 def extract_local_archive_file(pretrained_model_name_or_path, subfolder, variant=None):
     pretrained_model_name_or_path = str(pretrained_model_name_or_path)
     if os.path.isfile(
+        os.path.join(pretrained_model_name_or_path, subfolder,
+                     _add_variant(SAFE_WEIGHTS_NAME, variant))
+    ):
+        # Load from a safetensors checkpoint
+        archive_file = os.path.join(
+            pretrained_model_name_or_path, subfolder, _add_variant(SAFE_WEIGHTS_NAME, variant)
+        )
+        return archive_file, False
+    elif os.path.isfile(
+        os.path.join(pretrained_model_name_or_path, subfolder,
+                     _add_variant(SAFE_WEIGHTS_INDEX_NAME, variant))
+    ):
+        # Load from a sharded safetensors checkpoint
+        archive_file = os.path.join(
+            pretrained_model_name_or_path, subfolder,
+            _add_variant(SAFE_WEIGHTS_INDEX_NAME, variant)
+        )
+        return archive_file, True
+    elif os.path.isfile(
         os.path.join(pretrained_model_name_or_path, subfolder, _add_variant(WEIGHTS_NAME, variant))
     ):
         # Load from a PyTorch checkpoint
@@ -86,7 +120,53 @@ def extract_local_archive_file(pretrained_model_name_or_path, subfolder, variant
                           f" {pretrained_model_name_or_path}.")
 
 
-def load_state_dict(checkpoint_file: Union[str, os.PathLike]):
+def load_safetensors_mmap(checkpoint_file: Union[str, os.PathLike], read_ahead: bool=True):
+    """
+    Load a safetensors checkpoint as zero-copy views of a copy-on-write mmap of the file,
+    so that tensors are only paged in when used and never copied by the loader.
+    `read_ahead` starts reading the whole file into the page cache in background.
+    """
+    import json
+    import mmap
+    import struct
+
+    with open(checkpoint_file, "rb") as f:
+        header_size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if read_ahead and hasattr(mmap, "MADV_WILLNEED"):
+        # start reading the whole file in background
+        buffer.madvise(mmap.MADV_WILLNEED)
+
+    header.pop("__metadata__", None)
+    state_dict = {}
+    for name, info in header.items():
+        invalidInputError(info["dtype"] in SAFETENSORS_DTYPES,
+                          f"Unsupported dtype {info['dtype']} of {name} in {checkpoint_file}")
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            state_dict[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        tensor = torch.frombuffer(buffer, dtype=torch.uint8,
+                                  offset=8 + header_size + begin, count=end - begin)
+        state_dict[name] = tensor.view(dtype).reshape(info["shape"])
+    return state_dict
+
+
+def load_state_dicts(checkpoint_files, num_threads: int=8, read_ahead: bool=True):
+    """Load several checkpoint shards in parallel, return their state dicts in order."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    num_threads = max(1, min(num_threads, len(checkpoint_files)))
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(lambda f: load_state_dict(f, read_ahead=read_ahead),
+                                 checkpoint_files))
+
+
+def load_state_dict(checkpoint_file: Union[str, os.PathLike], read_ahead: bool=True):
+    if str(checkpoint_file).endswith(".safetensors"):
+        return load_safetensors_mmap(checkpoint_file, read_ahead=read_ahead)
     try:
         return torch.load(checkpoint_file, map_location="cpu")
     except Exception as e:
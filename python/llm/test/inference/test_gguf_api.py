@@ -0,0 +1,260 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import struct
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from ipex_llm.transformers.gguf.api import load_gguf_model
+from ipex_llm.transformers.gguf.gguf import GGUFTensorLoader
+
+
+QK_K = 256
+
+
+# reference dequantization, following dequantize_row_q*_K in llama.cpp ggml-quants.c
+def _f16(b):
+    return float(np.frombuffer(bytes(b), dtype=np.float16)[0])
+
+
+def _scale_min_k4(j, q):
+    if j < 4:
+        return q[j] & 63, q[j + 4] & 63
+    return (q[j + 4] & 0xF) | ((q[j - 4] >> 6) << 4), (q[j + 4] >> 4) | ((q[j] >> 6) << 4)
+
+
+def ref_q2_k(block):
+    scales, qs, d, dmin = block[:16], block[16:80], _f16(block[80:82]), _f16(block[82:84])
+    y, i = [], 0
+    for n in range(2):
+        q = qs[32 * n:32 * n + 32]
+        for shift in (0, 2, 4, 6):
+            for half in range(2):
+                sc = scales[i]
+                i += 1
+                for l in range(16):
+                    y.append(d * (sc & 0xF) * ((q[16 * half + l] >> shift) & 3) - dmin * (sc >> 4))
+    return y
+
+
+def ref_q3_k(block):
+    hmask, qs, d = block[:32], block[32:96], _f16(block[108:110])
+    aux = list(np.frombuffer(bytes(block[96:108]), dtype=np.uint32)) + [0]
+    kmask1, kmask2 = 0x03030303, 0x0f0f0f0f
+    tmp = aux[2]
+    aux[2] = ((aux[0] >> 4) & kmask2) | (((tmp >> 4) & kmask1) << 4)
+    aux[3] = ((aux[1] >> 4) & kmask2) | (((tmp >> 6) & kmask1) << 4)
+    aux[0] = (aux[0] & kmask2) | (((tmp >> 0) & kmask1) << 4)
+    aux[1] = (aux[1] & kmask2) | (((tmp >> 2) & kmask1) << 4)
+    scales = np.array(aux, dtype=np.uint32).view(np.int8).astype(np.int32)
+    y, i, m = [], 0, 1
+    for n in range(2):
+        q = qs[32 * n:32 * n + 32]
+        for shift in (0, 2, 4, 6):
+            for half in range(2):
+                dl = d * (scales[i] - 32)
+                i += 1
+                for l in range(16 * half, 16 * half + 16):
+                    y.append(dl * (((q[l] >> shift) & 3) - (0 if hmask[l] & m else 4)))
+            m <<= 1
+    return y
+
+
+def ref_q4_k(block):
+    d, dmin, scales, qs = _f16(block[:2]), _f16(block[2:4]), block[4:16], block[16:]
+    y = []
+    for j in range(4):
+        sc1, m1 = _scale_min_k4(2 * j, scales)
+        sc2, m2 = _scale_min_k4(2 * j + 1, scales)
+        q = qs[32 * j:32 * j + 32]
+        y += [d * sc1 * (x & 0xF) - dmin * m1 for x in q]
+        y += [d * sc2 * (x >> 4) - dmin * m2 for x in q]
+    return y
+
+
+def ref_q5_k(block):
+    d, dmin, scales = _f16(block[:2]), _f16(block[2:4]), block[4:16]
+    qh, qs = block[16:48], block[48:]
+    y, u1, u2 = [], 1, 2
+    for j in range(4):
+        sc1, m1 = _scale_min_k4(2 * j, scales)
+        sc2, m2 = _scale_min_k4(2 * j + 1, scales)
+        q = qs[32 * j:32 * j + 32]
+        y += [d * sc1 * ((q[l] & 0xF) + (16 if qh[l] & u1 else 0)) - dmin * m1
+              for l in range(32)]
+        y += [d * sc2 * ((q[l] >> 4) + (16 if qh[l] & u2 else 0)) - dmin * m2
+              for l in range(32)]
+        u1 <<= 2
+        u2 <<= 2
+    return y
+
+
+def ref_q6_k(block):
+    ql, qh, d = block[:128], block[128:192], _f16(block[208:210])
+    sc = np.frombuffer(bytes(block[192:208]), dtype=np.int8).astype(np.int32)
+    y = [0.0] * QK_K
+    for n in range(2):
+        for l in range(32):
+            i = l // 16
+            q1 = ((ql[64 * n + l] & 0xF) | (((qh[32 * n + l] >> 0) & 3) << 4)) - 32
+            q2 = ((ql[64 * n + l + 32] & 0xF) | (((qh[32 * n + l] >> 2) & 3) << 4)) - 32
+            q3 = ((ql[64 * n + l] >> 4) | (((qh[32 * n + l] >> 4) & 3) << 4)) - 32
+            q4 = ((ql[64 * n + l + 32] >> 4) | (((qh[32 * n + l] >> 6) & 3) << 4)) - 32
+            y[128 * n + l] = d * sc[8 * n + i] * q1
+            y[128 * n + l + 32] = d * sc[8 * n + i + 2] * q2
+            y[128 * n + l + 64] = d * sc[8 * n + i + 4] * q3
+            y[128 * n + l + 96] = d * sc[8 * n + i + 6] * q4
+    return y
+
+
+def ref_q8_k(block):
+    d = float(np.frombuffer(bytes(block[:4]), dtype=np.float32)[0])
+    return [d * x for x in np.frombuffer(bytes(block[4:260]), dtype=np.int8)]
+
+
+# qtype -> (reference, byte offsets of the fp16 / fp32 scales in a block)
+K_QUANTS = {
+    10: (ref_q2_k, [80, 82], []),
+    11: (ref_q3_k, [108], []),
+    12: (ref_q4_k, [0, 2], []),
+    13: (ref_q5_k, [0, 2], []),
+    14: (ref_q6_k, [208], []),
+    15: (ref_q8_k, [], [0]),
+}
+
+
+def random_blocks(qtype, num_blocks, block_size, rng):
+    blocks = rng.integers(0, 256, size=(num_blocks, block_size), dtype=np.uint8)
+    _, f16_offsets, f32_offsets = K_QUANTS[qtype]
+    for offset in f16_offsets:
+        scales = rng.uniform(0.001, 0.1, size=num_blocks).astype(np.float16)
+        blocks[:, offset:offset + 2] = scales.view(np.uint8).reshape(num_blocks, 2)
+    for offset in f32_offsets:
+        scales = rng.uniform(0.001, 0.1, size=num_blocks).astype(np.float32)
+        blocks[:, offset:offset + 4] = scales.view(np.uint8).reshape(num_blocks, 4)
+    return blocks
+
+
+def write_gguf(path, config, tensors):
+    """Write a gguf v3 file, `tensors` is a list of (name, dims, qtype, raw bytes)."""
+    def string(s):
+        s = s.encode()
+        return struct.pack("<Q", len(s)) + s
+
+    def value(v):
+        if isinstance(v, str):
+            return struct.pack("<I", 8) + string(v)
+        if isinstance(v, float):
+            return struct.pack("<If", 6, v)
+        if isinstance(v, int):
+            return struct.pack("<Ii", 5, v)
+        if isinstance(v[0], str):
+            return struct.pack("<IIQ", 9, 8, len(v)) + b"".join(string(x) for x in v)
+        if isinstance(v[0], float):
+            return struct.pack("<IIQ", 9, 6, len(v)) + struct.pack(f"<{len(v)}f", *v)
+        return struct.pack("<IIQ", 9, 5, len(v)) + struct.pack(f"<{len(v)}i", *v)
+
+    data = b""
+    infos = b""
+    for name, dims, qtype, raw in tensors:
+        infos += string(name) + struct.pack("<I", len(dims))
+        infos += b"".join(struct.pack("<Q", d) for d in reversed(dims))
+        infos += struct.pack("<IQ", qtype, len(data))
+        data += raw + b"\0" * (-len(raw) % 32)
+    header = b"GGUF" + struct.pack("<IQQ", 3, len(tensors), len(config))
+    header += b"".join(string(k) + value(v) for k, v in config.items()) + infos
+    with open(path, "wb") as f:
+        f.write(header + b"\0" * (-len(header) % 32) + data)
+
+
+class TestGGUFKQuants(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.loader = GGUFTensorLoader("", SimpleNamespace(infos=[], base_offset=0))
+
+    def test_dequantize_k_quants(self):
+        for qtype, (ref, _, _) in K_QUANTS.items():
+            block_size = self.loader.block_size[qtype]
+            blocks = random_blocks(qtype, 4, block_size, self.rng)
+            dims = [2, 2 * QK_K]
+            result = self.loader.convert_funcs[qtype](torch.from_numpy(blocks.reshape(-1)),
+                                                      blocks.size, len(dims), dims)
+            expected = torch.tensor([ref(block.tolist()) for block in blocks],
+                                    dtype=torch.float).reshape(dims)
+            self.assertEqual(list(result.shape), dims)
+            # the conversion runs in fp16
+            torch.testing.assert_close(result.float(), expected, rtol=2e-3,
+                                       atol=2e-3 * expected.abs().max().item(),
+                                       msg=f"qtype {qtype}")
+
+    def test_load_q4_k_m_model(self):
+        pieces = ["<unk>", "<s>", "</s>"] + [f"<0x{i:02X}>" for i in range(256)] + \
+            ["▁a", "▁b", "▁c", "a", "b"]
+        vocab_size, hidden_size, num_heads = len(pieces), QK_K, 4
+        config = {
+            "general.architecture": "llama",
+            "general.name": "tiny-llama",
+            "general.file_type": 15,    # q4_k_m
+            "llama.context_length": 128,
+            "llama.embedding_length": hidden_size,
+            "llama.feed_forward_length": hidden_size,
+            "llama.block_count": 1,
+            "llama.attention.head_count": num_heads,
+            "llama.attention.head_count_kv": num_heads,
+            "llama.attention.layer_norm_rms_epsilon": 1e-5,
+            "tokenizer.ggml.model": "llama",
+            "tokenizer.ggml.tokens": pieces,
+            "tokenizer.ggml.scores": [0.0] * vocab_size,
+            "tokenizer.ggml.token_type": [2, 3, 3] + [6] * 256 + [1] * 5,
+            "tokenizer.ggml.bos_token_id": 1,
+            "tokenizer.ggml.eos_token_id": 2,
+        }
+        embed_blocks = random_blocks(12, vocab_size, self.loader.block_size[12], self.rng)
+        tensors = [("token_embd.weight", [vocab_size, hidden_size], 12, embed_blocks.tobytes())]
+        shapes = {"output.weight": [vocab_size, hidden_size], "output_norm.weight": [hidden_size],
+                  "blk.0.attn_norm.weight": [hidden_size], "blk.0.ffn_norm.weight": [hidden_size]}
+        for name in ["attn_q", "attn_k", "attn_v", "attn_output",
+                     "ffn_gate", "ffn_up", "ffn_down"]:
+            shapes[f"blk.0.{name}.weight"] = [hidden_size, hidden_size]
+        for name, dims in shapes.items():
+            # like llama.cpp, keep norms in f32 and the other weights in f16
+            dtype, qtype = (np.float32, 0) if len(dims) == 1 else (np.float16, 1)
+            weight = (self.rng.standard_normal(dims) * 0.02).astype(dtype)
+            tensors.append((name, dims, qtype, weight.tobytes()))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "tiny-llama-q4_k_m.gguf")
+            write_gguf(path, config, tensors)
+            model, tokenizer = load_gguf_model(path, dtype=torch.float)
+
+        expected = torch.tensor([ref_q4_k(block.tolist()) for block in embed_blocks],
+                                dtype=torch.float)
+        torch.testing.assert_close(model.model.embed_tokens.weight.data, expected, rtol=2e-3,
+                                   atol=2e-3 * expected.abs().max().item())
+        self.assertEqual(model.config.vocab_size, vocab_size)
+        self.assertEqual(len(tokenizer), vocab_size)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
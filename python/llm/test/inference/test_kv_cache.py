@@ -0,0 +1,339 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import unittest
+import torch
+import pytest
+
+from unittest import mock
+
+from ipex_llm.transformers.kv import KVBlockPool, DynamicNormalCache, DynamicPagedCache, \
+    DynamicQuantizedCache, DynamicSinkCache, get_normal_cache_cls
+
+
+class TestPagedKVCache(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        KVBlockPool._pools = {}
+        # small blocks, so that a few tokens span several blocks and chunks
+        patcher = mock.patch("ipex_llm.transformers.kv.KV_CACHE_BLOCK_SIZE", 8)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_cache(self, cache, batch_size, lengths, num_layers=2, num_heads=2, head_dim=8):
+        keys = [[] for _ in range(num_layers)]
+        values = [[] for _ in range(num_layers)]
+        for length in lengths:
+            for layer_idx in range(num_layers):
+                k = torch.randn(batch_size, num_heads, length, head_dim)
+                v = torch.randn(batch_size, num_heads, length, head_dim)
+                keys[layer_idx].append(k)
+                values[layer_idx].append(v)
+                k_cache, v_cache = cache.update(k, v, layer_idx)
+                self.assertTrue(torch.equal(k_cache, torch.cat(keys[layer_idx], dim=2)))
+                self.assertTrue(torch.equal(v_cache, torch.cat(values[layer_idx], dim=2)))
+        return keys, values
+
+    @staticmethod
+    def attention(query, key, value, attention_mask=None):
+        n_rep = query.size(1) // key.size(1)
+        key = key.repeat_interleave(n_rep, dim=1)
+        value = value.repeat_interleave(n_rep, dim=1)
+        scores = query @ key.transpose(-1, -2) / key.size(-1) ** 0.5
+        if attention_mask is None:
+            q_len, kv_len = query.size(2), key.size(2)
+            attention_mask = torch.full((q_len, kv_len), float("-inf"))
+            attention_mask = attention_mask.triu(kv_len - q_len + 1)
+        return (scores + attention_mask).softmax(dim=-1) @ value
+
+    def test_update_matches_concat(self):
+        for batch_size in [1, 3]:
+            cache = DynamicPagedCache()
+            # prefill across several blocks and chunks, then decode across block boundaries
+            self.run_cache(cache, batch_size, [140] + [1] * 30)
+            self.assertEqual(cache.get_seq_length(), 170)
+            self.assertEqual(len(cache.block_table), 22)
+            k_cache, v_cache = cache[1]
+            self.assertEqual(k_cache.shape, (batch_size, 2, 170, 8))
+
+    def test_appends_write_in_place(self):
+        cache = DynamicPagedCache()
+        keys, _ = self.run_cache(cache, 2, [10] + [1] * 100)
+        # the blocks of a single sequence are consecutive and hold the tokens where
+        # they were first written
+        self.assertEqual(cache.block_table, list(range(14)))
+        k_chunk, _ = cache.pool.layer_chunk(0, 0)
+        self.assertTrue(torch.equal(k_chunk[0], keys[0][0][:, :, :8]))
+        self.assertTrue(torch.equal(k_chunk[1, :, :, :2], keys[0][0][:, :, 8:]))
+
+    def test_attention_matches_sdpa(self):
+        for batch_size, num_heads in [(1, 2), (2, 4)]:
+            cache = DynamicPagedCache()
+            # another cache allocating at the same time interleaves the blocks
+            other = DynamicPagedCache()
+            keys = torch.randn(batch_size, 2, 60, 8)
+            values = torch.randn(batch_size, 2, 60, 8)
+            queries = torch.randn(batch_size, num_heads, 60, 8)
+            # the second token of the first sequence is masked out
+            padding_mask = torch.zeros(batch_size, 1, 1, 60)
+            padding_mask[0, :, :, 1] = float("-inf")
+            start = 0
+            for length in [20, 1, 5, 1, 9, 1, 23]:
+                end = start + length
+                other.append(keys[:, :, :length], values[:, :, :length], 0)
+                for mask in [None, padding_mask]:
+                    attention_mask = None
+                    if mask is not None:
+                        causal_mask = torch.full((length, end), float("-inf"))
+                        attention_mask = mask[:, :, :, :end] + causal_mask.triu(start + 1)
+                    output = cache.attention(queries[:, :, start:end], keys[:, :, start:end],
+                                             values[:, :, start:end], 0, attention_mask)
+                    expected = self.attention(queries[:, :, start:end], keys[:, :, :end],
+                                              values[:, :, :end], attention_mask)
+                    torch.testing.assert_close(output, expected)
+                    # attend again with the same kv on the next round
+                    cache.crop(start)
+                cache.append(keys[:, :, start:end], values[:, :, start:end], 0)
+                start = end
+            self.assertNotEqual(cache.block_table, list(range(len(cache.block_table))))
+
+    def test_exports_are_copies(self):
+        cache = DynamicPagedCache()
+        keys, _ = self.run_cache(cache, 1, [30])
+        k_cache, _ = cache.to_legacy_cache()[0]
+        cache.free()
+        # a later request reuses and overwrites the blocks
+        self.run_cache(DynamicPagedCache(), 1, [30])
+        self.assertTrue(torch.equal(k_cache, keys[0][0]))
+
+    def test_blocks_are_reused(self):
+        cache = DynamicPagedCache()
+        self.run_cache(cache, 1, [30, 1])
+        block_table = cache.block_table
+        pool = cache.pool
+        del cache
+        self.assertEqual(KVBlockPool.free_nbytes(), 2 * 2 * 16 * 2 * 8 * 8 * 4)
+        cache = DynamicPagedCache()
+        self.run_cache(cache, 1, [25])
+        self.assertIs(cache.pool, pool)
+        self.assertEqual(cache.block_table, block_table)
+
+    def test_free_blocks_are_evicted(self):
+        cache = DynamicPagedCache()
+        other = DynamicPagedCache()
+        # two chunks, the second one used by both caches
+        self.run_cache(cache, 1, [200])
+        self.run_cache(other, 1, [8])
+        pool = cache.pool
+        chunk_nbytes = 2 * 2 * 16 * 2 * 8 * 8 * 4
+        with mock.patch("ipex_llm.transformers.kv.KV_CACHE_POOL_BYTES", chunk_nbytes):
+            cache.free()
+            # the first chunk is released, the free blocks of the second one are kept
+            self.assertIsNone(pool.chunks[0])
+            self.assertIsNotNone(pool.chunks[1])
+            self.assertEqual(KVBlockPool.free_nbytes(), chunk_nbytes * 15 // 16)
+            self.assertEqual(sorted(pool.free_ids), list(range(16, 25)) + list(range(26, 32)))
+            other.free()
+            self.assertEqual(pool.chunks, [None, pool.chunks[1]])
+        KVBlockPool.evict()
+        self.assertEqual(pool.chunks, [None, None])
+        self.assertEqual(KVBlockPool.free_nbytes(), 0)
+        # released chunks are allocated again
+        self.run_cache(cache, 1, [20])
+        self.assertEqual(cache.block_table, [0, 1, 2])
+
+    def test_crop_and_reorder(self):
+        from ipex_llm.transformers.speculative import _crop_past_key_values
+        cache = DynamicPagedCache()
+        keys, values = self.run_cache(cache, 2, [20], num_layers=1)
+        # crop like speculative decoding
+        _crop_past_key_values(None, cache, 5)
+        self.assertEqual(cache.get_seq_length(), 15)
+        self.assertEqual(len(cache.block_table), 2)
+        k = torch.randn(2, 2, 3, 8)
+        k_cache, _ = cache.update(k, k, 0)
+        self.assertTrue(torch.equal(k_cache, torch.cat([keys[0][0][:, :, :15], k], dim=2)))
+        # reorder like beam search
+        cache.reorder_cache(torch.tensor([1, 1]))
+        expected = k_cache[[1, 1]]
+        k = torch.randn(2, 2, 1, 8)
+        k_cache, _ = cache.update(k, k, 0)
+        self.assertTrue(torch.equal(k_cache, torch.cat([expected, k], dim=2)))
+
+
+class TestQuantizedKVCache(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_quantize_round_trip(self):
+        x = torch.randn(2, 4, 30, 64) * torch.rand(2, 4, 30, 1) * 10
+        x_quant, scale = DynamicQuantizedCache.quantize(x)
+        self.assertEqual(x_quant.dtype, torch.int8)
+        self.assertEqual(scale.shape, (2, 4, 30, 1))
+        error = (DynamicQuantizedCache.dequantize(x_quant, scale, torch.float32) - x).abs()
+        # at most half a quantization step per token
+        self.assertTrue(torch.all(error <= scale / 2 + 1e-6))
+        zeros_quant, zeros_scale = DynamicQuantizedCache.quantize(torch.zeros(1, 1, 2, 8))
+        self.assertTrue(torch.equal(DynamicQuantizedCache.dequantize(zeros_quant, zeros_scale,
+                                                                     torch.float32),
+                                    torch.zeros(1, 1, 2, 8)))
+
+    def test_attention_matches_dequantized(self):
+        for batch_size, num_heads in [(1, 2), (2, 4)]:
+            cache = DynamicQuantizedCache()
+            keys = torch.randn(batch_size, 2, 300, 8)
+            values = torch.randn(batch_size, 2, 300, 8)
+            queries = torch.randn(batch_size, num_heads, 300, 8)
+            # the second token of the first sequence is masked out
+            padding_mask = torch.zeros(batch_size, 1, 1, 300)
+            padding_mask[0, :, :, 1] = float("-inf")
+            start = 0
+            for length in [20, 1, 5, 250, 1, 23]:
+                end = start + length
+                causal_mask = torch.full((length, end), float("-inf")).triu(start + 1)
+                attention_mask = padding_mask[:, :, :, :end] + causal_mask
+                output = cache.attention(queries[:, :, start:end], keys[:, :, start:end],
+                                         values[:, :, start:end], 0, attention_mask)
+                if start == 0:
+                    # the prompt attends to its own kv before quantization
+                    k, v = keys[:, :, :end], values[:, :, :end]
+                else:
+                    k, v = cache.to_legacy_cache()[0]
+                expected = TestPagedKVCache.attention(queries[:, :, start:end], k, v,
+                                                      attention_mask)
+                torch.testing.assert_close(output, expected)
+                start = end
+            self.assertEqual(cache.get_seq_length(), 300)
+
+    def test_storage_and_legacy_dtype(self):
+        cache = DynamicQuantizedCache()
+        k = torch.randn(1, 2, 10, 64).bfloat16()
+        cache.attention(torch.randn(1, 2, 10, 64).bfloat16(), k, k, 0)
+        self.assertEqual(cache.key_cache[0].dtype, torch.int8)
+        legacy_k, legacy_v = cache.to_legacy_cache()[0]
+        self.assertEqual(legacy_k.dtype, torch.bfloat16)
+        torch.testing.assert_close(legacy_k, k, atol=0.05, rtol=0.02)
+
+    def test_crop(self):
+        from ipex_llm.transformers.speculative import _crop_past_key_values
+        cache = DynamicQuantizedCache()
+        keys = torch.randn(1, 2, 24, 8)
+        cache.update(keys[:, :, :20], keys[:, :, :20], 0)
+        _crop_past_key_values(None, cache, 6)
+        self.assertEqual(cache.get_seq_length(), 14)
+        k, _ = cache.update(keys[:, :, 20:], keys[:, :, 20:], 0)
+        self.assertEqual(cache.key_scale[0].size(2), 18)
+        k_quant, k_scale = DynamicQuantizedCache.quantize(torch.cat([keys[:, :, :14],
+                                                                     keys[:, :, 20:]], dim=2))
+        torch.testing.assert_close(k, DynamicQuantizedCache.dequantize(k_quant, k_scale,
+                                                                       torch.float32))
+
+    def test_get_normal_cache_cls(self):
+        x = torch.randn(1, 4)
+        for quantize, paged, cache_cls in [("0", "0", DynamicNormalCache),
+                                           ("1", "0", DynamicQuantizedCache),
+                                           ("0", "1", DynamicPagedCache),
+                                           ("1", "1", DynamicQuantizedCache)]:
+            with mock.patch.dict(os.environ, {"IPEX_LLM_QUANTIZE_KV_CACHE": quantize,
+                                              "IPEX_LLM_PAGED_KV_CACHE": paged}):
+                self.assertIs(get_normal_cache_cls(x), cache_cls)
+                # both are CPU only
+                self.assertIs(get_normal_cache_cls(x.to("meta")), DynamicNormalCache)
+
+
+class TestSinkKVCache(unittest.TestCase):
+    window_length = 8
+    num_sink_tokens = 2
+    head_dim = 8
+
+    def setUp(self):
+        torch.manual_seed(0)
+        inv_freq = 1.0 / (10000 ** (torch.arange(0, self.head_dim, 2).float() / self.head_dim))
+        freqs = torch.outer(torch.arange(64).float(), inv_freq)
+        emb = torch.cat([freqs, freqs], dim=-1)
+        self.cos, self.sin = emb.cos(), emb.sin()
+
+    def rotate(self, x, positions):
+        # rotate-half rope like llama
+        x1, x2 = x.chunk(2, dim=-1)
+        return x * self.cos[positions] + torch.cat([-x2, x1], dim=-1) * self.sin[positions]
+
+    @staticmethod
+    def attention(query, key, value):
+        scores = query @ key.transpose(-1, -2) / key.size(-1) ** 0.5
+        return scores.softmax(dim=-1) @ value
+
+    def test_matches_sink_cache(self):
+        from transformers.cache_utils import SinkCache
+        window, sink = self.window_length, self.num_sink_tokens
+        cache_kwargs = {"cos": self.cos, "sin": self.sin}
+        for prompt_len in [window - 3, window, window + 3]:
+            cache = DynamicSinkCache(window, sink)
+            ref_cache = SinkCache(window, sink)
+            num_tokens = max(prompt_len, window) + 2 * (window - sink)
+            keys = torch.randn(2, 2, num_tokens, self.head_dim)
+            values = torch.randn(2, 2, num_tokens, self.head_dim)
+
+            # the prompt is rotated at its positions in the sequence and fully attended to
+            k = self.rotate(keys[:, :, :prompt_len], torch.arange(prompt_len))
+            k_out, v_out = cache.update(k, values[:, :, :prompt_len], 0)
+            ref_k, ref_v = ref_cache.update(k, values[:, :, :prompt_len], 0, cache_kwargs)
+            torch.testing.assert_close(k_out, ref_k)
+            torch.testing.assert_close(v_out, ref_v)
+
+            for i in range(prompt_len, num_tokens):
+                # new tokens are rotated at their positions in the cache, like `generate`
+                # does with the attention mask cropped to `window_length`
+                position = min(cache.get_seq_length() + 1, window) - 1
+                k = self.rotate(keys[:, :, i:i + 1], torch.tensor([position]))
+                k_out, v_out = cache.update(k, values[:, :, i:i + 1], 0)
+                ref_k, ref_v = ref_cache.update(k, values[:, :, i:i + 1], 0, cache_kwargs)
+
+                # the sink tokens and the most recent tokens, rotated at their cache positions
+                if i < window:
+                    kept = list(range(i + 1))
+                else:
+                    kept = list(range(sink)) + list(range(i + 1 - window + sink, i + 1))
+                expected_k = self.rotate(keys[:, :, kept], torch.arange(len(kept)))
+                # the kv of decoding is not in sequence order, so compare attention outputs
+                query = torch.randn(2, 2, 1, self.head_dim)
+                output = self.attention(query, k_out, v_out)
+                torch.testing.assert_close(
+                    output, self.attention(query, expected_k, values[:, :, kept]))
+                # `SinkCache` assumes it was full when it first evicts, the keys it keeps then
+                # are rotated to wrong positions until they are evicted in turn
+                if i >= max(prompt_len, window) + window - sink:
+                    torch.testing.assert_close(output, self.attention(query, ref_k, ref_v))
+
+            legacy_k, legacy_v = cache.to_legacy_cache()[0]
+            torch.testing.assert_close(legacy_k, ref_cache.key_cache[0])
+            torch.testing.assert_close(legacy_v, ref_cache.value_cache[0])
+
+    def test_crop_is_rejected(self):
+        from ipex_llm.transformers.speculative import _crop_past_key_values
+        cache = DynamicSinkCache(self.window_length, self.num_sink_tokens)
+        k = torch.randn(1, 2, 4, self.head_dim)
+        cache.update(k, k, 0)
+        with self.assertRaises(RuntimeError):
+            _crop_past_key_values(None, cache, 1)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
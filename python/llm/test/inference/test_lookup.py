@@ -0,0 +1,129 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import random
+import unittest
+import torch
+import pytest
+
+from unittest import mock
+from ipex_llm.transformers.lookup import PromptLookupCandidateGenerator, \
+    _batched_lookup_generate
+
+
+def baseline_candidate(tokens, max_matching_ngram_size, num_output_tokens):
+    # the lookup table of the first occurrence of each ngram, rebuilt from all the tokens
+    input_ids = torch.tensor([tokens])
+    lookup_table = {}
+    for ngram_size in range(max_matching_ngram_size, 0, -1):
+        windows = input_ids.unfold(dimension=1, size=ngram_size, step=1)
+        for idx in range(windows.size(1)):
+            lookup_table.setdefault(tuple(windows[0, idx].tolist()), idx)
+    input_length = len(tokens)
+    for ngram_size in range(min(max_matching_ngram_size, input_length - 1), 0, -1):
+        start_idx = lookup_table[tuple(tokens[-ngram_size:])] + ngram_size
+        end_idx = min(start_idx + num_output_tokens, input_length)
+        if start_idx < end_idx:
+            return tokens[start_idx:end_idx]
+    return []
+
+
+class TestPromptLookup(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+
+    def test_matches_baseline(self):
+        for _ in range(50):
+            max_matching_ngram_size = random.randint(1, 3)
+            num_output_tokens = random.randint(1, 6)
+            generator = PromptLookupCandidateGenerator(num_output_tokens,
+                                                       max_matching_ngram_size)
+            tokens = [random.randrange(5) for _ in range(random.randint(3, 30))]
+            generator.init_look_up_table(torch.tensor([tokens]))
+            for _ in range(20):
+                input_ids = torch.tensor([tokens])
+                candidate_ids, _ = generator.get_candidates(input_ids)
+                self.assertEqual(candidate_ids[0, len(tokens):].tolist(),
+                                 baseline_candidate(tokens, max_matching_ngram_size,
+                                                    num_output_tokens))
+                tokens = tokens + [random.randrange(5) for _ in range(random.randint(1, 4))]
+                generator.update_look_up_table(torch.tensor([tokens]))
+
+    def test_hash_collisions(self):
+        # every ngram ending with the same token shares its hash
+        last_token = staticmethod(lambda ngrams: ngrams[:, -1].clone())
+        with mock.patch.object(PromptLookupCandidateGenerator, "_hash_ngrams", last_token):
+            generator = PromptLookupCandidateGenerator(2, 2)
+            generator.init_look_up_table(torch.tensor([[1, 3, 7, 2, 3, 8, 2, 3, 9]]))
+            self.assertEqual(generator._followers([2, 3]), {8: [1, 3], 9: [1, 6]})
+            self.assertEqual(generator._followers([1, 3]), {7: [1, 0]})
+
+    def test_candidate_ranking(self):
+        # "1 2" is followed by 3 once, then by 4 twice
+        tokens = [1, 2, 3, 0, 1, 2, 4, 0, 1, 2, 4, 5, 1, 2]
+        generator = PromptLookupCandidateGenerator(2, 2)
+        generator.init_look_up_table(torch.tensor([tokens]))
+        input_ids = torch.tensor([tokens])
+        # a single candidate follows the first occurrence
+        candidates = generator.get_candidate_list(input_ids)
+        self.assertEqual([c.tolist() for c in candidates], [[3, 0]])
+        candidates = generator.get_candidate_list(input_ids, num_candidates=2)
+        self.assertEqual([c.tolist() for c in candidates], [[4, 0], [3, 0]])
+        # the accepted tokens are counted as well
+        tokens = tokens + [3, 6, 1, 2]
+        generator.update_look_up_table(torch.tensor([tokens]))
+        candidates = generator.get_candidate_list(torch.tensor([tokens]), num_candidates=3)
+        self.assertEqual([c.tolist() for c in candidates], [[3, 0], [4, 0]])
+
+
+class TestBatchedLookup(unittest.TestCase):
+
+    def test_matches_greedy(self):
+        from transformers import LlamaConfig, LlamaForCausalLM, GenerationConfig, \
+            LogitsProcessorList
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=50, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+                             initializer_range=0.2, attn_implementation="eager")
+        model = LlamaForCausalLM(config).eval()
+        # repeated prompts, so that some candidates are accepted
+        prompts = [torch.randint(0, 50, (length // 2 + 1,)).repeat(2)[:length]
+                   for length in [12, 20, 7, 15]]
+        max_len = max(len(prompt) for prompt in prompts)
+        input_ids = torch.zeros(len(prompts), max_len, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for idx, prompt in enumerate(prompts):
+            input_ids[idx, max_len - len(prompt):] = prompt
+            attention_mask[idx, max_len - len(prompt):] = 1
+        generation_config = GenerationConfig(do_sample=False, pad_token_id=0, eos_token_id=2,
+                                             max_new_tokens=60)
+        output = _batched_lookup_generate(model, input_ids, 60, 3, 2, generation_config,
+                                          LogitsProcessorList(), attention_mask, "arc")
+        self.assertGreater(model.n_matched, 0)
+        self.assertLess(model.n_matched, model.n_drafted)
+        for idx, prompt in enumerate(prompts):
+            expected = model.generate(prompt.unsqueeze(0),
+                                      attention_mask=torch.ones(1, len(prompt)),
+                                      generation_config=generation_config)[0, len(prompt):]
+            new_tokens = output[idx, max_len:]
+            self.assertTrue(torch.equal(new_tokens[:len(expected)], expected))
+            self.assertTrue((new_tokens[len(expected):] == 0).all())
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,85 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import itertools
+import random
+import unittest
+import pytest
+
+from ipex_llm.transformers.pipeline_parallel import partition_layers
+
+
+def slowest_stage(sizes, layer_costs, head_cost=0.0, tail_cost=0.0, stage_speeds=None):
+    stage_speeds = stage_speeds or [1.0] * len(sizes)
+    times = []
+    start = 0
+    for stage, size in enumerate(sizes):
+        cost = sum(layer_costs[start:start + size])
+        if stage == 0:
+            cost += head_cost
+        if stage == len(sizes) - 1:
+            cost += tail_cost
+        times.append(cost / stage_speeds[stage])
+        start += size
+    return max(times)
+
+
+class TestPartitionLayers(unittest.TestCase):
+
+    def test_uniform_layers(self):
+        self.assertEqual(partition_layers([1.0] * 32, 2), [16, 16])
+        self.assertEqual(partition_layers([1.0] * 32, 4), [8, 8, 8, 8])
+        self.assertEqual(partition_layers([1.0] * 3, 3), [1, 1, 1])
+
+    def test_head_and_tail(self):
+        # a large lm_head moves layers to the first stage
+        self.assertEqual(partition_layers([1.0] * 32, 2, tail_cost=8.0), [20, 12])
+        self.assertEqual(partition_layers([1.0] * 32, 4, head_cost=2.0, tail_cost=6.0),
+                         [8, 10, 10, 4])
+
+    def test_stage_speeds(self):
+        self.assertEqual(partition_layers([1.0] * 32, 2, stage_speeds=[1.0, 3.0]), [8, 24])
+
+    def test_matches_brute_force(self):
+        random.seed(0)
+        for _ in range(50):
+            num_layers = random.randint(1, 9)
+            num_stages = random.randint(1, num_layers)
+            layer_costs = [random.uniform(0.5, 2.0) for _ in range(num_layers)]
+            kwargs = {"head_cost": random.uniform(0.0, 3.0),
+                      "tail_cost": random.uniform(0.0, 3.0),
+                      "stage_speeds": [random.uniform(0.5, 2.0) for _ in range(num_stages)]}
+            sizes = partition_layers(layer_costs, num_stages, **kwargs)
+            self.assertEqual(len(sizes), num_stages)
+            self.assertEqual(sum(sizes), num_layers)
+            self.assertGreaterEqual(min(sizes), 1)
+            best = min(
+                slowest_stage([b - a for a, b in zip((0,) + cuts, cuts + (num_layers,))],
+                              layer_costs, **kwargs)
+                for cuts in itertools.combinations(range(1, num_layers), num_stages - 1)
+            )
+            self.assertAlmostEqual(slowest_stage(sizes, layer_costs, **kwargs), best)
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(RuntimeError):
+            partition_layers([1.0] * 2, 3)
+        with self.assertRaises(RuntimeError):
+            partition_layers([1.0] * 4, 2, stage_speeds=[1.0])
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
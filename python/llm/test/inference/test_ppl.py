@@ -0,0 +1,79 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+import sys
+import unittest
+import torch
+import torch.nn.functional as F
+import pytest
+
+from transformers import LlamaConfig, LlamaForCausalLM
+from ipex_llm import optimize_model
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..",
+                                "dev", "benchmark", "perplexity"))
+from ppl import sliding_window_nll
+
+
+def full_logits_nll(model, input_ids, window, stride):
+    # each step recomputes its whole window, positions start from 0 in every window
+    seq_len = input_ids.size(1)
+    nll = torch.zeros(input_ids.size(0), dtype=torch.float64)
+    begin = 0
+    while begin < seq_len - 1:
+        end = min(begin + (window if begin == 0 else stride), seq_len)
+        start = max(begin - (window - stride), 0)
+        logits = model(input_ids[:, start:end]).logits[:, begin - start:].float()
+        labels = input_ids[:, begin + 1:end + 1]
+        nll += F.cross_entropy(logits[:, :labels.size(1)].transpose(1, 2), labels,
+                               reduction="none").sum(1).double()
+        begin = end
+    return nll
+
+
+class TestSlidingWindowNLL(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        # with a single layer, the reused kv of a token does not depend on its own context,
+        # so the windowed nll equals recomputing every window from scratch
+        config = LlamaConfig(vocab_size=1000, hidden_size=128, intermediate_size=256,
+                             num_hidden_layers=1, num_attention_heads=4,
+                             num_key_value_heads=2, initializer_range=0.2)
+        self.model = LlamaForCausalLM(config).eval()
+        self.input_ids = torch.randint(0, 1000, (2, 64))
+
+    def check_nll(self, model, rtol):
+        with torch.no_grad():
+            for window, stride in [(64, 32), (32, 16), (20, 7), (16, 4), (16, 16)]:
+                nll, count = sliding_window_nll(model, self.input_ids, window, stride,
+                                                loss_chunk_size=8)
+                self.assertEqual(count, 63)
+                expected = full_logits_nll(model, self.input_ids, window, stride)
+                torch.testing.assert_close(nll, expected, rtol=rtol, atol=0)
+
+    def test_matches_full_logits(self):
+        self.check_nll(self.model, rtol=1e-5)
+
+    def test_optimized_model(self):
+        model = optimize_model(self.model.to(torch.bfloat16), low_bit="bf16")
+        self.check_nll(model, rtol=2e-3)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
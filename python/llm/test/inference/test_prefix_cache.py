@@ -0,0 +1,81 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import torch
+import pytest
+
+from transformers import LlamaConfig, LlamaForCausalLM
+from ipex_llm.transformers.kv import DynamicQuantizedCache
+from ipex_llm.transformers.prefix_cache import PrefixCache
+
+
+class TestPrefixCache(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=1000, hidden_size=128, intermediate_size=256,
+                             num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+                             pad_token_id=0)
+        self.model = LlamaForCausalLM(config).eval()
+
+    def generate(self, input_ids, **kwargs):
+        return self.model.generate(input_ids, max_new_tokens=8, do_sample=False, **kwargs)
+
+    def test_generate_matches(self):
+        prefix = torch.randint(1, 1000, (1, 20))
+        prompts = [torch.cat((prefix, torch.randint(1, 1000, (1, n))), dim=1) for n in [5, 9]]
+        expected = [self.generate(input_ids) for input_ids in prompts]
+        expected_beams = [self.generate(input_ids, num_beams=2, num_return_sequences=2)
+                          for input_ids in prompts]
+        self.model.prefix_cache = PrefixCache()
+        for _ in range(2):
+            for input_ids, output in zip(prompts, expected):
+                self.assertTrue(torch.equal(self.generate(input_ids), output))
+            # beam search expands input_ids but not the kv cache, so it skips the prefix cache
+            for input_ids, output in zip(prompts, expected_beams):
+                self.assertTrue(torch.equal(self.generate(input_ids, num_beams=2,
+                                                          num_return_sequences=2), output))
+        del self.model.prefix_cache
+
+    def test_quantized_kv_is_stored_quantized(self):
+        cache = DynamicQuantizedCache()
+        keys = [torch.randn(1, 2, 10, 8) for _ in range(2)]
+        for layer_idx, k in enumerate(keys):
+            cache.update(k, k, layer_idx)
+        prefix_cache = PrefixCache()
+        self.assertTrue(prefix_cache.insert(list(range(10)), cache))
+        # int8 kv plus a fp32 scale per token and head
+        self.assertEqual(prefix_cache.cache_size, 2 * 2 * (2 * 10 * 8 + 2 * 10 * 4))
+        prefix_len, layers = prefix_cache.match(list(range(6)) + [100])
+        self.assertEqual(prefix_len, 6)
+        self.assertEqual(layers[0][0].dtype, torch.int8)
+        restored = prefix_cache._restore(layers, prefix_len)
+        self.assertIsInstance(restored, DynamicQuantizedCache)
+        self.assertEqual(restored.get_seq_length(), 6)
+        k = torch.randn(1, 2, 1, 8)
+        for layer_idx in range(2):
+            k_cache, _ = restored.update(k, k, layer_idx)
+            expected, _ = cache.update(k, k, layer_idx)
+            self.assertTrue(torch.equal(k_cache, torch.cat((expected[:, :, :6],
+                                                            expected[:, :, -1:]), dim=2)))
+            cache.key_cache[layer_idx] = cache.key_cache[layer_idx][:, :, :-1]
+            cache.value_cache[layer_idx] = cache.value_cache[layer_idx][:, :, :-1]
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,220 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import copy
+import tempfile
+import types
+import unittest
+import torch
+import pytest
+import transformers
+
+from packaging import version
+from unittest import mock
+from ipex_llm.transformers import AutoModelForCausalLM
+from ipex_llm.transformers.kv import DynamicNormalCache
+from ipex_llm.transformers.models.utils import init_kv_cache, append_kv_cache
+from ipex_llm.transformers.speculative import _DraftKVStorage, _draft_past_key_values, \
+    _compact_batched_past_key_values, _batched_speculative_generate, clear_benchmarks, \
+    _check_tree_width
+
+
+class TestDraftKVStorage(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def target_kv(self, length, num_layers=2, dtype=torch.bfloat16):
+        kv = []
+        for _ in range(num_layers):
+            k, v = init_kv_cache(1, 2, 8, 0, 64, dtype, torch.device("cpu"))
+            kv.append(append_kv_cache(k, v, torch.randn(1, 2, length, 8).to(dtype),
+                                      torch.randn(1, 2, length, 8).to(dtype)))
+        return kv
+
+    def check_draft(self, draft_kv, target_kv):
+        for (draft_k, draft_v), (k, v) in zip(draft_kv, target_kv):
+            self.assertEqual(draft_k.dtype, torch.float32)
+            self.assertTrue(torch.equal(draft_k, k.float()))
+            self.assertTrue(torch.equal(draft_v, v.float()))
+
+    def test_legacy_cache(self):
+        storage = _DraftKVStorage("llama")
+        target_kv = self.target_kv(10)
+        draft_kv = _draft_past_key_values(tuple(target_kv), storage, 4)
+        self.check_draft(draft_kv, target_kv)
+        # the draft model appends in place, then 3 tokens are accepted by the target model
+        k_buffer = draft_kv[0][0].data_ptr()
+        draft_k, draft_v = append_kv_cache(*draft_kv[0], torch.randn(1, 2, 4, 8),
+                                           torch.randn(1, 2, 4, 8))
+        self.assertEqual(draft_k.data_ptr(), k_buffer)
+        target_kv = [append_kv_cache(k, v, torch.randn(1, 2, 3, 8).bfloat16(),
+                                     torch.randn(1, 2, 3, 8).bfloat16()) for k, v in target_kv]
+        draft_kv = _draft_past_key_values(tuple(target_kv), storage, 4)
+        self.assertEqual(draft_kv[0][0].data_ptr(), k_buffer)
+        self.check_draft(draft_kv, target_kv)
+
+    def test_qwen_layout(self):
+        storage = _DraftKVStorage("qwen")
+        target_kv = [(k.transpose(1, 2), v.transpose(1, 2)) for k, v in self.target_kv(10)]
+        draft_kv = _draft_past_key_values(tuple(target_kv), storage, 4)
+        self.assertEqual(draft_kv[0][0].shape, (1, 10, 2, 8))
+        self.check_draft(draft_kv, target_kv)
+
+    def test_dynamic_cache(self):
+        storage = _DraftKVStorage("llama")
+        cache = DynamicNormalCache()
+        for layer_idx, (k, v) in enumerate(self.target_kv(10)):
+            cache.update(k, v, layer_idx)
+        for length in [0, 2, 70]:
+            for layer_idx in range(2):
+                cache.update(torch.randn(1, 2, length, 8).bfloat16(),
+                             torch.randn(1, 2, length, 8).bfloat16(), layer_idx)
+            draft_cache = _draft_past_key_values(cache, storage, 4)
+            self.assertIsInstance(draft_cache, DynamicNormalCache)
+            self.assertEqual(draft_cache.get_seq_length(), cache.get_seq_length())
+            self.check_draft(zip(draft_cache.key_cache, draft_cache.value_cache),
+                             zip(cache.key_cache, cache.value_cache))
+            # the draft tokens are not appended to the target cache
+            draft_cache.update(torch.randn(1, 2, 4, 8), torch.randn(1, 2, 4, 8), 0)
+            self.assertEqual(cache.key_cache[0].size(2), draft_cache.key_cache[0].size(2) - 4)
+
+    def test_fp32_cache_is_shared(self):
+        storage = _DraftKVStorage("llama")
+        target_kv = tuple(self.target_kv(10, dtype=torch.float32))
+        self.assertIs(_draft_past_key_values(target_kv, storage, 4), target_kv)
+
+    def test_unsupported_cache(self):
+        from transformers.cache_utils import DynamicCache
+        cache = DynamicCache()
+        cache.update(torch.randn(1, 2, 10, 8), torch.randn(1, 2, 10, 8), 0)
+        with self.assertRaises(RuntimeError):
+            _draft_past_key_values(cache, _DraftKVStorage("llama"), 4)
+
+
+class TestBatchedSpeculative(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+
+    def test_compact_kv(self):
+        model = types.SimpleNamespace(config=types.SimpleNamespace(model_type="llama"))
+        # left padding, then the kept (1) and rejected (0) tokens of the verify forwards
+        attention_mask = torch.tensor([[0, 1, 1, 0, 1, 1, 0, 0],
+                                       [1, 1, 1, 1, 1, 1, 1, 0],
+                                       [0, 0, 1, 1, 0, 1, 0, 0]])
+        all_ids = torch.arange(24).view(3, 8)
+        kv = torch.randn(3, 2, 8, 4)
+        cache = DynamicNormalCache()
+        cache.update(kv.clone(), kv.clone(), 0)
+        for past_key_values in [[(kv.clone(), kv.clone())], cache]:
+            past_key_values, mask, ids = _compact_batched_past_key_values(
+                model, past_key_values, attention_mask, all_ids)
+            self.assertEqual(mask.tolist(), [[0, 1, 1, 1, 1, 0, 0],
+                                             [1, 1, 1, 1, 1, 1, 1],
+                                             [0, 0, 1, 1, 1, 0, 0]])
+            self.assertEqual(ids[mask.bool()].tolist(),
+                             all_ids[attention_mask.bool()].tolist())
+            for row in range(3):
+                for k in past_key_values[0]:
+                    self.assertEqual(k.size(2), 7)
+                    self.assertTrue(torch.equal(k[row][:, mask[row].bool()],
+                                                kv[row][:, attention_mask[row].bool()]))
+        # nothing to compact
+        mask = torch.tensor([[0, 1, 1], [1, 1, 1]])
+        past_key_values = [(torch.randn(2, 2, 3, 4), torch.randn(2, 2, 3, 4))]
+        self.assertIs(_compact_batched_past_key_values(model, past_key_values, mask,
+                                                       all_ids[:2, :3])[0], past_key_values)
+
+    def test_matches_greedy(self):
+        from transformers import LlamaConfig, LlamaForCausalLM, GenerationConfig, \
+            LogitsProcessorList
+        config = LlamaConfig(vocab_size=50, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+                             initializer_range=0.2, attn_implementation="eager")
+        model = LlamaForCausalLM(config).eval()
+        model.clear_benchmarks = types.MethodType(clear_benchmarks, model)
+        # a draft model which only agrees with the target model sometimes
+        draft_model = copy.deepcopy(model)
+        with torch.no_grad():
+            draft_model.lm_head.weight.add_(torch.randn_like(draft_model.lm_head.weight) * 0.2)
+        prompts = [torch.randint(0, 50, (length,)) for length in [12, 20, 7, 15]]
+        max_len = max(len(prompt) for prompt in prompts)
+        input_ids = torch.zeros(len(prompts), max_len, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for idx, prompt in enumerate(prompts):
+            input_ids[idx, max_len - len(prompt):] = prompt
+            attention_mask[idx, max_len - len(prompt):] = 1
+        generation_config = GenerationConfig(do_sample=False, pad_token_id=0, eos_token_id=2,
+                                             max_new_tokens=40)
+        output = _batched_speculative_generate(model, input_ids, draft_model, 40, 4, 0.5, 1,
+                                               generation_config, LogitsProcessorList(),
+                                               attention_mask=attention_mask)
+        self.assertGreater(model.n_matched, 0)
+        self.assertLess(model.n_matched, model.n_drafted)
+        for idx, prompt in enumerate(prompts):
+            expected = model.generate(prompt.unsqueeze(0),
+                                      attention_mask=torch.ones(1, len(prompt)),
+                                      generation_config=generation_config)[0, len(prompt):]
+            new_tokens = output[idx, max_len:]
+            self.assertTrue(torch.equal(new_tokens[:len(expected)], expected))
+            self.assertTrue((new_tokens[len(expected):] == 0).all())
+
+
+class TestTreeVerify(unittest.TestCase):
+
+    def test_check_tree_width(self):
+        with mock.patch("ipex_llm.transformers.speculative.trans_version", "4.36.2"):
+            _check_tree_width(1)
+            with self.assertRaises(RuntimeError):
+                _check_tree_width(2)
+        with mock.patch("ipex_llm.transformers.speculative.trans_version", "4.37.0"):
+            _check_tree_width(2)
+
+
+class TestSpeculativeCPU(unittest.TestCase):
+
+    def run_bf16_target_int4_draft(self, config_cls, model_cls):
+        torch.manual_seed(0)
+        config = config_cls(vocab_size=1000, hidden_size=128, intermediate_size=256,
+                            num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2)
+        with tempfile.TemporaryDirectory() as tempdir:
+            model_cls(config).save_pretrained(tempdir)
+            # the sym_int4 draft model computes in fp32 while the target kv is in bf16
+            model = AutoModelForCausalLM.from_pretrained(tempdir, torch_dtype=torch.bfloat16,
+                                                         load_in_low_bit="bf16",
+                                                         optimize_model=True,
+                                                         speculative=True)
+        input_ids = torch.randint(0, 1000, (1, 20))
+        output = model.generate(input_ids, max_new_tokens=32, do_sample=False,
+                                max_step_draft=4)
+        self.assertEqual(output.shape, (1, 52))
+        self.assertGreater(model.n_drafted, 0)
+
+    def test_llama_bf16_target_int4_draft(self):
+        from transformers import LlamaConfig, LlamaForCausalLM
+        self.run_bf16_target_int4_draft(LlamaConfig, LlamaForCausalLM)
+
+    @pytest.mark.skipif(version.parse(transformers.__version__) < version.parse("4.37.0"),
+                        reason="qwen2 requires transformers>=4.37.0")
+    def test_qwen2_bf16_target_int4_draft(self):
+        from transformers import Qwen2Config, Qwen2ForCausalLM
+        self.run_bf16_target_int4_draft(Qwen2Config, Qwen2ForCausalLM)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
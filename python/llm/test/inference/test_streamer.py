@@ -0,0 +1,134 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import random
+import unittest
+import pytest
+
+from ipex_llm.transformers.streamer import IncrementalDetokenizer, StopStringMatcher
+
+
+class ByteTokenizer:
+    """A byte-level tokenizer, multi-byte characters may be split across tokens."""
+
+    def __init__(self):
+        self.pieces = [b"Hello", b" world", b",", b" ", b"\n", b"a", b"ab", b"</s",
+                       b">", b"\xc3", b"\xa9", b"\xe4\xbd", b"\xa0", b"\xf0\x9f",
+                       b"\x98\x80", "é".encode(), "你好".encode()]
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        return b"".join(self.pieces[i] for i in token_ids).decode("utf-8", errors="replace")
+
+
+class TestIncrementalDetokenizer(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        self.tokenizer = ByteTokenizer()
+
+    def test_matches_full_decode(self):
+        detokenizer = IncrementalDetokenizer(self.tokenizer, skip_special_tokens=True)
+        for _ in range(50):
+            token_ids = [random.randrange(len(self.tokenizer.pieces)) for _ in range(60)]
+            texts = []
+            start = 0
+            while start < len(token_ids):
+                end = start + random.randint(1, 3)
+                texts.append(detokenizer.put(token_ids[start:end]))
+                start = end
+            texts.append(detokenizer.flush())
+            self.assertEqual("".join(texts), self.tokenizer.decode(token_ids))
+
+    def test_holds_back_incomplete_characters(self):
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        self.assertEqual(detokenizer.put([0]), "Hello")
+        # "é" split into two tokens
+        self.assertEqual(detokenizer.put([9]), "")
+        self.assertEqual(detokenizer.put([10]), "é")
+        # "😀" split into two tokens
+        self.assertEqual(detokenizer.put([13]), "")
+        self.assertEqual(detokenizer.put([14, 1]), "😀 world")
+        # only a short window of the 6 tokens is kept
+        self.assertLessEqual(len(detokenizer.tokens), 3)
+        self.assertEqual(detokenizer.flush(), "")
+
+    def test_flush_incomplete_character(self):
+        detokenizer = IncrementalDetokenizer(self.tokenizer)
+        self.assertEqual(detokenizer.put([5, 11]), "")
+        self.assertEqual(detokenizer.flush(), "a�")
+        # reset after flush
+        self.assertEqual(detokenizer.put([16]), "你好")
+
+
+class TestStopStringMatcher(unittest.TestCase):
+
+    @staticmethod
+    def find(text, stop_strings):
+        # the stop string which ends first, the longest one if several end at the same place
+        for end in range(1, len(text) + 1):
+            lengths = [len(s) for s in stop_strings if s and text[:end].endswith(s)]
+            if lengths:
+                return end - max(lengths)
+        return -1
+
+    @staticmethod
+    def partial_len(text, stop_strings):
+        return max(k for k in range(len(text) + 1)
+                   if k == 0 or any(s.startswith(text[len(text) - k:]) for s in stop_strings))
+
+    def test_matches_brute_force(self):
+        random.seed(0)
+        for _ in range(200):
+            stop_strings = ["".join(random.choices("abc", k=random.randint(1, 4)))
+                            for _ in range(random.randint(1, 3))]
+            text = "".join(random.choices("abcd", k=30))
+            matcher = StopStringMatcher(stop_strings)
+            expected = self.find(text, stop_strings)
+            fed = ""
+            result = -1
+            while result == -1 and len(fed) < len(text):
+                chunk = text[len(fed):len(fed) + random.randint(1, 4)]
+                result = matcher.feed(chunk)
+                if result == -1:
+                    fed += chunk
+                    self.assertEqual(matcher.partial_len, self.partial_len(fed, stop_strings),
+                                     msg=f"{stop_strings} {fed}")
+            self.assertEqual(result, expected, msg=f"{stop_strings} {text}")
+
+    def test_stop_strings(self):
+        matcher = StopStringMatcher(["</s>", "Observation:", ""])
+        self.assertEqual(matcher.feed("Thought: done</"), -1)
+        self.assertEqual(matcher.partial_len, 2)
+        self.assertEqual(matcher.feed("s"), -1)
+        self.assertEqual(matcher.partial_len, 3)
+        self.assertEqual(matcher.feed("> and more"), 13)
+
+        matcher = StopStringMatcher(["Observation:"])
+        self.assertEqual(matcher.feed("Obs"), -1)
+        self.assertEqual(matcher.partial_len, 3)
+        self.assertEqual(matcher.feed("erve"), -1)
+        self.assertEqual(matcher.partial_len, 0)
+        self.assertEqual(matcher.feed("\nObservation: x"), 8)
+
+    def test_no_stop_strings(self):
+        matcher = StopStringMatcher([])
+        self.assertEqual(matcher.feed("any text"), -1)
+        self.assertEqual(matcher.partial_len, 0)
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
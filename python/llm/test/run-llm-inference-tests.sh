@@ -17,6 +17,14 @@ fi
 export OMP_NUM_THREADS=$THREAD_NUM
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_transformers_api.py -v
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_optimize_model_api.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_kv_cache.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_gguf_api.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_streamer.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_pipeline_parallel.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_speculative.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_lookup.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_ppl.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_prefix_cache.py -v
 
 now=$(date "+%s")
 time=$((now-start))